@@ -0,0 +1,94 @@
+"""
+Measures how long it takes to load the bridge state at start-up.
+
+Generates a state similar to the production one (seen comment ids and
+per issue/ticket keys) and times loading it with every snapshot format, with and without
+seen_comments_id kept as an IntSet:
+
+    python benchmarks/storage_startup.py --comments 100000 --issues 5000
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from jsb import storage  # noqa
+
+
+def generate_state(comments, issues):
+    data = {
+        'seen_comments_id': set(str(100000 + i) for i in range(comments)),
+        'issue_to_ticket_id': {},
+    }
+
+    for i in range(issues):
+        key = 'CFS-{}'.format(i)
+        ticket_id = 'a0B{:015d}'.format(i)
+        data['issue_to_ticket_id'][key] = ticket_id
+        data['last_seen_jira_status:{}'.format(key)] = 'Support Investigating'
+        data['last_seen_jira_assignee:{}'.format(key)] = 'jirabot'
+        data['last_seen_sf_status:{}'.format(ticket_id)] = 'Open'
+        data['last_seen_sf_assignee:{}'.format(ticket_id)] = 'JiraBot'
+
+    return data
+
+
+def timed(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--comments', type=int, default=100000)
+    parser.add_argument('--issues', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    data = generate_state(args.comments, args.issues)
+    directory = tempfile.mkdtemp()
+    results = {}
+
+    try:
+        path = os.path.join(directory, 'state')
+        tmp_path = os.path.join(directory, 'tmp_state')
+
+        yaml_backend = storage.FileBackend(path, tmp_path, format='yaml')
+        yaml_backend.save(data)
+        results['yaml_size'] = os.path.getsize(path)
+        results['yaml_pure_load'] = timed(
+            lambda: yaml.load(open(path), Loader=yaml.Loader), args.repeat)
+        results['yaml_load'] = timed(yaml_backend.load, args.repeat)
+
+        binary_backend = storage.FileBackend(path, tmp_path)
+        results['binary_save'] = timed(lambda: binary_backend.save(data), args.repeat)
+        results['binary_size'] = os.path.getsize(path)
+        results['binary_load'] = timed(binary_backend.load, args.repeat)
+        assert binary_backend.load() == data
+
+        compact = dict(data)
+        compact['seen_comments_id'] = storage.IntSet(data['seen_comments_id'])
+        binary_backend.save(compact)
+        results['compact_size'] = os.path.getsize(path)
+        results['compact_load'] = timed(binary_backend.load, args.repeat)
+        assert binary_backend.load() == compact
+    finally:
+        shutil.rmtree(directory)
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
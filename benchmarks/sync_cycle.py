@@ -0,0 +1,245 @@
+"""
+Measures sync cycles against in-process fake JIRA and SF servers.
+
+Generates issues with comments, runs a first cycle which creates their
+tickets and copies the comments, then changes comments, statuses and
+assignees of a share of the pairs on both sides before every following
+cycle. Reports wall time, time per sync phase, API requests per endpoint,
+state store writes and peak memory of every cycle as JSON:
+
+    python benchmarks/sync_cycle.py --issues 500 --comments 5 --latency 0.02 \
+        --output results.json
+"""
+import json
+import os
+import platform
+import sys
+import time
+from argparse import ArgumentParser
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from jira import JIRA  # noqa
+
+from jsb import load_yaml, storage, testing  # noqa
+from jsb.bridge import Bridge  # noqa
+from jsb.metrics import Metrics  # noqa
+from jsb.ratelimit import SalesforceLimiter  # noqa
+from jsb.salesforce import Client, OAuth2, create_session  # noqa
+from jsb.threads import ThreadLocalProxy  # noqa
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', 'config.yml')
+BOT = 'jirabot'
+
+
+class CountingBackend(storage.InMemoryBackend):
+    def __init__(self):
+        super(CountingBackend, self).__init__()
+        self.saves = 0
+        self.changes = 0
+
+    def record(self, op, key, *args):
+        self.changes += 1
+
+    def save(self, data):
+        super(CountingBackend, self).save(data)
+        self.saves += 1
+
+
+def load_config(path, jira):
+    with open(path) as fp:
+        config = load_yaml(fp)
+
+    config.update({
+        'jira_url': jira.url,
+        'jira_issue_jql': 'project = BENCH',
+    })
+    return config
+
+
+def generate_issues(jira, config, issues, comments):
+    # JIRA returns every custom field of the project, empty ones as null
+    custom_fields = dict((config[name], None) for name in (
+        'jira_reference_field', 'jira_sf_case_number_field'))
+
+    for i in range(issues):
+        key = 'BENCH-{}'.format(i + 1)
+        if i % 3 == 0:
+            jira.add_issue(key, 'New', **custom_fields)
+        else:
+            jira.add_issue(key, 'Support Investigating', assignee=BOT, **custom_fields)
+
+        for j in range(comments):
+            jira.add_comment(key, 'Comment {} of {}'.format(j + 1, key))
+
+
+def change_pairs(jira, salesforce, store, config, share, cycle):
+    """
+    Change a ``share`` of the synced pairs, rotating through new comments
+    on both sides, a new SF status and a new JIRA assignee
+    """
+    keys = list(jira.issues)
+    step = max(1, int(round(1 / share))) if share else 0
+    if not step:
+        return
+
+    for n, key in enumerate(keys[cycle % step::step]):
+        ticket_id = store.hget('issue_to_ticket_id', key)
+        if not ticket_id:
+            continue
+
+        change = (n + cycle) % 4
+        if change == 0:
+            jira.add_comment(key, 'Follow-up on {} in cycle {}'.format(key, cycle))
+        elif change == 1:
+            salesforce.add_comment(Comment__c='Answer in cycle {}'.format(cycle),
+                                   related_id__c=ticket_id)
+        elif change == 2:
+            salesforce.update('proxyTicket__c', ticket_id, {'Status__c': 'Pending'})
+        else:
+            jira.assign(key, config['symantec_assignee_username'])
+
+
+def requests_by_endpoint(fake):
+    with fake.lock:
+        requests = dict(('{} {}'.format(*key), count) for key, count in fake.requests.items())
+        fake.requests.clear()
+    return requests
+
+
+def peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def phase_seconds(metrics):
+    return dict((dict(labels)['phase'], histogram.sum)
+                for (name, labels), histogram in metrics.snapshot()[2].items()
+                if name == 'sync_phase_seconds')
+
+
+def run_cycle(bridge, jira, salesforce, backend, trace_memory):
+    saves, changes = backend.saves, backend.changes
+    phases = phase_seconds(bridge.metrics)
+    requests_by_endpoint(jira)
+    requests_by_endpoint(salesforce)
+    if trace_memory:
+        tracemalloc.start()
+
+    start = time.time()
+    bridge.sync_issues()
+    wall_time = time.time() - start
+
+    result = {
+        'wall_time': wall_time,
+        'jira_requests': requests_by_endpoint(jira),
+        'sfdc_requests': requests_by_endpoint(salesforce),
+        'store_saves': backend.saves - saves,
+        'store_changes': backend.changes - changes,
+        'peak_rss': peak_rss(),
+        'failed_issues': bridge._cycle.get('failed', 0),
+        'skipped_issues': bridge._cycle.get('skipped', 0),
+        'phase_seconds': dict((phase, seconds - phases.get(phase, 0))
+                              for phase, seconds in phase_seconds(bridge.metrics).items()),
+    }
+    result['jira_request_total'] = sum(result['jira_requests'].values())
+    result['sfdc_request_total'] = sum(result['sfdc_requests'].values())
+
+    if trace_memory:
+        result['peak_traced_memory'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--issues', type=int, default=200)
+    parser.add_argument('--comments', type=int, default=3,
+                        help='Comments per generated issue')
+    parser.add_argument('--changes', type=float, default=0.2,
+                        help='Share of pairs changed before every cycle after the first')
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every JIRA and SF request')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--config-file', default=CONFIG_PATH)
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Also report the peak of Python allocations of every cycle, '
+                             'slows the cycles down')
+    parser.add_argument('--output', help='Write the results to this file instead of stdout')
+    args = parser.parse_args()
+
+    if args.trace_memory and tracemalloc is None:
+        parser.error('--trace-memory requires Python 3')
+
+    jira = testing.FakeJira(latency=args.latency, username=BOT).start()
+    salesforce = testing.FakeSalesforce(latency=args.latency).start()
+
+    try:
+        config = load_config(args.config_file, jira)
+        generate_issues(jira, config, args.issues, args.comments)
+
+        oauth2 = OAuth2('client', 'secret', 'user', 'password', auth_url=salesforce.url)
+        session = create_session(pool_size=max(10, args.workers))
+        # The fake reports no API usage, the limiter stays out of the way
+        limiter = SalesforceLimiter(rate=100000)
+
+        def create_jira_client():
+            return JIRA(server=jira.url, basic_auth=(BOT, 'password'))
+
+        def create_sfdc_client():
+            return Client(oauth2, session=session, limiter=limiter)
+
+        if args.workers > 1:
+            jira_client = ThreadLocalProxy(create_jira_client)
+            sfdc_client = ThreadLocalProxy(create_sfdc_client)
+        else:
+            jira_client = create_jira_client()
+            sfdc_client = create_sfdc_client()
+
+        metrics = Metrics()
+        backend = CountingBackend()
+        store = storage.Store(backend, compact_sets=['seen_comments_id'], metrics=metrics)
+        bridge = Bridge(sfdc_client, jira_client, store, config, workers=args.workers,
+                        metrics=metrics)
+
+        cycles = []
+        for cycle in range(args.cycles):
+            if cycle:
+                change_pairs(jira, salesforce, store, config, args.changes, cycle)
+            result = run_cycle(bridge, jira, salesforce, backend, args.trace_memory)
+            result['cycle'] = cycle + 1
+            cycles.append(result)
+    finally:
+        jira.stop()
+        salesforce.stop()
+
+    results = {
+        'params': vars(args),
+        'python': platform.python_version(),
+        'cycles': cycles,
+    }
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
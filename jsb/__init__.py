@@ -3,12 +3,23 @@ import sys
 
 import yaml
 
+# libyaml based loader and dumper are several times faster than
+# the pure Python ones, use them whenever PyYAML was built with it
+YamlLoader = getattr(yaml, 'CLoader', yaml.Loader)
+YamlDumper = getattr(yaml, 'CDumper', yaml.Dumper)
+
 
 def force_yaml_unicode():
     def unicode_str_constructor(loader, node):
         return unicode(loader.construct_scalar(node))
 
     yaml.add_constructor(u'tag:yaml.org,2002:str', unicode_str_constructor)
+    yaml.add_constructor(u'tag:yaml.org,2002:str', unicode_str_constructor,
+                         Loader=YamlLoader)
+
+
+def load_yaml(stream):
+    return yaml.load(stream, Loader=YamlLoader)
 
 if sys.version_info < (3, 0):
     force_yaml_unicode()
@@ -0,0 +1,417 @@
+"""
+asyncio execution mode (Python 3.7+, requires aiohttp, the "asyncio" extra).
+
+`AsyncClient` talks to Salesforce over a single aiohttp session, so
+hundreds of requests can be in flight from one thread. Its queries and
+the handling of expired sessions and throttled requests are the ones of
+`jsb.salesforce.Client`.
+
+The bridge logic stays synchronous, as the JIRA library and the state
+backends block. `sync_issues` runs the SF reads of every cycle and of
+every issue in flight on the event loop, and hands the issues to a small
+pool of threads for the rest, where the bridge reaches SF through
+`BlockingClient`, which submits the calls to the event loop.
+"""
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+from jsb import LOG
+from jsb.ratelimit import SalesforceLimiter
+from jsb.salesforce import (COLLECTION_SIZE, COLLECTIONS_URL, COMMENTS_URL, POOL_SIZE,
+                            QUERY_URL, TICKETS_URL, RequestStats, RetryPolicy, TokenCache, WriteBatch,
+                            auth_headers, comment_stats, comment_stats_queries,
+                            comments_by_external_id, comments_by_external_id_queries,
+                            modified_ticket_comments_query, modified_tickets_query,
+                            session_token, ticket_comment_query, ticket_comments_query,
+                            tickets_queries, valid_ids)
+
+# Threads running the blocking part of the issues in flight
+THREADS = 8
+
+
+class LimitedResponse(object):
+    """
+    Parts of an aiohttp response read by the rate limiters, which expect
+    a requests response
+    """
+    def __init__(self, response, body):
+        self.status_code = response.status
+        self.headers = response.headers
+        self.content = body
+
+
+class AsyncClient(object):
+    """
+    asyncio counterpart of `jsb.salesforce.Client`.
+
+    ``limiter`` can be shared with synchronous clients, requests wait
+    for it on the event loop.
+    """
+    def __init__(self, oauth2, session=None, limit=POOL_SIZE, timeout=60, stats=None,
+                 token_cache=None, limiter=None):
+        self.oauth2 = oauth2
+        self.limit = limit
+        self.timeout = timeout
+        self.stats = stats or RequestStats()
+        self.token_cache = token_cache or TokenCache()
+        self.limiter = limiter or SalesforceLimiter()
+        self._session = session
+        self._auth_lock = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.limit)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={'Accept-Encoding': 'gzip, deflate'})
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            # A new session is created on the next request, possibly on
+            # a new event loop the lock has to be bound to as well
+            self._session = None
+        self._auth_lock = None
+
+    async def ticket(self, id):
+        try:
+            return await self.get('{}/{}'.format(TICKETS_URL, id))
+        except aiohttp.ClientResponseError:
+            return False
+
+    async def tickets(self, ids):
+        return await self._search_all(tickets_queries(ids))
+
+    async def create_ticket(self, data):
+        return await self.post(TICKETS_URL, json=data)
+
+    async def update_ticket(self, id, data):
+        return await self.patch('{}/{}'.format(TICKETS_URL, id), json=data)
+
+    async def update_comment(self, id, data):
+        return await self.patch('{}/{}'.format(COMMENTS_URL, id), json=data)
+
+    async def create_ticket_comment(self, data):
+        return await self.post(COMMENTS_URL, json=data)
+
+    async def create_records(self, records):
+        return await self.post(COLLECTIONS_URL, json={'allOrNone': False, 'records': records})
+
+    async def update_records(self, records):
+        return await self.patch(COLLECTIONS_URL, json={'allOrNone': False, 'records': records})
+
+    async def ticket_comment_stats(self, ticket_ids):
+        ticket_ids = valid_ids(ticket_ids)
+        return comment_stats(ticket_ids, await self._search_all(comment_stats_queries(ticket_ids)))
+
+    async def modified_tickets(self, since):
+        return await self.search(modified_tickets_query(since))
+
+    async def modified_ticket_comments(self, since):
+        return await self.search(modified_ticket_comments_query(since))
+
+    async def ticket_comments(self, ticket_id):
+        return await self.search(ticket_comments_query(ticket_id))
+
+    async def ticket_comment(self, comment_id):
+        return await self.get(QUERY_URL, params=dict(q=ticket_comment_query(comment_id)))
+
+    async def ticket_comments_by_external_id(self, external_ids):
+        return comments_by_external_id(
+            await self._search_all(comments_by_external_id_queries(external_ids)))
+
+    async def _search_all(self, queries):
+        """
+        Records of all ``queries``, which run concurrently
+        """
+        records = []
+        for result in await asyncio.gather(*[self.search(query) for query in queries]):
+            records.extend(result)
+        return records
+
+    async def search(self, query):
+        """
+        Run a SOQL query and follow its pagination
+
+        :return: list of all records
+        """
+        records = []
+        response = await self.get(QUERY_URL, params=dict(q=query))
+        while True:
+            records.extend(response['records'])
+
+            if response['done']:
+                return records
+
+            response = await self.get(response['nextRecordsUrl'])
+
+    async def get(self, url, **kwargs):
+        return await self._request('get', url, **kwargs)
+
+    async def patch(self, url, **kwargs):
+        return await self._request('patch', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self._request('post', url, **kwargs)
+
+    async def token(self, stale=None):
+        """
+        Cached token, authenticating if there is none yet or the cached one
+        is the ``stale`` access token. Only the event loop thread may use
+        the token cache of an async client.
+        """
+        if self._auth_lock is None:
+            self._auth_lock = asyncio.Lock()
+
+        async with self._auth_lock:
+            token = self.token_cache.load()
+            if token and token['access_token'] != stale:
+                return token
+
+            url, data = self.oauth2.token_request()
+            async with self.session.post(url, data=data) as response:
+                response.raise_for_status()
+                token = session_token(await response.json())
+
+            self.token_cache.save(token)
+            return token
+
+    async def _request(self, method, url, headers=None, **kwargs):
+        token = await self.token()
+        policy = RetryPolicy()
+        while True:
+            response, body = await self._send(token, method, url, headers, **kwargs)
+            action = policy.action(response.status)
+            if action is None:
+                break
+            if action == RetryPolicy.AUTHENTICATE:
+                token = await self.token(stale=token['access_token'])
+
+        response.raise_for_status()
+        if not body:
+            return None
+        return json.loads(body.decode('utf-8'))
+
+    async def _acquire(self):
+        wait = self.limiter.reserve()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self.limiter.reserve()
+
+    async def _send(self, token, method, url, headers=None, **kwargs):
+        await self._acquire()
+        start = time.time()
+        async with self.session.request(method, token['instance_url'] + url,
+                                        headers=auth_headers(token, headers),
+                                        **kwargs) as response:
+            body = await response.read()
+            elapsed = time.time() - start
+            self.limiter.observe(LimitedResponse(response, body), elapsed)
+
+            self.stats.record(method, url, elapsed)
+            LOG.debug('SF %s %s: %s in %.3fs', method.upper(), url, response.status, elapsed)
+
+            return response, body
+
+
+class BlockingClient(object):
+    """
+    Synchronous `jsb.salesforce.Client` interface over an `AsyncClient`.
+
+    Calls must be made from threads other than the one running ``loop``.
+    """
+    def __init__(self, client, loop):
+        self.client = client
+        self.loop = loop
+
+    def _call(self, name, *args):
+        coro = getattr(self.client, name)(*args)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def ticket(self, id):
+        return self._call('ticket', id)
+
+    def tickets(self, ids):
+        return self._call('tickets', list(ids))
+
+    def create_ticket(self, data):
+        return self._call('create_ticket', data)
+
+    def update_ticket(self, id, data):
+        return self._call('update_ticket', id, data)
+
+    def update_comment(self, id, data):
+        return self._call('update_comment', id, data)
+
+    def create_ticket_comment(self, data):
+        return self._call('create_ticket_comment', data)
+
+    def create_records(self, records):
+        return self._call('create_records', records)
+
+    def update_records(self, records):
+        return self._call('update_records', records)
+
+    def batch(self, size=COLLECTION_SIZE):
+        return WriteBatch(self, size=size)
+
+    def ticket_comment_stats(self, ticket_ids):
+        return self._call('ticket_comment_stats', list(ticket_ids))
+
+    def modified_tickets(self, since):
+        return self._call('modified_tickets', since)
+
+    def modified_ticket_comments(self, since):
+        return self._call('modified_ticket_comments', since)
+
+    def ticket_comments(self, ticket_id):
+        return self._call('ticket_comments', ticket_id)
+
+    def ticket_comment(self, comment_id):
+        return self._call('ticket_comment', comment_id)
+
+    def ticket_comments_by_external_id(self, external_ids):
+        return self._call('ticket_comments_by_external_id', list(external_ids))
+
+    def search(self, query):
+        return self._call('search', query)
+
+
+def comments_ticket_id(bridge, issue):
+    """
+    Id of the ticket whose comments ``bridge`` is going to read while
+    syncing ``issue``, None if it has no prefetched ticket or is skipped
+    as unchanged
+    """
+    ticket_id = bridge.linked_ticket_id(issue)
+    ticket = bridge.ticket_cache.peek(ticket_id) if ticket_id else None
+    if not ticket:
+        return
+
+    if bridge.skip_unchanged:
+        fingerprint = bridge.fingerprint(issue)
+        if fingerprint and bridge.store.hget('fingerprints', issue.key) == fingerprint:
+            return
+    return ticket['Id']
+
+
+async def prefetch_tickets(bridge, client, issues):
+    """
+    `jsb.bridge.Bridge.prefetch_tickets` with all queries in flight at once
+    """
+    ids = bridge.ticket_ids(issues)
+    try:
+        found = bridge.cache_tickets(ids, await client.tickets(ids))
+    except Exception:
+        LOG.exception('Failed to prefetch SF tickets')
+        return
+
+    if bridge.skip_unchanged:
+        try:
+            bridge.comment_stats = await client.ticket_comment_stats(
+                ticket['Id'] for ticket in found.values())
+        except Exception:
+            LOG.exception('Failed to prefetch SF comment stats')
+
+
+async def sync_issues(bridge, client, executor, concurrency=10):
+    """
+    Run a sync cycle of ``bridge``, with up to ``concurrency`` issues in
+    flight.
+
+    The SF comments of an issue are fetched on the event loop, then the
+    issue waits for one of the threads of ``executor`` to run the bridge,
+    which blocks on JIRA and the state backend.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def sync_issue(issue):
+        async with semaphore:
+            if bridge.stopping.is_set():
+                return
+
+            ticket_id = comments_ticket_id(bridge, issue)
+            if ticket_id:
+                try:
+                    bridge.prefetched_comments[ticket_id] = await client.ticket_comments(ticket_id)
+                except Exception:
+                    # The bridge queries them again
+                    LOG.exception('Failed to prefetch SF comments of %s', issue.key)
+            await loop.run_in_executor(executor, bridge._sync_issue_safe, issue)
+
+    issues = await loop.run_in_executor(executor, bridge.search_issues)
+    bridge.prepare_cycle(issues, prefetch=False)
+    await prefetch_tickets(bridge, client, issues)
+    tasks = [asyncio.ensure_future(sync_issue(issue)) for issue in issues]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # Workers may still need the loop for SF calls, keep running it
+        # until every issue in flight is done
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if bridge.stopping.is_set():
+        await loop.run_in_executor(executor, bridge.store.flush)
+    else:
+        await loop.run_in_executor(executor, bridge.finish_cycle)
+
+
+class Runner(object):
+    """
+    Runs sync cycles of ``bridge`` on one event loop, with SF calls made
+    through ``client``. The loop, the SF session of ``client`` and the
+    ``threads`` threads, with the JIRA clients they created, are kept
+    between cycles until `close`.
+
+    :param bridge: `jsb.bridge.Bridge`, its SF client is replaced by a
+        synchronous wrapper of ``client`` running on the loop
+    :param client: `AsyncClient`
+    """
+    def __init__(self, bridge, client, concurrency=10, threads=THREADS):
+        self.bridge = bridge
+        self.client = client
+        self.concurrency = concurrency
+
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, min(threads, concurrency)))
+        bridge.sfdc_client = BlockingClient(client, self.loop)
+
+    def run(self):
+        """
+        Run one sync cycle
+        """
+        asyncio.set_event_loop(self.loop)
+        task = self.loop.create_task(sync_issues(self.bridge, self.client, self.executor,
+                                                 concurrency=self.concurrency))
+        try:
+            self.loop.run_until_complete(task)
+        except KeyboardInterrupt:
+            LOG.error('Operation canceled by user')
+            # Issues being synced right now are finished, pending ones dropped
+            self.bridge.stop()
+            self.loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+            self.bridge.store.flush()
+
+    def close(self):
+        self.executor.shutdown()
+        self.loop.run_until_complete(self.client.close())
+        self.loop.close()
+
+
+def run(bridge, client, concurrency=10, threads=THREADS):
+    """
+    Run one sync cycle of ``bridge`` with a `Runner` of its own
+    """
+    runner = Runner(bridge, client, concurrency=concurrency, threads=threads)
+    try:
+        runner.run()
+    finally:
+        runner.close()
@@ -0,0 +1,244 @@
+import threading
+import time
+import unittest
+
+try:
+    import asyncio
+    import aiohttp  # noqa
+    from jsb import aio
+except (ImportError, SyntaxError):
+    raise unittest.SkipTest('asyncio mode requires Python 3 and aiohttp')
+
+from jsb import bridge, ratelimit, storage, testing
+from jsb.bridge_test import CONFIG, FakeJira, Obj
+from jsb.salesforce import OAuth2
+
+
+def oauth2(url):
+    return OAuth2('client', 'secret', 'user', 'password', auth_url=url)
+
+
+def async_client(url):
+    # Fast enough not to slow the tests down, short pauses when throttled
+    limiter = ratelimit.SalesforceLimiter(rate=1000, backoff_factor=0.01)
+    return aio.AsyncClient(oauth2(url), limiter=limiter)
+
+
+class AsyncClientTest(unittest.TestCase):
+    def setUp(self):
+        self.salesforce = testing.FakeSalesforce(page_size=3).start()
+        self.addCleanup(self.salesforce.stop)
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(self.loop.close)
+        self.client = async_client(self.salesforce.url)
+        self.addCleanup(lambda: self.loop.run_until_complete(self.client.close()))
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_ticket(self):
+        ticket = self.salesforce.add_ticket(Status__c='Open')
+
+        assert self.run_async(self.client.ticket(ticket['Id']))['Status__c'] == 'Open'
+        assert self.run_async(self.client.ticket('a0B999999999999999')) is False
+
+    def test_concurrent_requests_authenticate_once(self):
+        tickets = [self.salesforce.add_ticket() for _ in range(20)]
+
+        results = self.run_async(asyncio.gather(
+            *[self.client.ticket(ticket['Id']) for ticket in tickets]))
+
+        assert [result['Id'] for result in results] == [ticket['Id'] for ticket in tickets]
+        assert self.salesforce.requests[('POST', '/services/oauth2/token')] == 1
+
+    def test_expired_session(self):
+        ticket = self.salesforce.add_ticket()
+        self.run_async(self.client.ticket(ticket['Id']))
+        self.salesforce.expire_token()
+
+        results = self.run_async(asyncio.gather(
+            *[self.client.ticket(ticket['Id']) for _ in range(5)]))
+
+        assert all(result['Id'] == ticket['Id'] for result in results)
+        assert self.salesforce.requests[('POST', '/services/oauth2/token')] == 2
+
+    def test_expired_session_on_a_new_loop(self):
+        ticket = self.salesforce.add_ticket()
+        # Concurrent authentication binds the lock to the loop
+        self.run_async(asyncio.gather(*[self.client.ticket(ticket['Id']) for _ in range(5)]))
+        self.run_async(self.client.close())
+
+        # The next daemon cycle runs on a new event loop
+        first_loop, self.loop = self.loop, asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.salesforce.expire_token()
+        try:
+            results = self.run_async(asyncio.gather(
+                *[self.client.ticket(ticket['Id']) for _ in range(5)]))
+        finally:
+            self.run_async(self.client.close())
+            self.loop.close()
+            self.loop = first_loop
+
+        assert all(result['Id'] == ticket['Id'] for result in results)
+
+    def test_throttled_request_is_retried(self):
+        ticket = self.salesforce.add_ticket()
+        self.run_async(self.client.ticket(ticket['Id']))
+        self.salesforce.throttle(2)
+
+        assert self.run_async(self.client.ticket(ticket['Id']))['Id'] == ticket['Id']
+        assert self.salesforce.requests[('GET', '/services/data/v35.0/sobjects/proxyTicket__c/{id}')] == 4
+
+    def test_requests_wait_for_the_limiter(self):
+        tickets = [self.salesforce.add_ticket() for _ in range(4)]
+        limiter = ratelimit.SalesforceLimiter(rate=20, burst=1, backoff_factor=0.05)
+        self.client = aio.AsyncClient(oauth2(self.salesforce.url), limiter=limiter)
+        self.salesforce.throttle(1)
+
+        start = time.time()
+        results = self.run_async(asyncio.gather(
+            *[self.client.ticket(ticket['Id']) for ticket in tickets]))
+
+        assert [result['Id'] for result in results] == [ticket['Id'] for ticket in tickets]
+        # The throttled request paused the others, then was retried
+        assert (limiter.requests, limiter.throttled) == (5, 1)
+        assert time.time() - start >= 0.2
+
+    def test_search_pagination(self):
+        tickets = [self.salesforce.add_ticket() for _ in range(8)]
+
+        records = self.run_async(self.client.tickets(ticket['Id'] for ticket in tickets))
+
+        assert sorted(record['Id'] for record in records) == sorted(t['Id'] for t in tickets)
+        assert self.salesforce.requests[('GET', '/services/data/v35.0/query')] == 1
+        assert self.salesforce.requests[('GET', '/services/data/v35.0/query/{id}')] == 2
+
+    def test_writes(self):
+        result = self.run_async(self.client.create_ticket({'Subject__c': 'Subject'}))
+        self.run_async(self.client.update_ticket(result['id'], {'Status__c': 'Open'}))
+        comment = self.run_async(self.client.create_ticket_comment(
+            {'Comment__c': 'Text', 'related_id__c': result['id'], 'external_id__c': '10'}))
+        self.run_async(self.client.update_comment(comment['id'], {'Comment__c': 'Edited'}))
+
+        ticket = self.salesforce.records['proxyTicket__c'][result['id']]
+        assert ticket['Subject__c'] == 'Subject'
+        assert ticket['Status__c'] == 'Open'
+
+        comments = self.run_async(self.client.ticket_comments(result['id']))
+        assert [c['Comment__c'] for c in comments] == ['Edited']
+        found = self.run_async(self.client.ticket_comments_by_external_id(['10', '11']))
+        assert list(found) == ['10']
+
+    def test_modified_tickets(self):
+        old = self.salesforce.add_ticket(LastModifiedDate='2016-01-01T00:00:00.000+0000')
+        new = self.salesforce.add_ticket(External_id__c='TEST-1')
+        self.salesforce.add_comment(related_id__c=old['Id'])
+
+        since = time.time() - 60
+        tickets = self.run_async(self.client.modified_tickets(since))
+        comments = self.run_async(self.client.modified_ticket_comments(since))
+
+        assert [(t['Id'], t['External_id__c']) for t in tickets] == [(new['Id'], 'TEST-1')]
+        assert [c['related_id__c'] for c in comments] == [old['Id']]
+
+    def test_ticket_comment_stats(self):
+        tickets = [self.salesforce.add_ticket() for _ in range(3)]
+        self.salesforce.add_comment(related_id__c=tickets[0]['Id'], LastModifiedDate='2016-01-01')
+        self.salesforce.add_comment(related_id__c=tickets[0]['Id'], LastModifiedDate='2016-01-02')
+        self.salesforce.add_comment(related_id__c=tickets[1]['Id'], LastModifiedDate='2016-01-03')
+
+        stats = self.run_async(self.client.ticket_comment_stats(t['Id'] for t in tickets))
+
+        assert stats == {tickets[0]['Id'][:15]: (2, '2016-01-02'),
+                         tickets[1]['Id'][:15]: (1, '2016-01-03'),
+                         tickets[2]['Id'][:15]: (0, None)}
+
+
+class AsyncSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.salesforce = testing.FakeSalesforce(latency=0.01).start()
+        self.addCleanup(self.salesforce.stop)
+
+    def test_sync_issues(self):
+        jira = FakeJira()
+        for i in range(20):
+            issue = jira.add_issue('TEST-{}'.format(i), 'New', assignee=None)
+            issue.fields.comment.comments.append(bridge_comment('{}'.format(i)))
+
+        store = storage.Store()
+        client = async_client(self.salesforce.url)
+        aio.run(bridge.Bridge(None, jira, store, CONFIG), client, concurrency=10)
+
+        assert len(self.salesforce.records['proxyTicket__c']) == 20
+        assert len(self.salesforce.records['proxyTicketComment__c']) == 20
+        assert len(store.get('issue_to_ticket_id')) == 20
+        assert len(store.get('seen_comments_id')) == 20
+
+    def test_sf_reads_do_not_take_threads(self):
+        jira = FakeJira()
+        for i in range(20):
+            jira.add_issue('TEST-{}'.format(i), 'New', assignee=None)
+
+        store = storage.Store()
+        client = async_client(self.salesforce.url)
+        sync_bridge = bridge.Bridge(None, jira, store, CONFIG)
+        aio.run(sync_bridge, client, concurrency=10)
+        for ticket_id in store.get('issue_to_ticket_id').values():
+            self.salesforce.add_comment(related_id__c=ticket_id, Comment__c='From SF',
+                                        CreatedBy={'Name': 'SF user'})
+
+        threads = set()
+        prefetched = []
+        sync_issue, ticket_comments = sync_bridge._sync_issue_safe, sync_bridge.ticket_comments
+
+        def record_thread(issue):
+            threads.add(threading.current_thread())
+            sync_issue(issue)
+
+        def record_prefetched(ticket_id):
+            prefetched.append(ticket_id in sync_bridge.prefetched_comments)
+            return ticket_comments(ticket_id)
+
+        sync_bridge._sync_issue_safe = record_thread
+        sync_bridge.ticket_comments = record_prefetched
+        aio.run(sync_bridge, client, concurrency=10, threads=2)
+
+        assert len(threads) <= 2
+        assert all(len(issue.fields.comment.comments) == 1 for issue in jira.issues.values())
+        # Comments of all issues were fetched on the loop, none by the threads
+        assert prefetched == [True] * 20
+
+    def test_runner_keeps_threads_and_session(self):
+        jira = FakeJira()
+        for i in range(5):
+            jira.add_issue('TEST-{}'.format(i), 'New', assignee=None)
+
+        client = async_client(self.salesforce.url)
+        sync_bridge = bridge.Bridge(None, jira, storage.Store(), CONFIG)
+        runner = aio.Runner(sync_bridge, client, concurrency=10, threads=2)
+        self.addCleanup(runner.close)
+
+        threads, sessions = set(), set()
+        sync_issue = sync_bridge._sync_issue_safe
+
+        def record_thread(issue):
+            threads.add(threading.current_thread())
+            sync_issue(issue)
+
+        sync_bridge._sync_issue_safe = record_thread
+        for _ in range(3):
+            runner.run()
+            sessions.add(client.session)
+
+        assert len(sync_bridge.store.get('issue_to_ticket_id')) == 5
+        assert len(threads) <= 2
+        assert len(sessions) == 1
+
+
+def bridge_comment(id):
+    return Obj(id=id, body='Comment', author=Obj(name='user', displayName='User'),
+               created='2016-01-01T00:00:00.000+0000')
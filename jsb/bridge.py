@@ -1,17 +1,155 @@
+import hashlib
+import json
 import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
 import jinja2
+from multiprocessing.pool import ThreadPool
 from dateutil.parser import parse
+from jira import JIRAError
 from jsb import LOG
+from jsb.cache import IssueCache, TicketCache, TransitionCache
+from jsb.metrics import Metrics
+from jsb.salesforce import WriteError
+
+
+ORDER_BY = re.compile(r'\s+ORDER\s+BY\s+.*$', re.IGNORECASE | re.DOTALL)
+ISSUE_KEY = re.compile(r'^[A-Z][A-Z0-9_]*-[0-9]+$')
+# Number of issue keys per "key in (...)" search
+KEYS_PER_SEARCH = 100
+# Fields of the synced issues
+ISSUE_FIELDS = 'assignee,attachment,comment,*navigable'
+
+# Waiting for pool results with a timeout keeps the main thread
+# interruptible with Ctrl+C on Python 2
+POOL_WAIT_TIMEOUT = 365 * 24 * 60 * 60
+
+# Steps syncing an issue with its ticket, in order, each one is timed
+SYNC_PHASES = ('sync_priority', 'sync_jira_reference', 'sync_assignee',
+               'sync_comments_from_jira', 'sync_comments_to_jira',
+               'sync_subject_description', 'sync_status')
+
+
+def shard_of(key, count):
+    """
+    Shard of the issue ``key`` among ``count`` shards, the same in every
+    process and on every host
+    """
+    return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % count
+
+
+def shard_state(state, shard):
+    """
+    Part of a sync ``state`` about the issues of ``shard``, (index, count),
+    and their tickets. Seen comment ids do not tell their issue and are
+    all kept, as are the watermarks.
+    """
+    index, count = shard
+
+    def owned(key):
+        return shard_of(key, count) == index
+
+    links = state.get('issue_to_ticket_id') or {}
+    tickets = set(ticket_id[:15] for key, ticket_id in links.items() if owned(key))
+
+    result = {}
+    for key in state:
+        value = state[key]
+        if key in ('issue_to_ticket_id', 'fingerprints'):
+            result[key] = dict((field, field_value) for field, field_value in value.items()
+                               if owned(field))
+        elif key == 'retry_issue_keys':
+            result[key] = [issue_key for issue_key in value if owned(issue_key)]
+        elif key.startswith('last_seen_jira_'):
+            if owned(key.split(':', 1)[1]):
+                result[key] = value
+        elif key.startswith('last_seen_sf_'):
+            if key.split(':', 1)[1][:15] in tickets:
+                result[key] = value
+        else:
+            result[key] = value
+    return result
+
+
+class StagedUser(object):
+    """
+    Assignee of an issue whose assignment was not sent to JIRA yet
+    """
+    def __init__(self, name):
+        self.name = name
+        self.displayName = name
+
+
+class IssueChanges(object):
+    """
+    JIRA writes to the synced issue, staged until `Bridge.flush_issue_changes`.
+
+    Field updates are merged into a single update, an assignment only
+    keeps the last assignee and is dropped when it ends up where the issue
+    started.
+    """
+    def __init__(self):
+        self.issue = None
+        self.fields = OrderedDict()
+        self.assigned = False
+        self.assignee = None
+        self.original_assignee = None
+
+    def update(self, issue, fields):
+        self.issue = issue
+        self.fields.update(fields)
+
+    def assign(self, issue, assignee):
+        if not self.assigned:
+            self.assigned = True
+            self.original_assignee = getattr(issue.fields.assignee, 'name', None)
+        self.issue = issue
+        self.assignee = assignee
+
+    def __len__(self):
+        return len(self.fields) + int(self.assigned)
 
 
 class Bridge(object):
-    def __init__(self, sfdc_client, jira_client, store, config):
+    def __init__(self, sfdc_client, jira_client, store, config, workers=1, metrics=None,
+                 shard=None):
         self.sfdc_client = sfdc_client
         self.jira_client = jira_client
         self.store = store
-        self.force_assignee = False
+        self.workers = workers
+        self._pool = None
+        # (index, count) of the shard of issues synced by this bridge, the
+        # other issues are left to other processes
+        self.shard = shard
+        self.metrics = metrics or Metrics()
+        # Issues taking longer are logged with the time of every phase
+        self.slow_issue_threshold = config.get('slow_issue_threshold', 30)
+        self._local = threading.local()
+        self.ticket_cache = TicketCache()
+        self.transition_cache = TransitionCache(ttl=config.get('jira_transition_cache_ttl', 3600))
 
         self.issue_jql = config['jira_issue_jql']
+        self.search_page_size = config.get('jira_search_page_size', 100)
+
+        # Incremental mode only fetches issues updated since the last
+        # finished cycle and those which failed in it, with a full pass
+        # every `full_sync_interval`
+        self.incremental_sync = config.get('jira_incremental_sync', False)
+        self.sync_skew = config.get('jira_sync_skew', 300)
+        self.full_sync_interval = config.get('jira_full_sync_interval', 3600)
+        self._cycle = {}
+        self._cycle_lock = threading.Lock()
+        self.comment_stats = {}
+        # SF comments of tickets fetched ahead of their issues, by ticket id
+        self.prefetched_comments = {}
+
+        # Pairs whose fingerprint did not change since their last sync
+        # without writes are skipped
+        self.skip_unchanged = config.get('skip_unchanged_issues', True)
+        self.stopping = threading.Event()
 
         self.priority_map = config['jira_priority_map']
         self.fallback_priority = config['jira_fallback_priority']
@@ -43,34 +181,537 @@ class Bridge(object):
         self.assignee_sf_name = config['assignee_sf_name']
         self.symantec_assignee_username = config['symantec_assignee_username']
 
+    @property
+    def force_assignee(self):
+        """
+        Set by `sync_assignee` for `sync_status` of the same issue, kept per
+        thread as issues may be synced concurrently
+        """
+        return getattr(self._local, 'force_assignee', False)
+
+    @force_assignee.setter
+    def force_assignee(self, value):
+        self._local.force_assignee = value
+
+    @property
+    def issue_cache(self):
+        """
+        `IssueCache` of the issue synced by the current thread
+        """
+        return getattr(self._local, 'issue_cache', None)
+
+    def stop(self):
+        """
+        Stop syncing after the issues being synced right now, safe to call
+        from signal handlers
+        """
+        self.stopping.set()
+
     def sync_issues(self):
-        LOG.debug('Querying JIRA: %s', self.issue_jql)
-        for issue in self.jira_client.search_issues(self.issue_jql, maxResults=300, fields='assignee,attachment,comment,*navigable'):
+        issues = self.search_issues()
+        self.prepare_cycle(issues)
+
+        try:
+            if self.workers > 1:
+                self._sync_concurrently(issues)
+            else:
+                for issue in issues:
+                    self._sync_issue_safe(issue)
+        except KeyboardInterrupt:
+            LOG.error('Operation canceled by user')
+            self.stop()
+
+        if self.stopping.is_set():
+            # Remaining issues were skipped, the cycle is not finished
+            self.store.flush()
+            return
+
+        self.finish_cycle()
+
+    def search_issues(self):
+        """
+        Find the issues to sync in this cycle.
+
+        Incremental cycles fetch the issues updated in JIRA since the last
+        finished cycle, plus those whose SF tickets or ticket comments
+        changed meanwhile and those which failed to sync in it.
+        """
+        now = time.time()
+        full = True
+
+        watermark = self.store.get('sync_watermark')
+        last_full_sync = self.store.get('full_sync_time') or 0
+        if (self.incremental_sync and watermark and
+                now - last_full_sync < self.full_sync_interval):
+            full = False
+
+        self._cycle.update(start=now, full=full)
+
+        if full:
+            issues = self._search_owned(self.issue_jql)
+        else:
+            since = watermark - self.sync_skew
+            issues = self._search_owned(self.updated_since_jql(self.issue_jql, now - since))
+            try:
+                keys = self.changed_issue_keys(since)
+            except Exception:
+                LOG.exception('Failed to query SF changes, syncing all issues')
+                self._cycle['full'] = full = True
+                issues = self._search_owned(self.issue_jql)
+            else:
+                keys.update(self.store.get('retry_issue_keys') or ())
+                keys.difference_update(issue.key for issue in issues)
+                issues.extend(self.issues_by_key(set(key for key in keys if self.owns(key))))
+
+        LOG.debug('Found %s issues to sync (%s)', len(issues), 'full' if full else 'incremental')
+        return issues
+
+    def owns(self, key):
+        """
+        Whether the issue ``key`` belongs to the shard of this bridge
+        """
+        return self.shard is None or shard_of(key, self.shard[1]) == self.shard[0]
+
+    @property
+    def last_cycle(self):
+        """
+        Issues found, failed and skipped by the last cycle
+        """
+        with self._cycle_lock:
+            return dict((key, self._cycle.get(key, 0)) for key in ('issues', 'failed', 'skipped'))
+
+    def _search(self, jql, fields=ISSUE_FIELDS):
+        """
+        Search issues following the pagination of the results
+        """
+        LOG.debug('Querying JIRA: %s', jql)
+        issues = []
+        while True:
+            page = self.jira_client.search_issues(jql, startAt=len(issues),
+                                                  maxResults=self.search_page_size,
+                                                  validate_query=False,
+                                                  fields=fields)
+            issues.extend(page)
+            if not page:
+                return issues
+
+            # JIRA may cap maxResults below the page size asked for, so a
+            # short page only ends the search when the total is unknown
+            total = getattr(page, 'total', None)
+            if total is None:
+                if len(page) < self.search_page_size:
+                    return issues
+            elif len(issues) >= total:
+                return issues
+
+    def _search_owned(self, jql):
+        """
+        Search the issues of the shard of this bridge, in the order of the
+        results of ``jql``
+        """
+        if self.shard is None:
+            return self._search(jql)
+
+        # JQL can't select a shard, so only the keys of all issues are
+        # searched and the issues of this shard are fetched by key
+        keys = [issue.key for issue in self._search(jql, fields='key')
+                if self.owns(issue.key)]
+        issues = dict((issue.key, issue) for issue in self.issues_by_key(keys))
+        return [issues[key] for key in keys if key in issues]
+
+    def issues_by_key(self, keys):
+        """
+        Fetch the issues with the given keys which still match the JQL
+        """
+        keys = sorted(keys)
+        jql = ORDER_BY.sub('', self.issue_jql)
+        issues = []
+        for i in range(0, len(keys), KEYS_PER_SEARCH):
+            issues.extend(self._search('({}) AND key in ({})'.format(
+                jql, ', '.join(keys[i:i + KEYS_PER_SEARCH]))))
+        return issues
+
+    def changed_issue_keys(self, since):
+        """
+        Keys of the issues whose SF tickets, or comments of the tickets,
+        changed after ``since`` (Unix time)
+        """
+        keys = set()
+        ticket_ids = set()
+        for ticket in self.sfdc_client.modified_tickets(since):
+            if ticket.get('External_id__c'):
+                keys.add(ticket['External_id__c'])
+            else:
+                ticket_ids.add(ticket['Id'][:15])
+        for comment in self.sfdc_client.modified_ticket_comments(since):
+            if comment.get('related_id__c'):
+                ticket_ids.add(comment['related_id__c'][:15])
+
+        if ticket_ids:
+            for key, ticket_id in self.store.hgetall('issue_to_ticket_id').items():
+                if ticket_id and ticket_id[:15] in ticket_ids:
+                    keys.add(key)
+
+        # External ids are free text in SF, keep them out of the JQL
+        keys = set(key for key in keys if ISSUE_KEY.match(key))
+        LOG.debug('%s issues changed in SF', len(keys))
+        return keys
+
+    @staticmethod
+    def updated_since_jql(jql, seconds):
+        """
+        Restrict ``jql`` to issues updated in the last ``seconds``.
+
+        Relative dates are evaluated by JIRA, so the user time zone of the
+        bot does not matter.
+        """
+        order_by = ORDER_BY.search(jql)
+        order_by = order_by.group(0) if order_by else ''
+        jql = ORDER_BY.sub('', jql)
+        minutes = int(seconds // 60) + 1
+        return '({}) AND updated >= -{}m{}'.format(jql, minutes, order_by)
 
+    def prepare_cycle(self, issues, prefetch=True):
+        """
+        Reset per-cycle caches and prefetch data for the found issues,
+        unless the caller does so itself
+        """
+        self._cycle.update(issues=len(issues), failed=0, failed_keys=[], skipped=0,
+                           issue_fetches=0, issue_fetches_avoided=0)
+        self.ticket_cache.clear()
+        self.comment_stats = {}
+        self.prefetched_comments = {}
+        if prefetch:
+            self.prefetch_tickets(issues)
+
+    def finish_cycle(self):
+        if self.incremental_sync and 'start' in self._cycle:
+            # The watermark moves on past the issues which synced, those
+            # which failed are fetched by key until they sync
+            failed_keys = sorted(self._cycle.get('failed_keys') or ())
+            if failed_keys:
+                LOG.warning('%s issues failed to sync, retrying them in the next cycle',
+                            len(failed_keys))
+            self.store.set('retry_issue_keys', failed_keys)
+            self.store.set('sync_watermark', self._cycle['start'])
+            if self._cycle['full']:
+                self.store.set('full_sync_time', self._cycle['start'])
+
+        self.store.flush()
+        self.export_cycle_metrics()
+        LOG.debug('Sync finished, ticket cache hits: %s, misses: %s',
+                  self.ticket_cache.hits, self.ticket_cache.misses)
+        LOG.debug('JIRA issues refetched: %s, refetches avoided: %s',
+                  self._cycle.get('issue_fetches'), self._cycle.get('issue_fetches_avoided'))
+        LOG.debug('Unchanged issues skipped: %s', self._cycle.get('skipped'))
+
+    def export_cycle_metrics(self):
+        cycle = self._cycle
+        elapsed = time.time() - cycle['start'] if 'start' in cycle else None
+        metrics = self.metrics
+
+        if elapsed:
+            metrics.gauge('cycle_seconds', elapsed)
+            metrics.gauge('cycle_issues_per_second', cycle.get('issues', 0) / elapsed)
+        metrics.gauge('cycle_issues', cycle.get('issues', 0))
+        metrics.gauge('cycle_issues_failed', cycle.get('failed', 0))
+        metrics.gauge('cycle_issues_skipped', cycle.get('skipped', 0))
+        metrics.gauge('cache_hits', self.ticket_cache.hits, cache='ticket')
+        metrics.gauge('cache_misses', self.ticket_cache.misses, cache='ticket')
+        metrics.gauge('cache_hits', cycle.get('issue_fetches_avoided', 0), cache='issue')
+        metrics.gauge('cache_misses', cycle.get('issue_fetches', 0), cache='issue')
+
+    def prefetch_tickets(self, issues):
+        """
+        Load SF tickets of all given issues into the ticket cache, ids
+        which do not exist in SF are cached as missing
+        """
+        ids = self.ticket_ids(issues)
+        try:
+            found = self.cache_tickets(ids, self.sfdc_client.tickets(ids))
+        except Exception:
+            LOG.exception('Failed to prefetch SF tickets')
+            return
+
+        if self.skip_unchanged:
             try:
-                self.sync_issue(issue)
-            except KeyboardInterrupt:
-                LOG.error('Operation canceled by user')
-                return
-            except:
-                LOG.exception('Failed to sync issue: %s', issue.key)
+                self.comment_stats = self.sfdc_client.ticket_comment_stats(
+                    ticket['Id'] for ticket in found.values())
+            except Exception:
+                LOG.exception('Failed to prefetch SF comment stats')
+
+    def linked_ticket_id(self, issue):
+        return (self.store.hget('issue_to_ticket_id', issue.key) or
+                getattr(issue.fields, self.jira_reference_field))
+
+    def ticket_ids(self, issues):
+        return set(filter(None, (self.linked_ticket_id(issue) for issue in issues)))
+
+    def cache_tickets(self, ids, tickets):
+        """
+        Put prefetched ``tickets`` into the ticket cache, ``ids`` without
+        a ticket are cached as missing
+
+        :return: dict of the found tickets by their 15 and 18 character ids
+        """
+        found = {}
+        for ticket in tickets:
+            # Queries return 18 character ids, match 15 character ones too
+            found[ticket['Id']] = found[ticket['Id'][:15]] = ticket
+
+        for ticket_id in ids:
+            self.ticket_cache.put(ticket_id, found.get(ticket_id, False))
+        LOG.debug('Prefetched SF tickets for %s issues', len(ids))
+        return found
+
+    def ticket_comments(self, ticket_id):
+        """
+        SF comments of a ticket, comments prefetched for it are used once
+        """
+        comments = self.prefetched_comments.pop(ticket_id, None)
+        if comments is None:
+            comments = self.sfdc_client.ticket_comments(ticket_id)
+        return comments
+
+    def get_ticket(self, ticket_id):
+        ticket = self.ticket_cache.get(ticket_id)
+        if ticket is None:
+            ticket = self.sfdc_client.ticket(ticket_id)
+            self.ticket_cache.put(ticket_id, ticket)
+        return ticket
+
+    def update_ticket(self, ticket, data):
+        """
+        Update fields of ``ticket``, the dict is updated right away so
+        later steps see the new values.
+
+        While an issue is synced the update is staged and all updates of
+        the same ticket are sent as one PATCH when the issue is done.
+        """
+        ticket.update(data)
+        self._count_write()
+
+        staged = getattr(self._local, 'ticket_updates', None)
+        if staged is None:
+            self.ticket_cache.invalidate(ticket['Id'])
+            return self.sfdc_client.update_ticket(ticket['Id'], data)
+
+        staged.setdefault(ticket['Id'], {}).update(data)
+
+    def set_synced_state(self, key, value):
+        """
+        Store state describing the SF ticket, after the staged ticket
+        updates it depends on were sent
+        """
+        state = getattr(self._local, 'state_updates', None)
+        if state is None:
+            self.store.set(key, value)
+        else:
+            state.append((key, value))
+
+    def flush_ticket_updates(self):
+        """
+        Send the SF writes queued while syncing the current issue, with
+        its staged ticket updates, then store the state which depends on
+        the ticket updates
+        """
+        updates, self._local.ticket_updates = self._local.ticket_updates, OrderedDict()
+        state, self._local.state_updates = self._local.state_updates, []
+        batch = self._local.batch
+
+        items = []
+        for ticket_id, data in updates.items():
+            self.ticket_cache.invalidate(ticket_id)
+            items.append(batch.update_ticket(ticket_id, data))
+        self._flush_batch(batch)
+
+        for item in items:
+            if not item.success:
+                raise WriteError('Failed to update SF ticket {}: {}'.format(item.id, item.errors))
 
-        LOG.debug('Sync finished')
+        for key, value in state:
+            self.store.set(key, value)
+
+    @contextmanager
+    def write_batch(self, defer=True):
+        """
+        Batch of SF record writes. While an issue is synced, all its writes
+        are sent together when the issue is done, otherwise, or when not
+        ``defer``, when the block exits.
+        """
+        batch = getattr(self._local, 'batch', None)
+        if batch is not None and defer:
+            yield batch
+            return
+
+        batch = self.sfdc_client.batch()
+        try:
+            yield batch
+        finally:
+            self._flush_batch(batch)
+
+    def _flush_batch(self, batch):
+        if len(batch):
+            self._count_write()
+
+        def save_seen(items):
+            # A crash later in the issue must not copy these comments again
+            if any(item.success and item.on_success for item in items):
+                self.store.flush()
+
+        batch.flush(each_chunk=save_seen)
+
+    def _mark_seen(self, comment_id):
+        """
+        ``on_success`` of a batched comment write, marks the JIRA comment
+        ``comment_id`` as seen
+        """
+        return lambda item: self.store.sadd('seen_comments_id', comment_id)
+
+    def _count_write(self):
+        """
+        Count a write to JIRA or SF made while syncing the current issue
+        """
+        self._local.writes = getattr(self._local, 'writes', 0) + 1
+
+    def fingerprint(self, issue):
+        """
+        Digest of the state of an issue and its SF ticket as found by this
+        cycle, None if the ticket or its comment stats were not prefetched
+        """
+        ticket_id = self.linked_ticket_id(issue)
+        if not ticket_id or ticket_id not in self.ticket_cache:
+            return
+
+        ticket = self.ticket_cache.peek(ticket_id)
+        stats = self.comment_stats.get(ticket['Id'][:15]) if ticket else None
+        if stats is None:
+            return
+
+        fields = issue.fields
+        state = [
+            fields.updated,
+            fields.status.name,
+            getattr(fields.assignee, 'name', None),
+            getattr(fields.priority, 'name', None),
+            len(fields.comment.comments),
+            ticket['Id'],
+            ticket['LastModifiedDate'],
+            list(stats),
+        ]
+        return hashlib.sha1(json.dumps(state).encode('utf-8')).hexdigest()
+
+    def _sync_concurrently(self, issues):
+        LOG.debug('Syncing %s issues with %s workers', len(issues), self.workers)
+        # The pool lives as long as the bridge, so the per-thread clients
+        # of its workers and their connections are reused by every cycle
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+        try:
+            self._pool.map_async(self._sync_issue_safe, issues,
+                                 chunksize=1).get(POOL_WAIT_TIMEOUT)
+        except KeyboardInterrupt:
+            # Workers finish the issues they are syncing but take no new ones
+            pool, self._pool = self._pool, None
+            pool.terminate()
+            pool.join()
+            raise
+
+    def close(self):
+        """
+        Stop the worker threads once the bridge is not used any more
+        """
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def _sync_issue_safe(self, issue):
+        if self.stopping.is_set():
+            return
+
+        try:
+            self.sync_issue(issue)
+        except KeyboardInterrupt:
+            raise
+        except:
+            LOG.exception('Failed to sync issue: %s', issue.key)
+            self.metrics.increment('issues_failed_total')
+            with self._cycle_lock:
+                self._cycle['failed'] = self._cycle.get('failed', 0) + 1
+                self._cycle.setdefault('failed_keys', []).append(issue.key)
 
     def sync_issue(self, issue):
         LOG.debug('Syncing JIRA issue: %s', issue.key)
-        ticket = self.ensure_ticket(issue)
+        start = time.time()
+        self._local.phase_times = []
+        # The issue found by the search is as fresh as a refetched one
+        cache = self._local.issue_cache = IssueCache()
+        cache.put(issue.key, issue)
+        self._local.writes = 0
+        self._local.batch = self.sfdc_client.batch()
+        self._local.ticket_updates = OrderedDict()
+        self._local.state_updates = []
+        self._local.issue_changes = IssueChanges()
+        try:
+            # All state changes made while syncing one issue are written
+            # to the backend at once when the issue is done
+            with self.store.transaction():
+                fingerprint = self.fingerprint(issue) if self.skip_unchanged else None
+                if fingerprint and self.store.hget('fingerprints', issue.key) == fingerprint:
+                    LOG.debug('Issue %s and its ticket did not change, skipping', issue.key)
+                    with self._cycle_lock:
+                        self._cycle['skipped'] = self._cycle.get('skipped', 0) + 1
+                    return
+
+                try:
+                    self._sync_issue(issue)
+                finally:
+                    try:
+                        self._phase('flush_issue_changes')
+                    finally:
+                        self._phase('flush_ticket_updates')
+
+                # Writes change the fingerprint, the next cycle syncs the
+                # pair once more to record the new one
+                if fingerprint and not self._local.writes:
+                    self.store.hset('fingerprints', issue.key, fingerprint)
+        finally:
+            self._local.issue_cache = self._local.batch = None
+            self._local.ticket_updates = self._local.state_updates = None
+            self._local.issue_changes = None
+            with self._cycle_lock:
+                self._cycle['issue_fetches'] = self._cycle.get('issue_fetches', 0) + cache.fetches
+                self._cycle['issue_fetches_avoided'] = (self._cycle.get('issue_fetches_avoided', 0) +
+                                                        cache.avoided)
+
+            elapsed = time.time() - start
+            self.metrics.observe('issue_sync_seconds', elapsed)
+            phases, self._local.phase_times = self._local.phase_times, None
+            if self.slow_issue_threshold and elapsed >= self.slow_issue_threshold:
+                LOG.warning('Slow issue %s took %.1fs: %s', issue.key, elapsed,
+                            ', '.join('{} {:.2f}s'.format(name, seconds)
+                                      for name, seconds in phases))
+
+    def _sync_issue(self, issue):
+        ticket = self._phase('ensure_ticket', issue)
         if not ticket:
             return
 
-        self.sync_priority(issue, ticket)
-        self.sync_jira_reference(issue, ticket)
-        self.sync_assignee(issue, ticket)
-        self.sync_comments_from_jira(issue, ticket)
-        self.sync_comments_to_jira(issue, ticket)
-        self.sync_subject_description(issue, ticket)
+        for phase in SYNC_PHASES:
+            self._phase(phase, issue, ticket)
 
-        self.sync_status(issue, ticket)
+    def _phase(self, name, *args):
+        """
+        Run the bridge method ``name`` and time it
+        """
+        with self.metrics.timer('sync_phase_seconds', phase=name) as timer:
+            try:
+                return getattr(self, name)(*args)
+            finally:
+                phases = getattr(self._local, 'phase_times', None)
+                if phases is not None:
+                    phases.append((name, time.time() - timer.start))
 
     def ensure_ticket(self, issue):
         ticket = None
@@ -79,7 +720,7 @@ class Bridge(object):
             ticket_id = getattr(issue.fields, self.jira_reference_field)
 
         if ticket_id:
-            ticket = self.sfdc_client.ticket(ticket_id)
+            ticket = self.get_ticket(ticket_id)
             if not ticket:
                 LOG.debug('Jira-issue has a link to SF-ticket, but '
                           'SF does not have a ticket with ID: %s', ticket_id)
@@ -90,7 +731,7 @@ class Bridge(object):
             ticket_id = self.create_ticket(issue)
 
         elif ticket['Status__c'] == self.sf_ticket_close_status and not ticket['Closed__c']:
-            self.sfdc_client.update_ticket(ticket['Id'], data={'Closed__c': True})
+            self.update_ticket(ticket, data={'Closed__c': True})
 
         elif ticket['Status__c'] == self.sf_ticket_close_status:
             if not self.is_issue_eligible(issue):
@@ -100,7 +741,7 @@ class Bridge(object):
             ticket_id = self.create_followup_ticket(issue, ticket_id)
 
         self.store.hset('issue_to_ticket_id', issue.key, ticket_id)
-        return self.sfdc_client.ticket(ticket_id)
+        return self.get_ticket(ticket_id)
 
     def is_issue_eligible(self, issue):
         """
@@ -142,13 +783,13 @@ class Bridge(object):
         result = self.sfdc_client.create_ticket(data)
         LOG.debug('Successful create new ticket %s,  for old issue %s', result['id'], issue.key)
 
-        ticket = self.sfdc_client.ticket(result['id'])
+        ticket = self.get_ticket(result['id'])
         # description = self._description_followup_ticket(getattr(issue.fields, 'description', ''), ticket)
         # data = {
         #         'Description__c': description,
         #         }
         # self.sfdc_client.update_ticket(ticket['Id'], data)
-        issue.update(fields={self.jira_sf_case_number_field: ticket['CaseNumber__c']})
+        self.update_issue(issue, {self.jira_sf_case_number_field: ticket['CaseNumber__c']})
 
         data = {
                 'Comment__c': comment,
@@ -180,15 +821,20 @@ class Bridge(object):
         return description
 
     def _change_sf_comments_id(self, issue, new_ticket_id):
-        for comment in issue.fields.comment.comments:
-            comment_from_sf = self.sfdc_client.ticket_comment(comment.id)
-            if comment_from_sf['totalSize'] != 0:
-                data = {
-                    'related_id__c': new_ticket_id,
-                }
+        comments = issue.fields.comment.comments
+        comments_from_sf = self.sfdc_client.ticket_comments_by_external_id(
+            comment.id for comment in comments)
+
+        with self.write_batch() as batch:
+            for comment in comments:
+                comment_from_sf = comments_from_sf.get(comment.id)
+                if comment_from_sf:
+                    data = {
+                        'related_id__c': new_ticket_id,
+                    }
 
-                self.sfdc_client.update_comment(comment_from_sf['records'][0]['Id'], data)
-                self.store.sadd('seen_comments_id', comment.id)
+                    batch.update_comment(comment_from_sf['Id'], data,
+                                         on_success=self._mark_seen(comment.id))
 
     def create_ticket(self, issue):
         LOG.info('Trying to create ticket for issue %s', issue.key)
@@ -206,15 +852,15 @@ class Bridge(object):
         }
 
         result = self.sfdc_client.create_ticket(data)
-        ticket = self.sfdc_client.ticket(result['id'])
+        ticket = self.get_ticket(result['id'])
         case_id = ticket['CaseNumber__c']
         description = self.sf_initial_comment_format.render(issue=issue,
                                                         jira_url=self.jira_url)
         LOG.info('Successful create ticket %s,  for issue %s', result['id'], issue.key)
-        issue.update(fields={self.jira_description_field: description,
-                             self.jira_summary_field: summary,
-                             self.jira_sf_case_number_field: case_id
-                             })
+        self.update_issue(issue, {self.jira_description_field: description,
+                                  self.jira_summary_field: summary,
+                                  self.jira_sf_case_number_field: case_id
+                                  })
 
         self.store.set('last_seen_jira_status:{}'.format(issue.key), issue.fields.status.name)
         self.store.set('last_seen_sf_status:{}'.format(ticket['Id']), self.jira_possible_status['New'])
@@ -229,14 +875,15 @@ class Bridge(object):
         data = {
             'Priority__c': sfdc_priority
         }
-        self.sfdc_client.update_ticket(ticket['Id'], data)
+        self.update_ticket(ticket, data)
 
     def sync_jira_reference(self, issue, ticket):
         if getattr(issue.fields, self.jira_reference_field) != ticket['Id']:
             LOG.info('Updating JIRA reference for ticket: %s', ticket['Id'])
-            issue.update(fields={self.jira_reference_field: ticket['Id']})
+            self.update_issue(issue, {self.jira_reference_field: ticket['Id']})
 
     def sync_comments_from_jira(self, issue, ticket):
+        unseen = []
         for comment in issue.fields.comment.comments:
             if comment.author.name == self.jira_identity:
                 LOG.debug('Skipping my own JIRA comment: %s', comment.id)
@@ -245,54 +892,66 @@ class Bridge(object):
             if self.store.sismember('seen_comments_id', comment.id):
                 LOG.debug('Skipping seen JIRA comment: %s', comment.id)
                 continue
-            else:
-                comment_from_sf = self.sfdc_client.ticket_comment(comment.id)
-                if comment_from_sf['totalSize'] != 0:
+
+            unseen.append(comment)
+
+        if not unseen:
+            return
+
+        comments_from_sf = self.sfdc_client.ticket_comments_by_external_id(
+            comment.id for comment in unseen)
+
+        with self.write_batch() as batch:
+            for comment in unseen:
+                if comment.id in comments_from_sf:
                     LOG.debug('Skipping seen SF comment: %s', comment.id)
                     self.store.sadd('seen_comments_id', comment.id)
                     continue
 
-            LOG.info('Copying JIRA (Jira issue %s) comment to SFDC: %s', issue.key, comment.id)
+                LOG.info('Copying JIRA (Jira issue %s) comment to SFDC: %s', issue.key, comment.id)
 
-            comment_body = self.sf_comment_format.render(comment=comment)
+                comment_body = self.sf_comment_format.render(comment=comment)
 
-            data = {
-                'Comment__c': comment_body,
-                'related_id__c': ticket['Id'],
-                'external_id__c': comment.id
-            }
+                data = {
+                    'Comment__c': comment_body,
+                    'related_id__c': ticket['Id'],
+                    'external_id__c': comment.id
+                }
 
-            self.sfdc_client.create_ticket_comment(data)
-            self.store.sadd('seen_comments_id', comment.id)
+                batch.create_ticket_comment(data, on_success=self._mark_seen(comment.id))
 
     def sync_comments_to_jira(self, issue, ticket):
-        comments = self.sfdc_client.ticket_comments(ticket['Id'])
-        for comment in comments:
-            if self.store.sismember('seen_comments_id', comment['external_id__c']):
-                LOG.debug('Skipping seen SalesForce comment: %s', comment['Id'])
-                continue
-            if comment['external_id__c']:
-                LOG.debug('Skipping seen SalesForce comment: %s '
-                          '(comment has JIRA comment-id %s )',
-                          comment['Id'], comment['external_id__c'])
-                continue
+        comments = self.ticket_comments(ticket['Id'])
+        # JIRA comments are already created at this point, so the SF side
+        # is updated right away, even if a later comment or a later step of
+        # the issue fails, or the next cycle would copy them again
+        with self.write_batch(defer=False) as batch:
+            for comment in comments:
+                if self.store.sismember('seen_comments_id', comment['external_id__c']):
+                    LOG.debug('Skipping seen SalesForce comment: %s', comment['Id'])
+                    continue
+                if comment['external_id__c']:
+                    LOG.debug('Skipping seen SalesForce comment: %s '
+                              '(comment has JIRA comment-id %s )',
+                              comment['Id'], comment['external_id__c'])
+                    continue
 
-            LOG.info(
-                'Copying SalesForce comment %s ,  to JIRA issue %s',
-                comment['Id'], issue.key)
+                LOG.info(
+                    'Copying SalesForce comment %s ,  to JIRA issue %s',
+                    comment['Id'], issue.key)
 
-            comment_body = self.jira_comment_format.render(comment=comment['Comment__c'],
-                                                           created_at=comment['CreatedDate'],
-                                                           created_by=comment['CreatedBy']['Name'])
+                comment_body = self.jira_comment_format.render(comment=comment['Comment__c'],
+                                                               created_at=comment['CreatedDate'],
+                                                               created_by=comment['CreatedBy']['Name'])
 
-            issue_comment = self.jira_client.add_comment(issue, comment_body)
-            data = {'external_id__c': issue_comment.id}
-            LOG.info(
-                'Update SalesForce comment %s, with JIRA comment-id: %s',
-                comment['Id'], issue_comment.id)
+                issue_comment = self.add_comment(issue, comment_body)
+                data = {'external_id__c': issue_comment.id}
+                LOG.info(
+                    'Update SalesForce comment %s, with JIRA comment-id: %s',
+                    comment['Id'], issue_comment.id)
 
-            self.sfdc_client.update_comment(comment['Id'], data)
-            self.store.sadd('seen_comments_id', issue_comment.id)
+                batch.update_comment(comment['Id'], data,
+                                     on_success=self._mark_seen(issue_comment.id))
 
     def sync_subject_description(self, issue, ticket):
         if (issue.fields.description != ticket['Description__c'] or
@@ -307,16 +966,16 @@ class Bridge(object):
                 LOG.info(
                     'Update SalesForce subject, description. Ticket %s',
                     ticket['Id'])
-                self.sfdc_client.update_ticket(
-                    ticket['Id'],
+                self.update_ticket(
+                    ticket,
                     {'Description__c': issue.fields.description,
                      'Subject__c': issue.fields.summary})
             else:
                 LOG.info(
                     'Update Jira summary, description. Jira ticket %s',
                     issue.key)
-                issue.update(fields={'description': ticket['Description__c'],
-                                     'summary': ticket['Subject__c']})
+                self.update_issue(issue, {'description': ticket['Description__c'],
+                                          'summary': ticket['Subject__c']})
 
     def map_status_jira_sf(self, issue_status_name):
         return self.jira_possible_status.get(issue_status_name, 'None')
@@ -338,12 +997,12 @@ class Bridge(object):
         if jira_status_changed or sf_status_changed or self.force_assignee:
             new_issue_status, new_ticket_status = self.new_process_sync_status(
                 issue, ticket, jira_status_changed, sf_status_changed)
-            self.store.set('last_seen_jira_status:{}'.format(issue.key), new_issue_status)
-            self.store.set('last_seen_sf_status:{}'.format(ticket['Id']), new_ticket_status)
+            self.set_synced_state('last_seen_jira_status:{}'.format(issue.key), new_issue_status)
+            self.set_synced_state('last_seen_sf_status:{}'.format(ticket['Id']), new_ticket_status)
 
     def new_process_sync_status(self, issue, ticket, jira_status_changed, sf_status_changed):
         owned = issue.fields.assignee.name == self.jira_identity
-        real_owner = self.refresh_issue(issue).fields.assignee.name
+        real_owner = self.refresh_issue(issue, ['assignee']).fields.assignee.name
         status_name_issue = issue.fields.status.name
 
         if self.force_assignee and not sf_status_changed and not jira_status_changed:
@@ -352,7 +1011,7 @@ class Bridge(object):
             data = {
                     'Status__c': new_sf_status
                 }
-            self.sfdc_client.update_ticket(ticket['Id'], data)
+            self.update_ticket(ticket, data)
             LOG.debug('Updated ticket status: %s', ticket['Id'])
             return status_name_issue, new_sf_status
 
@@ -376,31 +1035,27 @@ class Bridge(object):
 
             # If we (L1/L2) try to move case to solve-status, when it has Symantec-asignee
             if (real_owner != self.jira_identity) and (ticket['Status__c'] in self.sf_ticket_solve_status or ticket['Status__c'] == 'Pending'):
-                self.jira_client.assign_issue(issue, self.jira_identity)
+                self.assign_issue(issue, self.jira_identity)
                 #issue = self.refresh_issue(issue)
 
             if not workflow:
                 LOG.info('Not found schema. Current Jira status: %s,'
                          ' SF status: %s', status_name_issue, ticket['Status__c'])
-            transitions = self.jira_client.transitions(self.jira_client.issue(issue.key))
-            available_transitions = dict((t['name'], t['id']) for t in transitions)
-            LOG.info('For current Jira-state %s, possible statuses is: %s, List of moving statuses %s ',
-                     status_name_issue, available_transitions, workflow)
+            LOG.info('For current Jira-state %s, list of moving statuses %s ',
+                     status_name_issue, workflow)
 
             if (real_owner != self.jira_identity) and ticket['Status__c'] == 'On Hold':
                 workflow = ['Skip', ]
 
-            for status in workflow:
-                if status == 'Skip':
+            status = status_name_issue
+            for step in workflow:
+                if step == 'Skip':
                     continue
-                LOG.info('Try to move issue to %s status', status)
-                result = self.jira_client.transition_issue(issue, available_transitions[status])
-                LOG.info('Moved issue to %s status', status)
-                transitions = self.jira_client.transitions(self.jira_client.issue(issue.key))
-                available_transitions = dict((t['name'], t['id']) for t in transitions)
-                LOG.info('Now, possible statuses: %s ', available_transitions)
-
-            issue = self.refresh_issue(issue)
+                LOG.info('Try to move issue to %s status', step)
+                status = self.transition_issue(issue, status, step)
+                LOG.info('Moved issue to %s status', step)
+
+            issue = self.refresh_issue(issue, ['assignee', 'status'])
             self._revert_assignee(issue, real_owner)
             return issue.fields.status.name, ticket['Status__c']
 
@@ -437,7 +1092,7 @@ class Bridge(object):
                     'Status__c': new_sf_status
                 }
 
-            self.sfdc_client.update_ticket(ticket['Id'], data)
+            self.update_ticket(ticket, data)
             LOG.debug('Updated ticket status: %s', ticket['Id'])
             return status_name_issue, new_sf_status
 
@@ -456,8 +1111,8 @@ class Bridge(object):
 
         elif not issue.fields.assignee:
             LOG.info('Assigning previously unassigned JIRA issue to bot')
-            self.jira_client.assign_issue(issue, self.jira_identity)
-            issue = self.refresh_issue(issue)
+            self.assign_issue(issue, self.jira_identity)
+            issue = self.refresh_issue(issue, ['assignee'])
 
         ticket_assignee_name = current_ticket_assignee_name = ticket['Assignee__c']
         jira_assignee_name = getattr(issue.fields.assignee, 'name', None)
@@ -474,28 +1129,177 @@ class Bridge(object):
                 ticket_assignee_name == self.assignee_sf_name[1]):
                 self.force_assignee = True
 
-            self.sfdc_client.update_ticket(ticket['Id'], data)
+            self.update_ticket(ticket, data)
 
         elif ticket['Assignee__c'] != last_seen_sf_assignee:
             if ticket['Assignee__c'] == self.assignee_sf_name[1]:
                 jira_assignee_name = self.jira_identity
             elif ticket['Assignee__c'] == self.assignee_sf_name[0]:
                 jira_assignee_name = self.symantec_assignee_username
-            self.jira_client.assign_issue(issue, jira_assignee_name)
+            self.assign_issue(issue, jira_assignee_name)
 
         LOG.info('ticket-id %s ; ticket_assignee_name %s', ticket['Id'], ticket_assignee_name)
         LOG.info('jira-issue %s ; jira_assignee_name %s', issue.key, jira_assignee_name)
         LOG.info('FINISHED ASSIGNEE for ticket-id %s and issue %s', ticket['Id'], issue.key)
 
-        self.store.set('last_seen_jira_assignee:{}'.format(issue.key), jira_assignee_name)
-        self.store.set('last_seen_sf_assignee:{}'.format(ticket['Id']), ticket_assignee_name)
+        self.set_synced_state('last_seen_jira_assignee:{}'.format(issue.key), jira_assignee_name)
+        self.set_synced_state('last_seen_sf_assignee:{}'.format(ticket['Id']), ticket_assignee_name)
+
+    def transition_key(self, issue, status):
+        return (issue.fields.project.key, issue.fields.issuetype.name, status)
+
+    def fetch_transitions(self, issue):
+        """
+        Transitions currently available for ``issue`` from the JIRA API
+
+        :return: dict of transition name to (id, target status name)
+        """
+        transitions = self.jira_client.transitions(issue.key)
+        return dict((t['name'], (t['id'], t.get('to', {}).get('name')))
+                    for t in transitions)
+
+    def transitions(self, issue, status):
+        """
+        Transitions available from ``status`` for issues of the same project
+        and type as ``issue``, from the cache if possible
+        """
+        if status is None:
+            return self.fetch_transitions(issue)
+
+        key = self.transition_key(issue, status)
+        transitions = self.transition_cache.get(key)
+        if transitions is None:
+            transitions = self.fetch_transitions(issue)
+            self.transition_cache.put(key, transitions)
+            LOG.info('Possible statuses for %s: %s', key, sorted(transitions))
+        return transitions
+
+    def transition_issue(self, issue, status, name):
+        """
+        Apply the transition ``name`` to ``issue`` which is in ``status``.
+
+        Cached transitions which are missing or rejected by JIRA are
+        refetched once.
+
+        :return: new status of the issue, None if unknown
+        """
+        # Workflow conditions and validators may depend on staged changes
+        self.flush_issue_changes()
+
+        transition = self.transitions(issue, status).get(name)
+        try:
+            if transition is None:
+                raise KeyError(name)
+            self.jira_client.transition_issue(issue, transition[0])
+            self.issue_written(issue)
+        except (KeyError, JIRAError):
+            if status is None:
+                raise
+
+            LOG.info('Transition %s of %s is not available, refetching transitions',
+                     name, issue.key)
+            self.transition_cache.invalidate(self.transition_key(issue, status))
+            transition = self.fetch_transitions(issue)[name]
+            self.jira_client.transition_issue(issue, transition[0])
+            self.issue_written(issue)
+
+        return transition[1]
+
+    def refresh_issue(self, issue, fields=None):
+        """
+        Refresh issue from the JIRA API, unless none of ``fields`` (or no
+        field if not given) was written since it was last fetched
+        """
+        cache = self.issue_cache
+        if cache:
+            cached = cache.get(issue.key, fields)
+            if cached is not None:
+                return cached
+
+        # The fetched issue has to include the staged changes
+        self.flush_issue_changes()
+        issue = self.jira_client.issue(issue.key, fields='assignee,attachment,comment,*navigable')
+        if cache:
+            cache.fetches += 1
+            cache.put(issue.key, issue)
+        return issue
+
+    def issue_written(self, issue, fields=None):
+        self._count_write()
+        if self.issue_cache:
+            self.issue_cache.written(issue.key, fields)
+
+    def assign_issue(self, issue, assignee):
+        """
+        Assign ``issue``, staged while the issue is synced
+        """
+        changes = getattr(self._local, 'issue_changes', None)
+        if changes is None:
+            self.jira_client.assign_issue(issue, assignee)
+            self.issue_written(issue, ['assignee'])
+            return
+
+        changes.assign(issue, assignee)
+        self._set_staged_field(issue, 'assignee',
+                               StagedUser(assignee) if assignee is not None else None)
+
+    def update_issue(self, issue, fields):
+        """
+        Update ``fields`` of ``issue``, staged while the issue is synced
+        """
+        changes = getattr(self._local, 'issue_changes', None)
+        if changes is None:
+            issue.update(fields=fields)
+            self.issue_written(issue, fields)
+            return
+
+        changes.update(issue, fields)
+        for name, value in fields.items():
+            self._set_staged_field(issue, name, value)
+
+    def _set_staged_field(self, issue, name, value):
+        """
+        Make a staged change visible on ``issue`` and its cached copy
+        """
+        setattr(issue.fields, name, value)
+        cached = self.issue_cache.issues.get(issue.key) if self.issue_cache else None
+        if cached is not None and cached is not issue:
+            setattr(cached.fields, name, value)
 
-    def refresh_issue(self, issue):
+    def flush_issue_changes(self):
         """
-        Refresh issue from the JIRA API
+        Send the staged JIRA changes of the current issue
         """
-        return self.jira_client.issue(issue.key, fields='assignee,attachment,comment,*navigable')
+        changes = getattr(self._local, 'issue_changes', None)
+        if not changes:
+            return
+        self._local.issue_changes = IssueChanges()
+
+        issue = changes.issue
+        try:
+            if changes.fields:
+                issue.update(fields=dict(changes.fields))
+                self.issue_written(issue, changes.fields)
+
+            if changes.assigned:
+                if changes.assignee == changes.original_assignee:
+                    LOG.debug('Assignment of %s cancelled out, not sending it', issue.key)
+                else:
+                    self.jira_client.assign_issue(issue, changes.assignee)
+                    self.issue_written(issue, ['assignee'])
+        except Exception:
+            # The staged synced state describes the changes which failed,
+            # the next cycle has to see the difference again to retry them
+            state = getattr(self._local, 'state_updates', None)
+            if state:
+                del state[:]
+            raise
+
+    def add_comment(self, issue, body):
+        comment = self.jira_client.add_comment(issue, body)
+        self.issue_written(issue, ['comment'])
+        return comment
 
     def _revert_assignee(self, issue, real_owner):
         if real_owner != getattr(issue.fields.assignee, 'name', None):
-            self.jira_client.assign_issue(issue, real_owner)
+            self.assign_issue(issue, real_owner)
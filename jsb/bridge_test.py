@@ -1,6 +1,831 @@
+import itertools
+import logging
+import re
+import threading
+import time
 import unittest
 
+from jira import JIRAError
 from jsb import bridge
+from jsb import salesforce
+from jsb import storage
+from jsb.storage_test import CountingBackend
+
+
+CONFIG = {
+    'jira_url': 'https://jira.example.com',
+    'jira_issue_jql': 'project = TEST',
+    'jira_priority_map': {'Major': 'Sev 3', 'Minor': 'Sev 4'},
+    'jira_fallback_priority': 'Sev 3',
+    'jira_reference_field': 'customfield_1',
+    'jira_sf_case_number_field': 'customfield_2',
+    'jira_solved_statuses': ['Closed', 'Resolved'],
+    'jira_possible_status': {
+        'New': 'New',
+        'Support Investigating': 'Open',
+        'Waiting Reporter': 'Pending',
+        'Waiting Support': 'Open',
+        'Resolved': 'Solved',
+        'Closed': 'Solved',
+    },
+    'sf_ticket_close_status': 'Closed',
+    'sf_ticket_solve_status': ['Solved', 'Closed'],
+    'reference_jira_sf_statuses': {
+        'New': {'Open': ['Start Investigation']},
+        'Support Investigating': {'Pending': ['Wait Reporter'], 'Open': ['Skip']},
+        'Waiting Reporter': {'Pending': ['Skip']},
+    },
+    'jira_resolution_status': {'name': 'Fixed'},
+    'jira_description_field': 'description',
+    'jira_summary_field': 'summary',
+    'sf_ticket_number_search': 'SF case number is (.+?) .',
+    'sf_summary_format': '[{{ issue.key }}] {{ issue.fields.summary }}',
+    'sf_initial_comment_format': '{{ issue.fields.description }}',
+    'sf_followup_comment_format': 'Reopened {{ issue.key }}',
+    'sf_comment_format': '{{ comment.body }}',
+    'jira_comment_format': '{{ created_by }}: {{ comment }}',
+    'sf_signature_delimeter': '---',
+    'assignee_sf_name': ['Symantec', 'JiraBot'],
+    'symantec_assignee_username': 'symantec',
+}
+
+BOT = 'bot'
+
+# Transition name to (id, target status) for every status
+WORKFLOW = {
+    'New': {'Start Investigation': ('11', 'Support Investigating')},
+    'Support Investigating': {'Wait Reporter': ('21', 'Waiting Reporter'),
+                              'Resolve': ('31', 'Resolved')},
+    'Waiting Reporter': {'Start Investigation': ('11', 'Support Investigating')},
+}
+
+
+class Obj(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeIssue(object):
+    def __init__(self, jira, key, status, assignee=BOT, comments=(), **fields):
+        self.jira = jira
+        self.key = key
+        self.fields = Obj(
+            status=Obj(name=status),
+            project=Obj(key=key.split('-')[0]),
+            issuetype=Obj(name='Bug'),
+            assignee=Obj(name=assignee) if assignee else None,
+            priority=Obj(name='Major'),
+            reporter=Obj(displayName='Reporter'),
+            creator=Obj(displayName='Creator'),
+            created='2016-01-01T00:00:00.000+0000',
+            updated='2016-01-01T00:00:00.000+0000',
+            summary='Summary',
+            description='Description',
+            comment=Obj(comments=list(comments)),
+            customfield_1=None,
+            customfield_2=None,
+        )
+        self.fields.__dict__.update(fields)
+
+    def update(self, fields):
+        self.jira.calls.append(('update', self.key))
+        for name, value in fields.items():
+            setattr(self.fields, name, value)
+
+
+class FakeJira(object):
+    def __init__(self):
+        self.issues = {}
+        self.calls = []
+        self.ids = itertools.count(1000)
+
+    def add_issue(self, key, status, **kwargs):
+        issue = FakeIssue(self, key, status, **kwargs)
+        self.issues[key] = issue
+        return issue
+
+    def current_user(self):
+        return BOT
+
+    def search_issues(self, jql, startAt=0, maxResults=50, validate_query=True, fields=None):
+        self.calls.append(('search_issues', jql, fields))
+        issues = list(self.issues.values())
+        keys = re.search(r'key in \((.*?)\)', jql)
+        if keys:
+            issues = [issue for issue in issues if issue.key in keys.group(1).split(', ')]
+        return issues[startAt:startAt + maxResults]
+
+    def issue(self, key, fields=None):
+        self.calls.append(('issue', key))
+        return self.issues[key]
+
+    def assign_issue(self, issue, assignee):
+        self.calls.append(('assign_issue', issue.key, assignee))
+        self.issues[issue.key].fields.assignee = Obj(name=assignee)
+
+    def transitions(self, issue):
+        issue = self.issues[getattr(issue, 'key', issue)]
+        self.calls.append(('transitions', issue.key))
+        return [{'id': id, 'name': name, 'to': {'name': to}}
+                for name, (id, to) in WORKFLOW.get(issue.fields.status.name, {}).items()]
+
+    def transition_issue(self, issue, transition):
+        self.calls.append(('transition_issue', issue.key, transition))
+        issue = self.issues[issue.key]
+        for id, to in WORKFLOW.get(issue.fields.status.name, {}).values():
+            if id == transition:
+                issue.fields.status = Obj(name=to)
+                return
+        raise JIRAError(400, 'It seems that you have tried to perform a workflow '
+                             'operation that is not valid')
+
+    def add_comment(self, issue, body):
+        self.calls.append(('add_comment', issue.key))
+        comment = Obj(id=str(next(self.ids)), body=body,
+                      author=Obj(name=BOT, displayName='Bot'),
+                      created='2016-01-01T00:00:00.000+0000')
+        self.issues[issue.key].fields.comment.comments.append(comment)
+        return comment
+
+
+class FakeSalesforce(object):
+    def __init__(self):
+        self.ticket_data = {}
+        self.comments = {}
+        self.calls = []
+        self.ids = itertools.count(1)
+        # Records returned by the change feed queries
+        self.modified = {'tickets': [], 'comments': []}
+
+    def add_ticket(self, id, **fields):
+        ticket = {
+            'Id': id,
+            'Status__c': 'Open',
+            'Closed__c': False,
+            'Priority__c': 'Sev 3',
+            'Assignee__c': 'JiraBot',
+            'Subject__c': 'Summary',
+            'Description__c': 'Description',
+            'CaseNumber__c': '0001',
+            'LastModifiedDate': '2016-01-01T00:00:00.000+0000',
+        }
+        ticket.update(fields)
+        self.ticket_data[id] = ticket
+        return ticket
+
+    def ticket(self, id):
+        self.calls.append(('ticket', id))
+        ticket = self.ticket_data.get(id)
+        return dict(ticket) if ticket else False
+
+    def tickets(self, ids):
+        self.calls.append(('tickets', len(ids)))
+        return [dict(self.ticket_data[id]) for id in ids if id in self.ticket_data]
+
+    def create_ticket(self, data):
+        self.calls.append(('create_ticket',))
+        id = 'T{}'.format(next(self.ids))
+        self.add_ticket(id, **data)
+        return {'id': id}
+
+    def update_ticket(self, id, data):
+        self.calls.append(('update_ticket', id))
+        self.ticket_data[id].update(data)
+
+    def create_ticket_comment(self, data):
+        self.calls.append(('create_ticket_comment',))
+        id = 'C{}'.format(next(self.ids))
+        comment = {'Id': id, 'external_id__c': None,
+                   'CreatedDate': '2016-01-01T00:00:00.000+0000',
+                   'CreatedBy': {'Name': 'Agent'}}
+        comment.update(data)
+        self.comments[id] = comment
+        return {'id': id}
+
+    def update_comment(self, id, data):
+        self.calls.append(('update_comment', id))
+        self.comments[id].update(data)
+
+    def batch(self):
+        return salesforce.WriteBatch(self)
+
+    def create_records(self, records):
+        self.calls.append(('create_records', len(records)))
+        results = []
+        for record in records:
+            data = dict(record)
+            del data['attributes']
+            results.append({'id': self.create_ticket_comment(data)['id'],
+                            'success': True, 'errors': []})
+        return results
+
+    def update_records(self, records):
+        self.calls.append(('update_records', len(records)))
+        results = []
+        for record in records:
+            data = dict(record)
+            sobject = data.pop('attributes')['type']
+            if sobject == 'proxyTicket__c':
+                self.update_ticket(data.pop('Id'), data)
+                results.append({'id': record['Id'], 'success': True, 'errors': []})
+                continue
+
+            if record['Id'] not in self.comments:
+                results.append({'id': record['Id'], 'success': False,
+                                'errors': [{'statusCode': 'ENTITY_IS_DELETED'}]})
+                continue
+
+            self.update_comment(record['Id'], data)
+            results.append({'id': record['Id'], 'success': True, 'errors': []})
+        return results
+
+    def ticket_comment_stats(self, ticket_ids):
+        ticket_ids = list(ticket_ids)
+        self.calls.append(('ticket_comment_stats', len(ticket_ids)))
+        result = dict((id, (0, None)) for id in ticket_ids)
+        for comment in list(self.comments.values()):
+            if comment.get('related_id__c') in result:
+                count, last = result[comment['related_id__c']]
+                result[comment['related_id__c']] = (count + 1, max(last, comment['CreatedDate'])
+                                                    if last else comment['CreatedDate'])
+        return result
+
+    def modified_tickets(self, since):
+        self.calls.append(('modified_tickets', since))
+        return self.modified['tickets']
+
+    def modified_ticket_comments(self, since):
+        self.calls.append(('modified_ticket_comments', since))
+        return self.modified['comments']
+
+    def ticket_comments(self, ticket_id):
+        self.calls.append(('ticket_comments', ticket_id))
+        return [dict(c) for c in list(self.comments.values())
+                if c['related_id__c'] == ticket_id]
+
+    def ticket_comments_by_external_id(self, external_ids):
+        external_ids = set(external_ids)
+        self.calls.append(('ticket_comments_by_external_id', len(external_ids)))
+        return dict((c['external_id__c'], dict(c)) for c in list(self.comments.values())
+                    if c['external_id__c'] in external_ids)
+
+    def ticket_comment(self, comment_id):
+        self.calls.append(('ticket_comment', comment_id))
+        records = [dict(c) for c in list(self.comments.values())
+                   if c['external_id__c'] == comment_id]
+        return {'totalSize': len(records), 'records': records}
+
 
 class BridgeTest(unittest.TestCase):
-    pass
+    def setUp(self):
+        self.jira = FakeJira()
+        self.sfdc = FakeSalesforce()
+        self.backend = CountingBackend()
+        self.store = storage.Store(self.backend)
+        self.bridge = bridge.Bridge(self.sfdc, self.jira, self.store, CONFIG)
+
+    def add_comment(self, issue, id, author='user'):
+        comment = Obj(id=id, body='Comment {}'.format(id),
+                      author=Obj(name=author, displayName=author),
+                      created='2016-01-01T00:00:00.000+0000')
+        issue.fields.comment.comments.append(comment)
+        return comment
+
+    def test_sync_cycle_writes_state_once_per_issue(self):
+        for i in range(3):
+            issue = self.jira.add_issue('TEST-{}'.format(i), 'New', assignee=None)
+            for j in range(5):
+                self.add_comment(issue, '{}{}'.format(i, j))
+
+        self.bridge.sync_issues()
+
+        # Every issue creates a ticket, copies 5 comments and records the
+        # last seen statuses and assignees; each issue costs one write of
+        # the state file once SF saved its comments and one for the rest,
+        # plus one final flush that has nothing to do
+        assert len(self.sfdc.ticket_data) == 3
+        assert len(self.store.get('seen_comments_id')) == 15
+        assert self.backend.saves == 6
+
+    def test_steady_state_cycle_does_not_write(self):
+        issue = self.jira.add_issue('TEST-1', 'Support Investigating')
+        self.sfdc.add_ticket('T1')
+        issue.fields.customfield_1 = 'T1'
+
+        # The first cycle updates the ticket, the second one finds nothing
+        # to do and records the fingerprint of the pair
+        self.bridge.sync_issues()
+        self.bridge.sync_issues()
+        saves = self.backend.saves
+        self.bridge.sync_issues()
+
+        assert saves == 2
+        assert self.backend.saves == saves
+
+    def test_unchanged_pair_is_skipped(self):
+        issue = self.jira.add_issue('TEST-1', 'Support Investigating')
+        self.sfdc.add_ticket('T1')
+        issue.fields.customfield_1 = 'T1'
+        self.add_comment(issue, '1')
+
+        self.bridge.sync_issues()
+        self.bridge.sync_issues()
+        assert self.store.hget('fingerprints', 'TEST-1')
+        del self.sfdc.calls[:]
+        del self.jira.calls[:]
+
+        self.bridge.sync_issues()
+        assert [call[0] for call in self.sfdc.calls] == ['tickets', 'ticket_comment_stats']
+        assert [call[0] for call in self.jira.calls] == ['search_issues']
+
+        # A new SF comment changes the fingerprint
+        self.sfdc.create_ticket_comment({'Comment__c': 'SF', 'related_id__c': 'T1'})
+        self.bridge.sync_issues()
+        assert len(issue.fields.comment.comments) == 2
+
+    def test_comments_are_written_in_batches(self):
+        issue = self.jira.add_issue('TEST-1', 'Support Investigating')
+        self.sfdc.add_ticket('T1')
+        issue.fields.customfield_1 = 'T1'
+        for j in range(5):
+            self.add_comment(issue, str(j))
+        for j in range(3):
+            self.sfdc.create_ticket_comment({'Comment__c': 'SF', 'related_id__c': 'T1'})
+        del self.sfdc.calls[:]
+
+        self.bridge.sync_issues()
+
+        # Copied SF comments are updated right away, the ticket update goes
+        # with the other writes of the issue
+        calls = [call for call in self.sfdc.calls if call[0].endswith('_records')]
+        assert calls == [('update_records', 3), ('create_records', 5), ('update_records', 1)]
+        assert len(self.store.get('seen_comments_id')) == 8
+
+    def test_comments_are_seen_once_sf_saved_them(self):
+        issue = self.jira.add_issue('TEST-1', 'Support Investigating')
+        self.sfdc.add_ticket('T1')
+        issue.fields.customfield_1 = 'T1'
+        self.add_comment(issue, '1')
+        self.sfdc.create_ticket_comment({'Comment__c': 'SF', 'related_id__c': 'T1'})
+
+        saves = []
+
+        def fail(records):
+            saves.append(self.backend.saves)
+            raise IOError('SF is down')
+        self.sfdc.update_records = fail
+        saves.append(self.backend.saves)
+
+        self.bridge.sync_issues()
+
+        # Saved before the ticket update of the issue was sent
+        assert saves[-1] == saves[0] + 1
+        assert self.store.get('seen_comments_id') == set(['1'])
+        assert self.bridge.last_cycle['failed'] == 1
+
+    def test_copied_comments_are_marked_before_the_issue_is_done(self):
+        issue = self.jira.add_issue('TEST-1', 'Support Investigating')
+        self.sfdc.add_ticket('T1')
+        issue.fields.customfield_1 = 'T1'
+        comment = self.sfdc.create_ticket_comment({'Comment__c': 'SF', 'related_id__c': 'T1'})
+
+        marked = []
+
+        def sync_subject_description(issue, ticket):
+            external_id = self.sfdc.comments[comment['id']]['external_id__c']
+            marked.append(bool(external_id) and
+                          self.backend.data['seen_comments_id'] == set([external_id]))
+        self.bridge.sync_subject_description = sync_subject_description
+
+        self.bridge.sync_issues()
+
+        assert marked == [True]
+
+    def test_tickets_are_prefetched(self):
+        for i in range(5):
+            issue = self.jira.add_issue('TEST-{}'.format(i), 'Support Investigating')
+            self.sfdc.add_ticket('T{}'.format(i))
+            issue.fields.customfield_1 = 'T{}'.format(i)
+        self.jira.issues['TEST-0'].fields.customfield_1 = 'MISSING'
+        self.jira.issues['TEST-0'].fields.status.name = 'Closed'
+
+        self.bridge.sync_issues()
+
+        assert [call for call in self.sfdc.calls if call[0] in ('ticket', 'tickets')] == [('tickets', 5)]
+
+    def test_updated_ticket_is_not_refetched(self):
+        issue = self.jira.add_issue('TEST-1', 'Support Investigating')
+        self.sfdc.add_ticket('T1', Status__c='Closed', Closed__c=False)
+        issue.fields.customfield_1 = 'T1'
+
+        self.bridge.sync_issues()
+
+        assert [call for call in self.sfdc.calls if call[0] == 'ticket'] == []
+        assert self.sfdc.ticket_data['T1']['Closed__c']
+
+    def test_ticket_updates_are_sent_once_per_issue(self):
+        issue = self.jira.add_issue('TEST-1', 'Support Investigating')
+        self.sfdc.add_ticket('T1', Status__c='Closed', Closed__c=False)
+        issue.fields.customfield_1 = 'T1'
+        issue.fields.summary = 'New summary'
+
+        self.bridge.sync_issues()
+
+        assert [call for call in self.sfdc.calls if call[0] == 'update_ticket'] == [
+            ('update_ticket', 'T1')]
+        ticket = self.sfdc.ticket_data['T1']
+        assert ticket['Closed__c']
+        assert ticket['Subject__c'] == 'New summary'
+
+    def test_failed_ticket_update_keeps_last_seen_state(self):
+        issue = self.add_open_ticket_issue('TEST-1', status='Resolved')
+        # JIRA moved the issue, the ticket status has to follow
+        self.store.set('last_seen_jira_status:TEST-1', 'Support Investigating')
+        self.store.set('last_seen_sf_status:TTEST-1', 'Open')
+
+        def fail(id, data):
+            raise IOError('SF is down')
+        self.sfdc.update_ticket = fail
+
+        self.bridge.sync_issues()
+
+        assert self.store.get('last_seen_jira_status:TEST-1') == 'Support Investigating'
+        assert not self.store.hget('fingerprints', 'TEST-1')
+
+        del self.sfdc.update_ticket
+        self.bridge.sync_issues()
+
+        assert self.sfdc.ticket_data['TTEST-1']['Status__c'] == 'Solved'
+        assert self.store.get('last_seen_jira_status:TEST-1') == issue.fields.status.name
+
+    def test_comments_are_looked_up_in_bulk(self):
+        issue = self.jira.add_issue('TEST-1', 'Support Investigating')
+        self.sfdc.add_ticket('T1')
+        issue.fields.customfield_1 = 'T1'
+        for j in range(10):
+            self.add_comment(issue, str(j))
+        for j in range(4):
+            self.sfdc.create_ticket_comment({'Comment__c': 'Copied', 'related_id__c': 'T1',
+                                             'external_id__c': str(j)})
+        self.store.sadd('seen_comments_id', '9')
+
+        self.bridge.sync_issues()
+
+        assert ('ticket_comments_by_external_id', 9) in self.sfdc.calls
+        assert not [call for call in self.sfdc.calls if call[0] == 'ticket_comment']
+        assert ('create_records', 5) in self.sfdc.calls
+        assert len(self.store.get('seen_comments_id')) == 10
+
+    def test_concurrent_sync(self):
+        self.bridge.workers = 4
+        for i in range(20):
+            issue = self.jira.add_issue('TEST-{}'.format(i), 'New', assignee=None)
+            for j in range(3):
+                self.add_comment(issue, '{}-{}'.format(i, j))
+        # Fails in ensure_ticket, the other issues are still synced
+        del self.jira.issues['TEST-7'].fields.status
+
+        self.bridge.sync_issues()
+
+        assert len(self.sfdc.ticket_data) == 19
+        assert len(self.store.get('issue_to_ticket_id')) == 19
+        assert len(self.store.get('seen_comments_id')) == 57
+
+    def test_worker_threads_are_reused(self):
+        self.bridge.workers = 3
+        self.addCleanup(self.bridge.close)
+        for i in range(6):
+            self.add_open_ticket_issue('TEST-{}'.format(i))
+        threads = set()
+        sync_issue = self.bridge.sync_issue
+
+        def record_thread(issue):
+            threads.add(threading.current_thread())
+            return sync_issue(issue)
+        self.bridge.sync_issue = record_thread
+
+        for _ in range(3):
+            self.bridge.sync_issues()
+
+        assert len(threads) <= 3
+
+    def add_open_ticket_issue(self, key, status='New'):
+        issue = self.jira.add_issue(key, status)
+        ticket_id = 'T{}'.format(key)
+        self.sfdc.add_ticket(ticket_id, Status__c='Open')
+        issue.fields.customfield_1 = ticket_id
+        # SF moved the ticket to Open since the last cycle
+        self.store.set('last_seen_jira_status:{}'.format(key), status)
+        self.store.set('last_seen_sf_status:{}'.format(ticket_id), 'New')
+        return issue
+
+    def test_transitions_are_cached(self):
+        for i in range(3):
+            self.add_open_ticket_issue('TEST-{}'.format(i))
+
+        self.bridge.sync_issues()
+
+        assert [call for call in self.jira.calls if call[0] == 'transitions'] == [
+            ('transitions', 'TEST-0')]
+        assert all(issue.fields.status.name == 'Support Investigating'
+                   for issue in self.jira.issues.values())
+
+    def test_issue_is_refetched_only_after_writes(self):
+        self.add_open_ticket_issue('TEST-1')
+        # Support Investigating -> Open is skipped, nothing is written
+        self.add_open_ticket_issue('TEST-2', status='Support Investigating')
+
+        self.bridge.sync_issues()
+
+        assert [call for call in self.jira.calls if call[0] == 'issue'] == [('issue', 'TEST-1')]
+        assert self.bridge._cycle['issue_fetches'] == 1
+        assert self.bridge._cycle['issue_fetches_avoided'] == 3
+
+    def test_rejected_transition_is_refetched(self):
+        issue = self.add_open_ticket_issue('TEST-1')
+        self.bridge.transition_cache.put(('TEST', 'Bug', 'New'),
+                                         {'Start Investigation': ('99', 'Support Investigating')})
+
+        self.bridge.sync_issues()
+
+        assert issue.fields.status.name == 'Support Investigating'
+        assert [call for call in self.jira.calls if call[0].startswith('transition')] == [
+            ('transition_issue', 'TEST-1', '99'), ('transitions', 'TEST-1'),
+            ('transition_issue', 'TEST-1', '11')]
+        assert self.bridge.transition_cache.get(('TEST', 'Bug', 'New')) is None
+
+    def test_issue_field_updates_are_merged(self):
+        issue = self.jira.add_issue('TEST-1', 'New')
+
+        self.bridge.sync_issues()
+
+        # The new ticket's number, the JIRA summary and description and
+        # the reference to the ticket go out in one update
+        assert [call for call in self.jira.calls if call[0] == 'update'] == [('update', 'TEST-1')]
+        ticket_id = issue.fields.customfield_1
+        assert self.sfdc.ticket_data[ticket_id]['CaseNumber__c'] == issue.fields.customfield_2
+        assert issue.fields.summary == '[TEST-1] Summary'
+
+    def test_reverted_assignment_is_not_sent(self):
+        issue = self.add_open_ticket_issue('TEST-1', status='Waiting Reporter')
+        issue.fields.assignee = Obj(name='someone')
+        self.sfdc.ticket_data['TTEST-1']['Status__c'] = 'Pending'
+        self.store.set('last_seen_sf_status:TTEST-1', 'Open')
+
+        self.bridge.sync_issues()
+
+        # The bot takes the issue for a workflow without transitions and
+        # hands it back right away
+        assert [call for call in self.jira.calls if call[0] == 'assign_issue'] == []
+        assert issue.fields.assignee.name == 'someone'
+        assert self.store.get('last_seen_sf_status:TTEST-1') == 'Pending'
+
+    def test_assignment_is_sent_before_transitions(self):
+        issue = self.add_open_ticket_issue('TEST-1', status='Support Investigating')
+        issue.fields.assignee = Obj(name='someone')
+        self.sfdc.ticket_data['TTEST-1']['Status__c'] = 'Pending'
+        self.store.set('last_seen_sf_status:TTEST-1', 'Open')
+
+        self.bridge.sync_issues()
+
+        assert [call for call in self.jira.calls
+                if call[0] in ('assign_issue', 'transition_issue')] == [
+            ('assign_issue', 'TEST-1', BOT),
+            ('transition_issue', 'TEST-1', '21'),
+            ('assign_issue', 'TEST-1', 'someone')]
+        assert issue.fields.status.name == 'Waiting Reporter'
+
+    def test_failed_assignment_keeps_last_seen_state(self):
+        issue = self.add_open_ticket_issue('TEST-1', status='Support Investigating')
+        issue.fields.assignee = Obj(name=BOT)
+        # SF handed the ticket to Symantec since the last cycle
+        self.sfdc.ticket_data['TTEST-1']['Assignee__c'] = 'Symantec'
+        self.store.set('last_seen_jira_assignee:TEST-1', BOT)
+        self.store.set('last_seen_sf_assignee:TTEST-1', 'JiraBot')
+
+        def fail(issue, assignee):
+            raise JIRAError(500, 'JIRA is down')
+        self.jira.assign_issue = fail
+
+        self.bridge.sync_issues()
+
+        assert self.store.get('last_seen_jira_assignee:TEST-1') == BOT
+        assert self.store.get('last_seen_sf_assignee:TTEST-1') == 'JiraBot'
+
+        del self.jira.assign_issue
+        self.bridge.sync_issues()
+
+        assert issue.fields.assignee.name == 'symantec'
+        assert self.sfdc.ticket_data['TTEST-1']['Assignee__c'] == 'Symantec'
+        assert self.store.get('last_seen_jira_assignee:TEST-1') == 'symantec'
+
+    def test_sync_phases_are_timed(self):
+        self.add_open_ticket_issue('TEST-1')
+        self.add_open_ticket_issue('TEST-2')
+
+        self.bridge.sync_issues()
+
+        histograms = self.bridge.metrics.histograms
+        for phase in ('ensure_ticket',) + bridge.SYNC_PHASES:
+            assert histograms[('sync_phase_seconds', (('phase', phase),))].count == 2
+        assert histograms[('issue_sync_seconds', ())].count == 2
+        assert self.bridge.metrics.gauges[('cycle_issues', ())] == 2
+
+    def test_slow_issue_is_logged(self):
+        self.add_open_ticket_issue('TEST-1')
+        self.bridge.slow_issue_threshold = 1e-9
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        bridge.LOG.addHandler(handler)
+        self.addCleanup(bridge.LOG.removeHandler, handler)
+
+        self.bridge.sync_issues()
+
+        slow = [message for message in messages if message.startswith('Slow issue TEST-1')]
+        assert len(slow) == 1
+        assert 'ensure_ticket' in slow[0] and 'sync_status' in slow[0]
+
+    def test_force_assignee_is_per_thread(self):
+        self.bridge.force_assignee = True
+        result = []
+        thread = threading.Thread(target=lambda: result.append(self.bridge.force_assignee))
+        thread.start()
+        thread.join()
+
+        assert result == [False]
+        assert self.bridge.force_assignee
+
+
+class Page(list):
+    total = None
+
+
+class IncrementalSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.jira = FakeJira()
+        self.sfdc = FakeSalesforce()
+        self.store = storage.Store()
+        config = dict(CONFIG, jira_incremental_sync=True, jira_sync_skew=60,
+                      jira_full_sync_interval=3600, jira_search_page_size=2)
+        self.bridge = bridge.Bridge(self.sfdc, self.jira, self.store, config)
+
+        for i in range(5):
+            issue = self.jira.add_issue('TEST-{}'.format(i), 'Support Investigating')
+            self.sfdc.add_ticket('T{}'.format(i))
+            issue.fields.customfield_1 = 'T{}'.format(i)
+
+    def searches(self):
+        return [call[1] for call in self.jira.calls if call[0] == 'search_issues']
+
+    def test_all_pages_are_fetched(self):
+        assert len(self.bridge.search_issues()) == 5
+        assert len(self.searches()) == 3
+
+    def test_pages_capped_by_server_are_followed(self):
+        search_issues = self.jira.search_issues
+
+        def capped_search_issues(jql, startAt=0, maxResults=50, **kwargs):
+            page = Page(search_issues(jql, startAt, min(maxResults, 1), **kwargs))
+            page.total = len(self.jira.issues)
+            return page
+
+        self.jira.search_issues = capped_search_issues
+        assert len(self.bridge.search_issues()) == 5
+        assert len(self.searches()) == 5
+
+    def test_incremental_cycle(self):
+        self.bridge.sync_issues()
+        assert self.searches() == ['project = TEST'] * 3
+        watermark = self.store.get('sync_watermark')
+        assert watermark and self.store.get('full_sync_time') == watermark
+
+        del self.jira.calls[:]
+        self.store.set('sync_watermark', watermark - 600)
+        self.bridge.sync_issues()
+
+        assert self.searches()[0] == '(project = TEST) AND updated >= -12m'
+        assert self.store.get('sync_watermark') > watermark
+        assert self.store.get('full_sync_time') == watermark
+
+    def test_full_reconciliation(self):
+        self.store.set('sync_watermark', time.time())
+        self.store.set('full_sync_time', time.time() - 7200)
+
+        self.bridge.sync_issues()
+
+        assert self.searches()[0] == 'project = TEST'
+
+    def test_failed_issues_are_retried(self):
+        self.store.set('sync_watermark', 1)
+        self.store.set('full_sync_time', time.time())
+        status = self.jira.issues['TEST-3'].fields.status
+        del self.jira.issues['TEST-3'].fields.status
+
+        self.bridge.sync_issues()
+
+        # The watermark moves on, the failed issue is remembered
+        watermark = self.store.get('sync_watermark')
+        assert watermark > 1
+        assert self.store.get('retry_issue_keys') == ['TEST-3']
+
+        # No issue was updated since
+        search_issues = self.jira.search_issues
+        self.jira.search_issues = lambda jql, **kwargs: (
+            search_issues(jql, **kwargs) if 'key in' in jql else [])
+        del self.jira.calls[:]
+        self.bridge.sync_issues()
+
+        assert self.searches() == ['(project = TEST) AND key in (TEST-3)']
+        assert self.store.get('sync_watermark') > watermark
+        assert self.store.get('retry_issue_keys') == ['TEST-3']
+
+        self.jira.issues['TEST-3'].fields.status = status
+        self.bridge.sync_issues()
+        assert self.store.get('retry_issue_keys') == []
+
+        del self.jira.calls[:]
+        self.bridge.sync_issues()
+        assert not any('key in' in jql for jql in self.searches())
+
+    def test_sf_changes(self):
+        self.store.set('sync_watermark', 1000)
+        self.store.set('full_sync_time', time.time())
+        self.store.hset('issue_to_ticket_id', 'TEST-2', 'T2')
+        self.store.hset('issue_to_ticket_id', 'TEST-3', 'T3')
+        self.sfdc.modified['tickets'] = [{'Id': 'T0', 'External_id__c': 'TEST-0'},
+                                         {'Id': 'T2', 'External_id__c': None},
+                                         {'Id': 'TX', 'External_id__c': "x') OR (key = 'y"}]
+        self.sfdc.modified['comments'] = [{'Id': 'C1', 'related_id__c': 'T3'}]
+        search_issues = self.jira.search_issues
+        self.jira.search_issues = lambda jql, **kwargs: (
+            search_issues(jql, **kwargs) if 'key in' in jql else [self.jira.issues['TEST-3']])
+
+        issues = self.bridge.search_issues()
+
+        assert ('modified_tickets', 940) in self.sfdc.calls
+        assert [issue.key for issue in issues] == ['TEST-3', 'TEST-0', 'TEST-2']
+        assert set(self.searches()) == {'(project = TEST) AND key in (TEST-0, TEST-2)'}
+
+    def test_sf_change_feed_failure(self):
+        self.store.set('sync_watermark', 1000)
+        self.store.set('full_sync_time', time.time())
+        self.sfdc.modified_tickets = None
+
+        assert len(self.bridge.search_issues()) == 5
+        assert self.searches()[-1] == 'project = TEST'
+
+    def test_stop_skips_remaining_issues(self):
+        synced = []
+
+        def sync_issue(issue):
+            synced.append(issue.key)
+            self.bridge.stop()
+
+        self.bridge.sync_issue = sync_issue
+        self.bridge.sync_issues()
+
+        assert synced == ['TEST-0']
+        assert self.store.get('sync_watermark') is None
+
+    def test_shards_split_the_issues(self):
+        keys = []
+        for index in range(3):
+            self.bridge.shard = (index, 3)
+            issues = self.bridge.search_issues()
+            assert all(bridge.shard_of(issue.key, 3) == index for issue in issues)
+            keys.extend(issue.key for issue in issues)
+
+        assert sorted(keys) == sorted(self.jira.issues)
+        # Other shards' issues are only searched by key
+        assert all(call[2] == 'key' or 'key in (' in call[1]
+                   for call in self.jira.calls if call[0] == 'search_issues')
+
+    def test_shard_state(self):
+        keys = ['TEST-{}'.format(i) for i in range(10)]
+        state = {
+            'issue_to_ticket_id': dict((key, 'a0B00000000000{}'.format(i))
+                                       for i, key in enumerate(keys)),
+            'fingerprints': dict((key, 'f') for key in keys),
+            'seen_comments_id': set(['1']),
+            'sync_watermark': 10,
+            'retry_issue_keys': keys,
+        }
+        for i, key in enumerate(keys):
+            state['last_seen_jira_status:{}'.format(key)] = 'Open'
+            state['last_seen_sf_status:a0B00000000000{}AAA'.format(i)] = 'New'
+
+        owned = [key for key in keys if bridge.shard_of(key, 3) == 1]
+        part = bridge.shard_state(state, (1, 3))
+
+        assert sorted(part['issue_to_ticket_id']) == sorted(part['fingerprints']) == owned
+        assert part['retry_issue_keys'] == owned
+        assert sorted(key.split(':')[1] for key in part if key.startswith('last_seen_jira')) == owned
+        assert sorted(part['issue_to_ticket_id'].values()) == sorted(
+            key.split(':')[1][:15] for key in part if key.startswith('last_seen_sf'))
+        assert part['seen_comments_id'] == set(['1'])
+        assert part['sync_watermark'] == 10
+
+    def test_updated_since_jql(self):
+        jql = bridge.Bridge.updated_since_jql('project = A OR project = B order by updated DESC', 90)
+        assert jql == '(project = A OR project = B) AND updated >= -2m order by updated DESC'
@@ -0,0 +1,112 @@
+import threading
+import time
+
+
+class TicketCache(object):
+    """
+    SF tickets fetched during a single sync cycle.
+
+    ``False`` is cached for ids which are known not to exist in SF.
+    """
+    def __init__(self):
+        self.tickets = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, id):
+        return id in self.tickets
+
+    def get(self, id):
+        if id in self.tickets:
+            self.hits += 1
+            return self.tickets[id]
+
+        self.misses += 1
+
+    def peek(self, id):
+        """
+        Cached ticket without counting a hit or miss
+        """
+        return self.tickets.get(id)
+
+    def put(self, id, ticket):
+        self.tickets[id] = ticket
+
+    def invalidate(self, id):
+        self.tickets.pop(id, None)
+
+    def clear(self):
+        self.tickets.clear()
+
+
+class TransitionCache(object):
+    """
+    JIRA workflow transitions available from a status, keyed by project,
+    issue type and status name, which all issues of the same kind share.
+
+    Entries expire after ``ttl`` seconds so workflow changes are noticed.
+    """
+    def __init__(self, ttl=3600, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and self.clock() - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+
+            self.entries.pop(key, None)
+            self.misses += 1
+
+    def put(self, key, transitions):
+        with self.lock:
+            self.entries[key] = (self.clock(), transitions)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class IssueCache(object):
+    """
+    JIRA issues fetched while syncing a single issue.
+
+    Writes record which fields of an issue they changed, a cached copy is
+    only refetched when a field its caller needs was written since.
+    """
+    def __init__(self):
+        self.issues = {}
+        self.stale = {}
+        self.fetches = 0
+        self.avoided = 0
+
+    def get(self, key, fields=None):
+        """
+        Cached issue, None if it is not cached or any of ``fields``, all
+        fields if not given, was written since it was fetched
+        """
+        if key not in self.issues:
+            return
+
+        stale = self.stale.get(key)
+        if stale and (fields is None or '*' in stale or stale.intersection(fields)):
+            return
+
+        self.avoided += 1
+        return self.issues[key]
+
+    def put(self, key, issue):
+        self.issues[key] = issue
+        self.stale.pop(key, None)
+
+    def written(self, key, fields=None):
+        """
+        Record a write of ``fields`` of an issue, of any field if not given
+        """
+        self.stale.setdefault(key, set()).update(fields or ['*'])
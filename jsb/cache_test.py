@@ -0,0 +1,34 @@
+import unittest
+
+from jsb import cache
+
+
+class TransitionCacheTest(unittest.TestCase):
+    def test_ttl(self):
+        now = [1000]
+        transitions = cache.TransitionCache(ttl=60, clock=lambda: now[0])
+
+        transitions.put(('TEST', 'Bug', 'New'), {'Start': ('11', 'Open')})
+        now[0] += 59
+        assert transitions.get(('TEST', 'Bug', 'New')) == {'Start': ('11', 'Open')}
+        now[0] += 1
+        assert transitions.get(('TEST', 'Bug', 'New')) is None
+
+        assert (transitions.hits, transitions.misses) == (1, 1)
+
+
+class IssueCacheTest(unittest.TestCase):
+    def test_stale_fields(self):
+        issues = cache.IssueCache()
+        issues.put('TEST-1', 'issue')
+
+        issues.written('TEST-1', ['comment'])
+        assert issues.get('TEST-1', ['assignee']) == 'issue'
+        assert issues.get('TEST-1') is None
+
+        issues.written('TEST-1')
+        assert issues.get('TEST-1', ['assignee']) is None
+
+        issues.put('TEST-1', 'fresh')
+        assert issues.get('TEST-1', ['assignee']) == 'fresh'
+        assert issues.avoided == 2
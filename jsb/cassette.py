@@ -0,0 +1,312 @@
+"""
+Record and replay of the JIRA and SF traffic of a sync cycle.
+
+`RecordingAdapter` wraps the transport adapters of a requests session and
+adds every request with its response to a `Cassette`, `ReplayAdapter`
+answers requests from a cassette without any network. Passwords, secrets
+and tokens are redacted before anything is recorded.
+
+Cassettes are gzipped JSON lines: a header with the time of the recording
+and the state the cycle started with, then one line per request.
+"""
+import base64
+import gzip
+import json
+import os
+import threading
+import time
+from collections import Counter, deque
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from six.moves.urllib.parse import parse_qsl, urlencode, urlsplit
+
+from jsb import LOG
+from jsb.storage import FileBackend, merge_states
+
+VERSION = 1
+
+# Values of these fields are replaced in urls, request and response bodies
+REDACTED_FIELDS = frozenset(['password', 'client_secret', 'client_id', 'access_token',
+                             'refresh_token', 'signature'])
+REDACTED = 'REDACTED'
+
+# Response headers read by the clients and the rate limiters
+RECORDED_HEADERS = ('Content-Type', 'Location', 'Retry-After', 'Sforce-Limit-Info')
+
+WRITE_METHODS = frozenset(['POST', 'PUT', 'PATCH', 'DELETE'])
+
+
+class CassetteError(requests.ConnectionError):
+    """
+    Request not found in the cassette being replayed
+    """
+
+
+def redact(value, fields=REDACTED_FIELDS):
+    """
+    Copy of a decoded JSON ``value`` with the values of ``fields`` redacted
+    """
+    if isinstance(value, dict):
+        return dict((key, REDACTED if key in fields else redact(item, fields))
+                    for key, item in value.items())
+    if isinstance(value, list):
+        return [redact(item, fields) for item in value]
+    return value
+
+
+def redact_url(url, fields=REDACTED_FIELDS):
+    """
+    Path and query string of ``url`` with the values of ``fields`` redacted
+    """
+    parts = urlsplit(url)
+    path = parts.path or '/'
+    if not parts.query:
+        return path
+
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    if not any(name in fields for name, value in query):
+        return '{}?{}'.format(path, parts.query)
+    return '{}?{}'.format(path, urlencode(
+        [(name, REDACTED if name in fields else value) for name, value in query]))
+
+
+def _text(content):
+    if content is None:
+        return None
+    if isinstance(content, bytes):
+        return content.decode('utf-8', 'replace')
+    return content
+
+
+def normalize_body(body, content_type=None, fields=REDACTED_FIELDS):
+    """
+    Redacted request or response ``body``, JSON with sorted keys so equal
+    bodies compare equal
+    """
+    body = _text(body)
+    if not body:
+        return body
+
+    if content_type and 'x-www-form-urlencoded' in content_type:
+        return urlencode(sorted((name, REDACTED if name in fields else value)
+                                for name, value in parse_qsl(body, keep_blank_values=True)))
+    try:
+        value = json.loads(body)
+    except ValueError:
+        return body
+    return json.dumps(redact(value, fields), sort_keys=True, separators=(',', ':'))
+
+
+def request_key(api, request, fields=REDACTED_FIELDS):
+    """
+    (api, method, url, body) identifying a prepared ``request``
+    """
+    return (api, request.method.upper(), redact_url(request.url, fields),
+            normalize_body(request.body, request.headers.get('Content-Type'), fields))
+
+
+class Cassette(object):
+    """
+    Requests and responses of a sync cycle, with the state the cycle
+    started with encoded like `jsb.storage.FileBackend` snapshots
+    """
+    def __init__(self, interactions=(), state=None, recorded_at=None,
+                 redacted_fields=REDACTED_FIELDS):
+        self.interactions = list(interactions)
+        self.state = state
+        self.recorded_at = recorded_at or time.time()
+        self.redacted_fields = frozenset(redacted_fields)
+        self.lock = threading.Lock()
+
+    def record(self, api, request, response, elapsed):
+        method, url, body = request_key(api, request, self.redacted_fields)[1:]
+        interaction = {
+            'api': api,
+            'method': method,
+            'url': url,
+            'body': body,
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': dict((name, response.headers[name]) for name in RECORDED_HEADERS
+                            if name in response.headers),
+            'response': normalize_body(response.content, fields=self.redacted_fields),
+            'elapsed': round(elapsed, 4),
+        }
+        with self.lock:
+            self.interactions.append(interaction)
+
+    def save_state(self, data):
+        """
+        Keep the state ``data`` of the store as the recorded cycle starts,
+        any backend's state is copied into plain dicts and sets first
+        """
+        self.recorded_at = time.time()
+        self.state = FileBackend(None, None).encode(merge_states([data]))
+
+    def load_state(self):
+        if self.state is None:
+            return {}
+        return FileBackend(None, None).decode(self.state)
+
+    def writes(self):
+        """
+        (api, method, url, body) of every recorded write request
+        """
+        return [(i['api'], i['method'], i['url'], i['body'])
+                for i in self.interactions if i['method'] in WRITE_METHODS]
+
+    def save(self, path):
+        header = {'version': VERSION, 'recorded_at': self.recorded_at}
+        if self.state is not None:
+            header['state'] = base64.b64encode(self.state).decode('ascii')
+
+        tmp_path = '{}.tmp'.format(path)
+        with gzip.open(tmp_path, 'wb') as fp:
+            for line in [header] + self.interactions:
+                fp.write(json.dumps(line, sort_keys=True).encode('utf-8') + b'\n')
+        os.rename(tmp_path, path)
+        LOG.info('Recorded %s requests to %s', len(self.interactions), path)
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, 'rb') as fp:
+            lines = [json.loads(line.decode('utf-8')) for line in fp if line.strip()]
+
+        header = lines[0]
+        if header.get('version') != VERSION:
+            raise ValueError('Unsupported cassette version {} in {}'.format(
+                header.get('version'), path))
+
+        state = header.get('state')
+        if state is not None:
+            state = base64.b64decode(state)
+        return cls(lines[1:], state=state, recorded_at=header['recorded_at'])
+
+
+class RecordingAdapter(BaseAdapter):
+    """
+    Transport adapter adding the requests sent by the wrapped ``adapter``
+    to ``cassette``
+    """
+    def __init__(self, cassette, api, adapter):
+        super(RecordingAdapter, self).__init__()
+        self.cassette = cassette
+        self.api = api
+        self.adapter = adapter
+
+    def send(self, request, **kwargs):
+        start = time.time()
+        response = self.adapter.send(request, **kwargs)
+        # Reads the whole body, the session gets it from the response
+        response.content
+        self.cassette.record(self.api, request, response, time.time() - start)
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+def record_session(session, cassette, api):
+    """
+    Record all requests of ``session`` to ``cassette``
+    """
+    for prefix, adapter in list(session.adapters.items()):
+        if not isinstance(adapter, RecordingAdapter):
+            session.mount(prefix, RecordingAdapter(cassette, api, adapter))
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Transport adapter answering requests to ``api`` with the responses
+    recorded in ``cassette``.
+
+    Requests are matched by method, url and body, then by method and url,
+    then by method and path only, so queries containing the current time
+    are still answered. Recorded responses are used in order, the last
+    one of a request is reused when it is sent again. With ``timing``
+    every response takes as long as the recorded one.
+    """
+    def __init__(self, cassette, api, timing=False):
+        super(ReplayAdapter, self).__init__()
+        self.cassette = cassette
+        self.api = api
+        self.timing = timing
+        self.writes = []
+        self.lock = threading.Lock()
+
+        self.responses = {}
+        self.used = set()
+        for index, interaction in enumerate(cassette.interactions):
+            if interaction['api'] != api:
+                continue
+            method, url = interaction['method'], interaction['url']
+            for key in ((method, url, interaction['body']), (method, url),
+                        (method, url.split('?', 1)[0])):
+                self.responses.setdefault(key, deque()).append((index, interaction))
+
+    def _find(self, method, url, body):
+        for key in ((method, url, body), (method, url), (method, url.split('?', 1)[0])):
+            responses = self.responses.get(key)
+            if not responses:
+                continue
+
+            # Skip responses already used through one of the other keys
+            while len(responses) > 1 and responses[0][0] in self.used:
+                responses.popleft()
+            index, interaction = responses[0]
+            if len(responses) > 1:
+                responses.popleft()
+            self.used.add(index)
+            return interaction
+
+    def send(self, request, **kwargs):
+        api, method, url, body = request_key(self.api, request,
+                                             self.cassette.redacted_fields)
+        with self.lock:
+            if method in WRITE_METHODS:
+                self.writes.append((api, method, url, body))
+            interaction = self._find(method, url, body)
+
+        if interaction is None:
+            raise CassetteError('{} {} {} is not in the cassette'.format(api, method, url),
+                                request=request)
+
+        if self.timing:
+            time.sleep(interaction['elapsed'])
+
+        response = requests.Response()
+        response.status_code = interaction['status']
+        response.reason = interaction['reason']
+        response.headers = CaseInsensitiveDict(interaction['headers'])
+        response._content = (interaction['response'] or '').encode('utf-8')
+        response._content_consumed = True
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+
+def replay_session(session, cassette, api, timing=False):
+    """
+    Answer all requests of ``session`` from ``cassette``, returns the
+    `ReplayAdapter`
+    """
+    adapter = ReplayAdapter(cassette, api, timing=timing)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return adapter
+
+
+def compare_writes(recorded, replayed):
+    """
+    Write requests of a recording missing from its replay and those the
+    replay sent in addition, as lists of (api, method, url, body)
+    """
+    recorded, replayed = Counter(recorded), Counter(replayed)
+    return sorted((recorded - replayed).elements()), sorted((replayed - recorded).elements())
@@ -0,0 +1,155 @@
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import requests
+from jira import JIRA
+
+from jsb import bridge, cassette, storage, testing
+from jsb.bridge_test import BOT, CONFIG
+from jsb.salesforce import Client, OAuth2
+
+
+class CassetteTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'cycle.jsonl.gz')
+
+        self.jira = testing.FakeJira(username=BOT).start()
+        self.addCleanup(self.jira.stop)
+        self.salesforce = testing.FakeSalesforce().start()
+        self.addCleanup(self.salesforce.stop)
+        self.config = dict(CONFIG, jira_url=self.jira.url)
+
+        for i in range(3):
+            key = 'TEST-{}'.format(i)
+            self.jira.add_issue(key, 'New', customfield_1=None, customfield_2=None)
+            self.jira.add_comment(key, 'Comment {}'.format(i))
+
+    def create_bridge(self, store, record=None, replay=None):
+        jira_client = JIRA(server=self.jira.url, basic_auth=(BOT, 'password'),
+                           get_server_info=False)
+        sfdc_session = requests.Session()
+        adapters = []
+        if record:
+            cassette.record_session(jira_client._session, record, 'JIRA')
+            cassette.record_session(sfdc_session, record, 'SF')
+        if replay:
+            adapters.append(cassette.replay_session(jira_client._session, replay, 'JIRA'))
+            adapters.append(cassette.replay_session(sfdc_session, replay, 'SF'))
+
+        sfdc_client = Client(OAuth2('client', 'secret', 'user', 'password',
+                                    auth_url=self.salesforce.url), session=sfdc_session)
+        return bridge.Bridge(sfdc_client, jira_client, store, self.config), adapters
+
+    def record(self):
+        store = storage.Store()
+        self.create_bridge(store)[0].sync_issues()
+        self.jira.add_comment('TEST-1', 'New comment')
+
+        recording = cassette.Cassette()
+        recording.save_state(store.data)
+        self.create_bridge(store, record=recording)[0].sync_issues()
+        recording.save(self.path)
+        return store
+
+    def test_replay_sends_the_recorded_writes(self):
+        recorded_store = self.record()
+        self.jira.stop()
+        self.salesforce.stop()
+
+        recording = cassette.Cassette.load(self.path)
+        store = storage.Store()
+        store.data = recording.load_state()
+        replay_bridge, adapters = self.create_bridge(store, replay=recording)
+        replay_bridge.sync_issues()
+
+        writes = adapters[0].writes + adapters[1].writes
+        assert any(write[:2] == ('SF', 'POST') and 'New comment' in write[3]
+                   for write in writes)
+        assert cassette.compare_writes(recording.writes(), writes) == ([], [])
+        assert store.hgetall('issue_to_ticket_id') == recorded_store.hgetall(
+            'issue_to_ticket_id')
+
+    def test_secrets_are_redacted(self):
+        self.record()
+
+        with gzip.open(self.path, 'rb') as fp:
+            content = fp.read().decode('utf-8')
+        assert 'client_secret=REDACTED' in content
+        assert 'password=REDACTED' in content
+        assert '=secret' not in content
+        assert 'password=password' not in content
+        assert self.salesforce.access_token not in content
+
+    def test_state_of_every_backend(self):
+        directory = os.path.dirname(self.path)
+        backends = [
+            storage.InMemoryBackend(),
+            storage.FileBackend(os.path.join(directory, 'state.yml'),
+                                os.path.join(directory, 'tmp_state.yml')),
+            storage.JournalBackend(os.path.join(directory, 'journal.yml'),
+                                   os.path.join(directory, 'tmp_journal.yml'),
+                                   os.path.join(directory, 'journal.log')),
+            storage.SqliteBackend(os.path.join(directory, 'state.db')),
+        ]
+        for backend in backends:
+            store = storage.Store(backend, compact_sets=['seen_comments_id'])
+            store.sadd('seen_comments_id', '10001')
+            store.hset('issue_to_ticket_id', 'TEST-1', 'T1')
+            store.set('sync_watermark', 1000.5)
+
+            recording = cassette.Cassette()
+            recording.save_state(store.data)
+            recording.save(self.path)
+
+            state = cassette.Cassette.load(self.path).load_state()
+            assert state == {'seen_comments_id': set(['10001']),
+                             'issue_to_ticket_id': {'TEST-1': 'T1'},
+                             'sync_watermark': 1000.5}, type(backend)
+
+    def test_state_of_runner_script_modules(self):
+        # runner.py runs as a script and imports this module as plain storage
+        sys.path.insert(0, os.path.dirname(storage.__file__))
+        try:
+            script_storage = __import__('storage')
+            store = script_storage.Store(compact_sets=['seen_comments_id'])
+            store.sadd('seen_comments_id', '10001')
+            store.sadd('seen_comments_id', '10002')
+        finally:
+            sys.path.pop(0)
+            sys.modules.pop('storage', None)
+        assert not isinstance(store.data['seen_comments_id'], storage.IntSet)
+
+        recording = cassette.Cassette()
+        recording.save_state(store.data)
+        recording.save(self.path)
+
+        state = cassette.Cassette.load(self.path).load_state()
+        assert state == {'seen_comments_id': set(['10001', '10002'])}
+
+    def test_unknown_request(self):
+        replay = cassette.ReplayAdapter(cassette.Cassette(), 'SF')
+        session = requests.Session()
+        session.mount('http://', replay)
+
+        with self.assertRaises(cassette.CassetteError):
+            session.get('http://example.com/services/data/v35.0/query?q=x')
+
+    def test_queries_with_other_values_replay_in_order(self):
+        recording = cassette.Cassette([
+            dict(api='SF', method='GET', url='/query?q=1', body=None, status=200,
+                 reason='OK', headers={}, response='{"n":1}', elapsed=0),
+            dict(api='SF', method='GET', url='/query?q=2', body=None, status=200,
+                 reason='OK', headers={}, response='{"n":2}', elapsed=0),
+        ])
+        session = requests.Session()
+        cassette.replay_session(session, recording, 'SF')
+
+        assert session.get('http://sf/query?q=2').json() == {'n': 2}
+        assert session.get('http://sf/query?q=3').json() == {'n': 1}
+        assert session.get('http://sf/query?q=3').json() == {'n': 2}
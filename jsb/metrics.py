@@ -0,0 +1,301 @@
+"""
+Counters, gauges and latency histograms of the bridge.
+
+Everything is recorded into a `Metrics` registry shared by all threads,
+sinks export it: `StatsdSink` sends every observation as it happens, the
+others read the registry when `Metrics.flush` is called at the end of a
+sync cycle.
+"""
+import os
+import re
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+
+from jsb import LOG
+
+# Upper bounds in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Issue keys and numeric ids in JIRA API urls
+JIRA_RESOURCE = re.compile(r'/(issue|comment)/[^/?]+')
+STATSD_INVALID = re.compile(r'[^a-zA-Z0-9_.-]')
+
+
+def jira_endpoint_name(url):
+    """
+    Strip the query string, issue keys and ids from a JIRA API url, so
+    calls to the same endpoint can be grouped together
+    """
+    path = re.sub(r'^https?://[^/]+', '', url.split('?', 1)[0])
+    return JIRA_RESOURCE.sub(r'/\1/{id}', path)
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def cumulative(self):
+        """
+        (upper bound, number of observations up to it) pairs
+        """
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.count, histogram.sum, histogram.max = self.count, self.sum, self.max
+        return histogram
+
+
+class Timer(object):
+    def __init__(self):
+        self.start = time.time()
+        self.elapsed = None
+
+
+class Metrics(object):
+    """
+    Registry of metrics identified by a name and a set of labels
+    """
+    def __init__(self, prefix='jsb', sinks=()):
+        self.prefix = prefix
+        self.sinks = list(sinks)
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self._record('counter', name, value, labels)
+
+    def gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+        self._record('gauge', name, value, labels)
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+        self._record('histogram', name, value, labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observe the seconds spent in the block, also when it raises
+        """
+        timer = Timer()
+        try:
+            yield timer
+        finally:
+            timer.elapsed = time.time() - timer.start
+            self.observe(name, timer.elapsed, **labels)
+
+    def _record(self, kind, name, value, labels):
+        for sink in self.sinks:
+            sink.record(kind, name, value, labels)
+
+    def snapshot(self):
+        """
+        Copies of the counters, gauges and histograms
+        """
+        with self.lock:
+            return (dict(self.counters), dict(self.gauges),
+                    dict((key, h.copy()) for key, h in self.histograms.items()))
+
+    def flush(self):
+        for sink in self.sinks:
+            try:
+                sink.flush(self)
+            except Exception:
+                LOG.exception('Failed to export metrics with %s', type(sink).__name__)
+
+
+class Sink(object):
+    def record(self, kind, name, value, labels):
+        """
+        Called for every observation
+        """
+        pass
+
+    def flush(self, metrics):
+        """
+        Called at the end of every sync cycle
+        """
+        pass
+
+
+def _prometheus_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in labels))
+
+
+def render_prometheus(metrics):
+    """
+    The metrics in the Prometheus text exposition format
+    """
+    counters, gauges, histograms = metrics.snapshot()
+    lines = []
+
+    def add(values, kind):
+        seen = set()
+        for (name, labels), value in sorted(values.items()):
+            name = '{}_{}'.format(metrics.prefix, name)
+            if name not in seen:
+                seen.add(name)
+                lines.append('# TYPE {} {}'.format(name, kind))
+            if kind != 'histogram':
+                lines.append('{}{} {}'.format(name, _prometheus_labels(labels), value))
+                continue
+
+            for bound, count in value.cumulative():
+                lines.append('{}_bucket{} {}'.format(
+                    name, _prometheus_labels(labels, [('le', bound)]), count))
+            lines.append('{}_bucket{} {}'.format(
+                name, _prometheus_labels(labels, [('le', '+Inf')]), value.count))
+            lines.append('{}_sum{} {}'.format(name, _prometheus_labels(labels), value.sum))
+            lines.append('{}_count{} {}'.format(name, _prometheus_labels(labels), value.count))
+
+    add(counters, 'counter')
+    add(gauges, 'gauge')
+    add(histograms, 'histogram')
+    return '\n'.join(lines) + '\n'
+
+
+class PrometheusTextfileSink(Sink):
+    """
+    Writes the metrics for the textfile collector of the node exporter,
+    replacing the file at once so it is never read half written
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def flush(self, metrics):
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as fp:
+            fp.write(render_prometheus(metrics))
+        os.rename(tmp_path, self.path)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class PrometheusEndpoint(Sink):
+    """
+    Serves the current metrics on ``http://host:port/metrics``
+    """
+    def __init__(self, metrics, port, host=''):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+
+                content = render_prometheus(metrics).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+class StatsdSink(Sink):
+    """
+    Sends every observation to a StatsD server over UDP, label values are
+    appended to the metric name. Histograms are sent as timers in
+    milliseconds.
+    """
+    TYPES = {'counter': 'c', 'gauge': 'g', 'histogram': 'ms'}
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='jsb'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def format(self, kind, name, value, labels):
+        parts = [self.prefix, name] + [str(labels[label]) for label in sorted(labels)]
+        name = '.'.join(STATSD_INVALID.sub('_', part.strip('/')) for part in parts if part)
+        if kind == 'histogram':
+            value = value * 1000
+        return '{}:{:g}|{}'.format(name, value, self.TYPES[kind])
+
+    def record(self, kind, name, value, labels):
+        try:
+            self.socket.sendto(self.format(kind, name, value, labels).encode('utf-8'),
+                               self.address)
+        except socket.error:
+            # Metrics must never break a sync
+            pass
+
+
+class SummarySink(Sink):
+    """
+    Logs the histograms and counters at the end of every cycle
+    """
+    def flush(self, metrics):
+        counters, gauges, histograms = metrics.snapshot()
+        for (name, labels), histogram in sorted(histograms.items()):
+            if not histogram.count:
+                continue
+            LOG.info('%s%s: %s, %.3fs total, %.3fs avg, %.3fs max', name,
+                     _prometheus_labels(labels), histogram.count, histogram.sum,
+                     histogram.sum / histogram.count, histogram.max)
+        for (name, labels), value in sorted(counters.items()):
+            LOG.info('%s%s: %s', name, _prometheus_labels(labels), value)
+        for (name, labels), value in sorted(gauges.items()):
+            LOG.info('%s%s: %s', name, _prometheus_labels(labels), value)
@@ -0,0 +1,97 @@
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+import requests
+
+from jsb import metrics, storage
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = metrics.Metrics()
+
+    def test_render_prometheus(self):
+        self.metrics.increment('issues_failed_total')
+        self.metrics.increment('issues_failed_total', 2)
+        self.metrics.gauge('cache_hits', 5, cache='ticket')
+        self.metrics.observe('sync_phase_seconds', 0.02, phase='sync_status')
+        self.metrics.observe('sync_phase_seconds', 3, phase='sync_status')
+
+        lines = metrics.render_prometheus(self.metrics).splitlines()
+
+        assert '# TYPE jsb_issues_failed_total counter' in lines
+        assert 'jsb_issues_failed_total 3' in lines
+        assert 'jsb_cache_hits{cache="ticket"} 5' in lines
+        assert '# TYPE jsb_sync_phase_seconds histogram' in lines
+        assert 'jsb_sync_phase_seconds_bucket{phase="sync_status",le="0.01"} 0' in lines
+        assert 'jsb_sync_phase_seconds_bucket{phase="sync_status",le="0.025"} 1' in lines
+        assert 'jsb_sync_phase_seconds_bucket{phase="sync_status",le="5"} 2' in lines
+        assert 'jsb_sync_phase_seconds_bucket{phase="sync_status",le="+Inf"} 2' in lines
+        assert 'jsb_sync_phase_seconds_count{phase="sync_status"} 2' in lines
+
+    def test_timer_observes_failed_blocks(self):
+        with self.assertRaises(ValueError):
+            with self.metrics.timer('sync_phase_seconds', phase='sync_status'):
+                raise ValueError()
+
+        histogram = self.metrics.histograms[('sync_phase_seconds', (('phase', 'sync_status'),))]
+        assert histogram.count == 1
+
+    def test_textfile_sink(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'jsb.prom')
+        self.metrics.add_sink(metrics.PrometheusTextfileSink(path))
+        self.metrics.gauge('cycle_issues', 10)
+
+        self.metrics.flush()
+
+        with open(path) as fp:
+            assert 'jsb_cycle_issues 10' in fp.read().splitlines()
+        assert os.listdir(directory) == ['jsb.prom']
+
+    def test_prometheus_endpoint(self):
+        endpoint = metrics.PrometheusEndpoint(self.metrics, 0, host='127.0.0.1').start()
+        self.addCleanup(endpoint.stop)
+        self.metrics.gauge('cycle_issues', 10)
+
+        response = requests.get('http://127.0.0.1:{}/metrics'.format(endpoint.port))
+
+        assert response.status_code == 200
+        assert 'jsb_cycle_issues 10' in response.text.splitlines()
+
+    def test_statsd_sink(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        self.addCleanup(server.close)
+        self.metrics.add_sink(metrics.StatsdSink(port=server.getsockname()[1]))
+
+        self.metrics.observe('api_request_seconds', 0.25, api='SF', method='GET',
+                             endpoint='/services/data/v35.0/query')
+        self.metrics.increment('issues_failed_total')
+
+        assert server.recv(1024) == b'jsb.api_request_seconds.SF.services_data_v35.0_query.GET:250|ms'
+        assert server.recv(1024) == b'jsb.issues_failed_total:1|c'
+
+    def test_jira_endpoint_name(self):
+        assert metrics.jira_endpoint_name(
+            'https://jira.example.com/rest/api/2/issue/CFS-848/comment/1234?expand=x') == (
+            '/rest/api/2/issue/{id}/comment/{id}')
+        assert metrics.jira_endpoint_name('/rest/api/2/search?jql=project') == '/rest/api/2/search'
+
+    def test_store_flushes(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        backend = storage.FileBackend(os.path.join(directory, 'state'),
+                                      os.path.join(directory, 'tmp_state'))
+        store = storage.Store(backend, metrics=self.metrics)
+
+        store.set('key', 'value')
+
+        assert self.metrics.histograms[('store_flush_seconds', ())].count == 1
+        assert self.metrics.counters[('store_flush_bytes_total', ())] == os.path.getsize(
+            os.path.join(directory, 'state'))
@@ -0,0 +1,249 @@
+"""
+Client side rate limiting of the SF and JIRA APIs.
+
+Every API gets one limiter shared by all threads talking to it. The
+limiter is a token bucket whose rate adapts to what the API reports: SF
+sends the daily API usage with every response, JIRA is judged by its
+response times. Throttled responses pause all callers at once.
+"""
+import re
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+
+from jsb import LOG
+
+LIMIT_INFO = re.compile(r'api-usage=(\d+)/(\d+)')
+
+
+def retry_after(headers):
+    """
+    Seconds from a Retry-After header, HTTP dates are not supported
+    """
+    try:
+        return max(0.0, float(headers.get('Retry-After')))
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter(object):
+    """
+    Token bucket allowing ``rate`` requests per second with bursts of up
+    to ``burst`` requests.
+
+    :param min_rate: lowest rate the limiter may slow down to
+    :param backoff_factor: first pause after a throttled response in
+        seconds, doubled for every consecutive one
+    """
+    def __init__(self, rate=10, burst=None, min_rate=0.1, backoff_factor=1,
+                 max_backoff=300, clock=time.time, sleep=time.sleep):
+        self.max_rate = float(rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.rate = self.max_rate
+        self.burst = burst or max(1.0, self.max_rate)
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.sleep = sleep
+
+        self.tokens = self.burst
+        self.updated = clock()
+        self.paused_until = 0
+        self.failures = 0
+
+        self.requests = 0
+        self.throttled = 0
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """
+        Take a token if a request may be made now
+
+        :return: 0, or the seconds to wait before trying again
+        """
+        with self.lock:
+            now = self.clock()
+            self._refill(now)
+            if now >= self.paused_until and self.tokens >= 1:
+                self.tokens -= 1
+                self.requests += 1
+                return 0
+
+            wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            self.waited += wait
+            return wait
+
+    def acquire(self):
+        """
+        Block until a request may be made
+        """
+        wait = self.reserve()
+        while wait:
+            self.sleep(wait)
+            wait = self.reserve()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill(self.clock())
+            self.rate = max(self.min_rate, min(self.max_rate, rate))
+
+    def backoff(self, delay=None):
+        """
+        Pause all requests after a throttled response, for ``delay``
+        seconds or exponentially longer with every consecutive call
+
+        :return: length of the pause
+        """
+        with self.lock:
+            self.failures += 1
+            self.throttled += 1
+            if delay is None:
+                delay = min(self.max_backoff, self.backoff_factor * 2 ** (self.failures - 1))
+            self.paused_until = max(self.paused_until, self.clock() + delay)
+
+        LOG.warning('API request was throttled, pausing requests for %.1fs', delay)
+        return delay
+
+    def observe(self, response, elapsed):
+        """
+        Adapt to a response received ``elapsed`` seconds after the request
+        was sent
+        """
+        if response.status_code == 429:
+            self.backoff(retry_after(response.headers))
+        elif self.failures:
+            with self.lock:
+                self.failures = 0
+
+    def log_summary(self, name):
+        LOG.info('%s: %s requests, %s throttled, %.1fs spent waiting, rate %.1f/s',
+                 name, self.requests, self.throttled, self.waited, self.rate)
+
+    def export(self, metrics, api):
+        """
+        Set gauges of the limiter state in `jsb.metrics.Metrics`
+        """
+        metrics.gauge('ratelimit_requests', self.requests, api=api)
+        metrics.gauge('ratelimit_throttled', self.throttled, api=api)
+        metrics.gauge('ratelimit_wait_seconds', self.waited, api=api)
+        metrics.gauge('ratelimit_rate', self.rate, api=api)
+
+
+class SalesforceLimiter(RateLimiter):
+    """
+    Slows down as the org gets close to its daily API request limit,
+    reported by SF in the Sforce-Limit-Info header.
+
+    Up to ``soft_limit`` of the daily requests used, requests run at the
+    full rate. Past it the rate drops linearly to ``min_rate`` which is
+    reached at ``hard_limit``.
+    """
+    def __init__(self, rate=25, soft_limit=0.5, hard_limit=0.95,
+                 limit_exceeded_delay=600, **kwargs):
+        super(SalesforceLimiter, self).__init__(rate, **kwargs)
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.limit_exceeded_delay = limit_exceeded_delay
+
+        self.api_usage = None
+        self.api_limit = None
+
+    def observe(self, response, elapsed):
+        match = LIMIT_INFO.search(response.headers.get('Sforce-Limit-Info') or '')
+        if match:
+            self.update_usage(int(match.group(1)), int(match.group(2)))
+
+        if response.status_code == 403 and b'REQUEST_LIMIT_EXCEEDED' in response.content:
+            # The daily limit is used up, retrying soon would not help
+            self.backoff(self.limit_exceeded_delay)
+            return
+
+        super(SalesforceLimiter, self).observe(response, elapsed)
+
+    def update_usage(self, used, limit):
+        self.api_usage, self.api_limit = used, limit
+        if not limit:
+            return
+
+        usage = float(used) / limit
+        if usage <= self.soft_limit:
+            rate = self.max_rate
+        elif usage >= self.hard_limit:
+            rate = self.min_rate
+        else:
+            share = (self.hard_limit - usage) / (self.hard_limit - self.soft_limit)
+            rate = self.min_rate + (self.max_rate - self.min_rate) * share
+
+        if rate != self.rate:
+            self.set_rate(rate)
+
+    def export(self, metrics, api='SF'):
+        super(SalesforceLimiter, self).export(metrics, api)
+        if self.api_limit:
+            metrics.gauge('api_daily_usage', self.api_usage, api=api)
+            metrics.gauge('api_daily_limit', self.api_limit, api=api)
+
+    def log_summary(self, name='SF API'):
+        super(SalesforceLimiter, self).log_summary(name)
+        if self.api_limit:
+            LOG.info('%s usage: %s of %s daily requests (%.0f%%)', name, self.api_usage,
+                     self.api_limit, 100.0 * self.api_usage / self.api_limit)
+
+
+class LatencyLimiter(RateLimiter):
+    """
+    Additive increase, multiplicative decrease of the rate based on
+    response times: responses slower than ``slow_factor`` times the
+    average cut the rate by ``decrease``, others raise it by ``increase``
+    requests per second.
+    """
+    def __init__(self, rate=10, slow_factor=3, decrease=0.7, increase=0.5, **kwargs):
+        super(LatencyLimiter, self).__init__(rate, **kwargs)
+        self.slow_factor = slow_factor
+        self.decrease = decrease
+        self.increase = increase
+        self.average = None
+
+    def observe(self, response, elapsed):
+        super(LatencyLimiter, self).observe(response, elapsed)
+        if response.status_code == 429:
+            self.set_rate(self.rate * self.decrease)
+            return
+
+        if self.average is not None and elapsed > self.slow_factor * self.average:
+            self.set_rate(self.rate * self.decrease)
+        elif self.rate < self.max_rate:
+            self.set_rate(self.rate + self.increase)
+
+        with self.lock:
+            self.average = elapsed if self.average is None else 0.9 * self.average + 0.1 * elapsed
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    Transport adapter passing every request through ``limiter``, for
+    sessions created by third party clients
+
+    :param stats: `jsb.salesforce.RequestStats` recording every request
+    """
+    def __init__(self, limiter, stats=None, **kwargs):
+        super(RateLimitedAdapter, self).__init__(**kwargs)
+        self.limiter = limiter
+        self.stats = stats
+
+    def send(self, request, **kwargs):
+        self.limiter.acquire()
+
+        start = time.time()
+        response = super(RateLimitedAdapter, self).send(request, **kwargs)
+        elapsed = time.time() - start
+        self.limiter.observe(response, elapsed)
+        if self.stats:
+            self.stats.record(request.method, request.url, elapsed)
+        return response
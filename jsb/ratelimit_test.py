@@ -0,0 +1,91 @@
+import unittest
+
+import requests
+
+from jsb import ratelimit
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def response(status=200, headers=None, content=b''):
+    result = requests.Response()
+    result.status_code = status
+    result.headers.update(headers or {})
+    result._content = content
+    return result
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def limiter(self, cls=ratelimit.RateLimiter, **kwargs):
+        return cls(clock=self.clock, sleep=self.clock.sleep, **kwargs)
+
+    def test_rate(self):
+        limiter = self.limiter(rate=2, burst=2)
+        for _ in range(6):
+            limiter.acquire()
+
+        # The burst goes out at once, then one request every 0.5s
+        assert self.clock.now == 1002.0
+        assert limiter.requests == 6
+
+    def test_backoff(self):
+        limiter = self.limiter(rate=100, backoff_factor=1)
+
+        limiter.observe(response(429), 0.1)
+        limiter.observe(response(429), 0.1)
+        limiter.acquire()
+        assert self.clock.now == 1002.0
+
+        limiter.observe(response(429, {'Retry-After': '30'}), 0.1)
+        limiter.acquire()
+        assert self.clock.now == 1032.0
+        assert limiter.throttled == 3
+
+        limiter.observe(response(200), 0.1)
+        assert limiter.failures == 0
+
+    def test_salesforce_usage(self):
+        limiter = self.limiter(ratelimit.SalesforceLimiter, rate=20, min_rate=1,
+                               soft_limit=0.5, hard_limit=0.9)
+
+        limiter.observe(response(headers={'Sforce-Limit-Info': 'api-usage=400/1000'}), 0.1)
+        assert limiter.rate == 20
+        limiter.observe(response(headers={'Sforce-Limit-Info': 'api-usage=700/1000'}), 0.1)
+        self.assertAlmostEqual(limiter.rate, 10.5)
+        limiter.observe(response(headers={'Sforce-Limit-Info': 'api-usage=950/1000'}), 0.1)
+        assert limiter.rate == 1
+        assert (limiter.api_usage, limiter.api_limit) == (950, 1000)
+
+    def test_salesforce_limit_exceeded(self):
+        limiter = self.limiter(ratelimit.SalesforceLimiter, limit_exceeded_delay=600)
+
+        limiter.observe(response(403, content=b'[{"errorCode": "REQUEST_LIMIT_EXCEEDED"}]'), 0.1)
+        limiter.acquire()
+
+        assert self.clock.now == 1600.0
+
+    def test_latency(self):
+        limiter = self.limiter(ratelimit.LatencyLimiter, rate=10, slow_factor=3,
+                               decrease=0.5, increase=1)
+
+        limiter.observe(response(), 0.1)
+        limiter.observe(response(), 1.0)
+        assert limiter.rate == 5
+        limiter.observe(response(), 0.1)
+        assert limiter.rate == 6
+        limiter.observe(response(429), 0.1)
+        assert limiter.rate == 3
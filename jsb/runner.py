@@ -1,45 +1,382 @@
+import json
 import logging
 import os
+import re
+import shutil
+import signal
+import subprocess
 import sys
-import yaml
-# import shutil
+import tempfile
+import time
 
-from jsb import LOG
+from jsb import LOG, load_yaml
 from jira import JIRA
-from argparse import ArgumentParser
-from salesforce import OAuth2, Client
-from bridge import Bridge
-from storage import FileBackend, Store
+import requests
+from argparse import SUPPRESS, ArgumentParser, ArgumentTypeError
+from salesforce import (POOL_SIZE, OAuth2, Client, FileTokenCache, RequestStats, TokenCache,
+                        create_session)
+from bridge import Bridge, shard_state
+from cassette import Cassette, compare_writes, record_session, replay_session
+from storage import (FileBackend, InMemoryBackend, JournalBackend, MergedBackend,
+                     ReadOnlyBackend, SqliteBackend, Store)
+from threads import ThreadLocalProxy
+from ratelimit import LatencyLimiter, RateLimitedAdapter, SalesforceLimiter
+from scheduler import run_periodically
+from metrics import (Metrics, PrometheusEndpoint, PrometheusTextfileSink, StatsdSink,
+                     SummarySink, jira_endpoint_name)
 
+# State files of a shard of a sync split into several processes
+SHARD_STATE = re.compile(r'^state_cftest\.shard-([0-9]+)-of-([0-9]+)\.(yml|log|db)$')
+
+# Keys of the state kept at their lowest value when states are merged,
+# so shards seeded from several states resync everything since then
+WATERMARK_KEYS = ('sync_watermark', 'full_sync_time')
+
+
+def configure_logger(level, shard=None):
+    log_format = '%(asctime)s %(levelname)s %(message)s'
+    if shard:
+        log_format = '%(asctime)s [shard {}/{}] %(levelname)s %(message)s'.format(*shard)
 
-def configure_logger(level):
     handler = logging.StreamHandler(sys.stdout)
     handler.setLevel(level)
-    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    handler.setFormatter(logging.Formatter(log_format))
 
     LOG.addHandler(handler)
     LOG.setLevel(level)
 
 
+def parse_shard(value):
+    """
+    (index, count) from ``index/count``
+    """
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise ArgumentTypeError('expected INDEX/COUNT, like 0/4')
+    if not 0 <= index < count:
+        raise ArgumentTypeError('shard index must be between 0 and {}'.format(count - 1))
+    return index, count
+
+
+def shard_suffix(shard):
+    if not shard:
+        return ''
+    return '.shard-{}-of-{}'.format(*shard)
+
+
+def shard_config(config, shard):
+    """
+    Copy of ``config`` for one shard, files and ports are not shared with
+    other shards and each shard gets its share of the API rate limits
+    """
+    index, count = shard
+    suffix = shard_suffix(shard)
+    config = dict(config)
+
+    config['jira_max_rate'] = float(config.get('jira_max_rate', 10)) / count
+    config['sfdc_max_rate'] = float(config.get('sfdc_max_rate', 25)) / count
+
+    token_cache_path = config.get('sfdc_token_cache',
+                                  os.path.join(config['storage_dir'], 'sfdc_token.json'))
+    if token_cache_path:
+        root, ext = os.path.splitext(token_cache_path)
+        config['sfdc_token_cache'] = root + suffix + ext
+    if config.get('metrics_textfile'):
+        root, ext = os.path.splitext(config['metrics_textfile'])
+        config['metrics_textfile'] = root + suffix + ext
+    if config.get('metrics_port'):
+        config['metrics_port'] += index
+    config['statsd_prefix'] = '{}.shard{}'.format(config.get('statsd_prefix', 'jsb'), index)
+    return config
+
+
+def state_paths(config, shard=None):
+    """
+    Paths of the snapshot, journal and database the state may be kept in
+    """
+    name = os.path.join(config['storage_dir'], 'state_cftest' + shard_suffix(shard))
+    return [name + '.yml', name + '.log', name + '.db']
+
+
+def create_backend(config, shard=None, legacy=None):
+    suffix = shard_suffix(shard)
+    storage_path = os.path.join(config['storage_dir'], 'state_cftest{}.yml'.format(suffix))
+    tmp_path = os.path.join(config['storage_dir'], 'tmp_state_cftest{}.yml'.format(suffix))
+
+    storage_format = config.get('storage_format', 'binary')
+
+    backend = config.get('storage_backend', 'file')
+    if backend == 'file':
+        return FileBackend(storage_path, tmp_path, format=storage_format, legacy=legacy)
+
+    if backend == 'journal':
+        log_path = os.path.join(config['storage_dir'], 'state_cftest{}.log'.format(suffix))
+        return JournalBackend(storage_path, tmp_path, log_path,
+                              compact_size=config.get('storage_compact_size',
+                                                      4 * 1024 * 1024),
+                              format=storage_format, legacy=legacy)
+
+    if backend == 'sqlite':
+        db_path = os.path.join(config['storage_dir'], 'state_cftest{}.db'.format(suffix))
+        return SqliteBackend(db_path, legacy=FileBackend(storage_path, tmp_path, legacy=legacy))
+
+    raise ValueError('Unknown storage backend: {}'.format(backend))
+
+
+def create_shard_backend(config, shard):
+    """
+    Backend of the state of a shard. A new shard starts from its part of
+    the state of the unsharded sync and of shards of any other shard
+    count, so comments copied before are not copied again. Their files are
+    only read, whatever backend wrote them.
+    """
+    layouts = set()
+    for name in os.listdir(config['storage_dir']):
+        match = SHARD_STATE.match(name)
+        if match and int(match.group(2)) != shard[1]:
+            layouts.add((int(match.group(1)), int(match.group(2))))
+
+    sources = [ReadOnlyBackend(*state_paths(config, layout),
+                               backend=config.get('storage_backend', 'file'))
+               for layout in [None] + sorted(layouts)
+               if any(os.path.exists(path) for path in state_paths(config, layout))]
+    if not sources:
+        return create_backend(config, shard)
+    return create_backend(config, shard, legacy=MergedBackend(
+        sources, lowest=WATERMARK_KEYS, select=lambda state: shard_state(state, shard)))
+
+
+def create_metrics(config):
+    metrics = Metrics()
+    if config.get('metrics_summary', True):
+        metrics.add_sink(SummarySink())
+    if config.get('metrics_textfile'):
+        metrics.add_sink(PrometheusTextfileSink(config['metrics_textfile']))
+    if config.get('metrics_port'):
+        metrics.add_sink(PrometheusEndpoint(metrics, config['metrics_port']).start())
+    if config.get('statsd_host'):
+        metrics.add_sink(StatsdSink(config['statsd_host'], config.get('statsd_port', 8125),
+                                    prefix=config.get('statsd_prefix', 'jsb')))
+    return metrics
+
+
+def create_replay_store(cassette, metrics):
+    """
+    In-memory store with the state a recorded cycle started with, the
+    state of the bridge is left untouched
+    """
+    backend = InMemoryBackend()
+    backend.data = cassette.load_state()
+    store = Store(backend, compact_sets=['seen_comments_id'], metrics=metrics)
+
+    # Incremental cycles compare the watermarks with the current time,
+    # shift them so the cycle is synced like the recorded one
+    shift = time.time() - cassette.recorded_at
+    for key in ('sync_watermark', 'full_sync_time'):
+        if store.get(key):
+            store.set(key, store.get(key) + shift)
+    return store
+
+
+def log_replayed_writes(cassette, adapters):
+    replayed = []
+    for adapter in adapters:
+        replayed.extend(adapter.writes)
+
+    missing, unexpected = compare_writes(cassette.writes(), replayed)
+    for api, method, url, body in missing:
+        LOG.warning('Recorded write not replayed: %s %s %s %s', api, method, url, body)
+    for api, method, url, body in unexpected:
+        LOG.warning('Write not in the recording: %s %s %s %s', api, method, url, body)
+    LOG.info('Replayed %s writes, %s missing, %s not recorded',
+             len(replayed), len(missing), len(unexpected))
+
+
+def shard_command(argv, shard, result_path):
+    """
+    Command line running one shard of the sync started by ``argv``
+    """
+    command = [sys.executable, argv[0]]
+    skip = False
+    for arg in argv[1:]:
+        name = arg.split('=', 1)[0]
+        if skip:
+            skip = False
+        elif len(name) > 3 and '--processes'.startswith(name):
+            skip = '=' not in arg
+        else:
+            command.append(arg)
+    return command + ['--shard', '{}/{}'.format(*shard), '--shard-result', result_path]
+
+
+def run_shards(argv, count):
+    """
+    Run every shard of the sync in its own process and wait for all of
+    them, returns 1 if any of them failed
+    """
+    directory = tempfile.mkdtemp(prefix='jsb-shards-')
+    result_paths = [os.path.join(directory, '{}.json'.format(index)) for index in range(count)]
+    try:
+        processes = [subprocess.Popen(shard_command(argv, (index, count), path))
+                     for index, path in enumerate(result_paths)]
+
+        # Every shard stops after the issues it is syncing and flushes its
+        # state, see main
+        def terminate(signum, frame):
+            for process in processes:
+                if process.poll() is None:
+                    process.terminate()
+
+        signal.signal(signal.SIGTERM, terminate)
+        returncodes = []
+        for process in processes:
+            try:
+                returncodes.append(process.wait())
+            except KeyboardInterrupt:
+                # Ctrl+C reached the shards as well, let them finish
+                returncodes.append(process.wait())
+
+        results = []
+        for path in result_paths:
+            try:
+                with open(path) as fp:
+                    results.append(json.load(fp))
+            except (IOError, OSError, ValueError):
+                results.append(None)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    totals = dict(issues=0, failed=0, skipped=0)
+    for index, (returncode, result) in enumerate(zip(returncodes, results)):
+        if returncode < 0:
+            LOG.error('Shard %s/%s was killed by signal %s', index, count, -returncode)
+        if result is None:
+            LOG.error('Shard %s/%s exited with %s without finishing a cycle',
+                      index, count, returncode)
+            continue
+        LOG.info('Shard %s/%s exited with %s: %s issues, %s failed, %s skipped',
+                 index, count, returncode, result['issues'], result['failed'],
+                 result['skipped'])
+        for key in totals:
+            totals[key] += result[key]
+
+    LOG.info('Synced %s issues in %s shards, %s failed, %s skipped',
+             totals['issues'], count, totals['failed'], totals['skipped'])
+    return 1 if any(returncodes) else 0
+
+
+def run_daemon(bridge, store, sync_cycle, interval):
+    # Clients, connection pools, worker threads and the state stay loaded
+    # between cycles
+    LOG.info('Running as a daemon, syncing every %ss', interval)
+    try:
+        run_periodically(sync_cycle, interval, bridge.stopping)
+    except KeyboardInterrupt:
+        LOG.error('Operation canceled by user')
+    finally:
+        store.flush()
+    LOG.info('Daemon stopped')
+
+
 def main():
     parser = ArgumentParser()
     parser.add_argument('-c', '--config-file', default='config.yml')
     parser.add_argument('-d', '--debug', action='store_true')
     parser.add_argument('-Q', '--query')
+    parser.add_argument('-w', '--workers', type=int,
+                        help='Number of issues synced concurrently')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='Use the asyncio SF client, --workers limits '
+                             'the number of issues in flight')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running and sync every --interval seconds')
+    parser.add_argument('--interval', type=float,
+                        help='Seconds between the starts of sync cycles in '
+                             'daemon mode')
+    parser.add_argument('--record', metavar='CASSETTE',
+                        help='Record the JIRA and SF requests of a cycle to this file')
+    parser.add_argument('--replay', metavar='CASSETTE',
+                        help='Sync against the requests recorded in this file, '
+                             'without network and without changing the state')
+    parser.add_argument('--replay-timing', action='store_true',
+                        help='Replayed responses take as long as the recorded ones')
+    parser.add_argument('--processes', type=int,
+                        help='Split the issues into this many shards, each '
+                             'synced by its own process')
+    parser.add_argument('--shard', type=parse_shard, metavar='INDEX/COUNT',
+                        help='Only sync the issues of this shard, with its own state, '
+                             'e.g. 0/4 to 3/4 on four hosts')
+    parser.add_argument('--shard-result', help=SUPPRESS)
 
     args = parser.parse_args()
+    if args.record and args.replay:
+        parser.error('--record and --replay are exclusive')
+    if (args.record or args.replay) and (args.daemon or args.asyncio):
+        parser.error('--record and --replay run a single cycle with the requests '
+                     'based clients')
+    if args.processes and (args.shard or args.record or args.replay):
+        parser.error('--processes runs every shard itself, without --shard, '
+                     '--record and --replay')
 
-    if args.debug:
-        configure_logger(logging.DEBUG)
-    else:
-        configure_logger(logging.INFO)
+    level = logging.DEBUG if args.debug else logging.INFO
+    configure_logger(level, shard=args.shard)
+
+    if args.processes and args.processes > 1:
+        return run_shards(sys.argv, args.processes)
 
     with open(args.config_file) as fp:
-        config = yaml.load(fp)
+        config = load_yaml(fp)
+    if args.shard:
+        config = shard_config(config, args.shard)
+
+    if args.replay:
+        # Replays only log their metrics, the exporters belong to the
+        # production sync
+        config = dict(config, metrics_textfile=None, metrics_port=None, statsd_host=None)
+
+    workers = args.workers or config.get('workers', 1)
+    metrics = create_metrics(config)
+    jira_stats = RequestStats(metrics, api='JIRA', normalize=jira_endpoint_name)
+
+    cassette = None
+    replay_adapters = []
+    if args.record:
+        cassette = Cassette()
+    elif args.replay:
+        cassette = Cassette.load(args.replay)
+
+    # Limiters are shared by all threads using the same API
+    jira_limiter = LatencyLimiter(rate=config.get('jira_max_rate', 10))
+    sfdc_limiter = SalesforceLimiter(rate=config.get('sfdc_max_rate', 25),
+                                     soft_limit=config.get('sfdc_api_soft_limit', 0.5),
+                                     hard_limit=config.get('sfdc_api_hard_limit', 0.95))
+    if args.replay:
+        # Without --replay-timing responses come as fast as they can
+        sfdc_limiter = SalesforceLimiter(rate=100000)
 
-    jira_client = JIRA(server=config['jira_url'],
-                       basic_auth=(config['jira_username'],
-                                   config['jira_password']))
+    def create_jira_client():
+        # Server info is fetched by the constructor unless told otherwise,
+        # cassettes need it to go through the adapters mounted below
+        jira = JIRA(server=config['jira_url'],
+                    basic_auth=(config['jira_username'],
+                                config['jira_password']),
+                    get_server_info=cassette is None)
+        if args.replay:
+            replay_adapters.append(replay_session(jira._session, cassette, 'JIRA',
+                                                  timing=args.replay_timing))
+        else:
+            adapter = RateLimitedAdapter(jira_limiter, stats=jira_stats)
+            jira._session.mount('https://', adapter)
+            jira._session.mount('http://', adapter)
+            if args.record:
+                record_session(jira._session, cassette, 'JIRA')
+
+        if cassette is not None:
+            server_info = jira.server_info()
+            jira._version = tuple(server_info['versionNumbers'])
+            jira.deploymentType = server_info.get('deploymentType')
+        return jira
 
     sfdc_oauth2 = OAuth2(client_id=config['sfdc_client_id'],
                          client_secret=config['sfdc_client_secret'],
@@ -47,19 +384,126 @@ def main():
                          password=config['sfdc_password'],
                          auth_url=config['sfdc_auth_url'])
     
-    sfdc_client = Client(sfdc_oauth2)
+    sfdc_pool_size = max(config.get('sfdc_pool_size', POOL_SIZE), workers)
+    sfdc_session = create_session(pool_size=sfdc_pool_size,
+                                  max_retries=config.get('sfdc_max_retries', 3),
+                                  backoff_factor=config.get('sfdc_backoff_factor', 0.5))
+    sfdc_stats = RequestStats(metrics)
+
+    if args.replay:
+        sfdc_session = requests.Session()
+        replay_adapters.append(replay_session(sfdc_session, cassette, 'SF',
+                                              timing=args.replay_timing))
+    elif args.record:
+        record_session(sfdc_session, cassette, 'SF')
+
+    # All clients share one token and refresh it together, the file keeps
+    # it for the next run. Cassettes always start with an authentication.
+    token_cache_path = config.get('sfdc_token_cache',
+                                  os.path.join(config['storage_dir'], 'sfdc_token.json'))
+    if token_cache_path and cassette is None:
+        sfdc_token_cache = FileTokenCache(token_cache_path)
+    else:
+        sfdc_token_cache = TokenCache()
 
-    storage_path = os.path.join(config['storage_dir'], 'state_cftest.yml')
-    tmp_path = os.path.join(config['storage_dir'], 'tmp_state_cftest.yml')
+    def create_sfdc_client():
+        return Client(sfdc_oauth2, session=sfdc_session,
+                      timeout=config.get('sfdc_timeout', 60), stats=sfdc_stats,
+                      token_cache=sfdc_token_cache, limiter=sfdc_limiter)
 
-    store = Store(FileBackend(storage_path, tmp_path))
+    if workers > 1 or args.asyncio:
+        # Every worker thread gets its own clients, the SF ones share
+        # the connection pool
+        jira_client = ThreadLocalProxy(create_jira_client)
+        sfdc_client = ThreadLocalProxy(create_sfdc_client)
+    else:
+        jira_client = create_jira_client()
+        sfdc_client = create_sfdc_client()
+
+    if args.replay:
+        store = create_replay_store(cassette, metrics)
+    else:
+        if args.shard:
+            backend = create_shard_backend(config, args.shard)
+        else:
+            backend = create_backend(config)
+        store = Store(backend,
+                      flush_every=config.get('storage_flush_every'),
+                      flush_interval=config.get('storage_flush_interval'),
+                      compact_sets=['seen_comments_id'],
+                      metrics=metrics)
 
-    bridge = Bridge(sfdc_client, jira_client, store, config)
+    if args.asyncio:
+        from jsb import aio
+
+        # The SF client is set by the runner, whose event loop, session and
+        # threads serve every cycle
+        bridge = Bridge(None, jira_client, store, config, workers=1, metrics=metrics,
+                        shard=args.shard)
+        client = aio.AsyncClient(sfdc_oauth2,
+                                 limit=sfdc_pool_size,
+                                 timeout=config.get('sfdc_timeout', 60),
+                                 stats=sfdc_stats, token_cache=sfdc_token_cache,
+                                 limiter=sfdc_limiter)
+        aio_runner = aio.Runner(bridge, client, concurrency=workers,
+                                threads=config.get('asyncio_threads', aio.THREADS))
+    else:
+        bridge = Bridge(sfdc_client, jira_client, store, config, workers=workers,
+                        metrics=metrics, shard=args.shard)
 
     if args.query:
         bridge.issue_jql = args.query
 
-    bridge.sync_issues()
+    def sync_cycle():
+        if args.asyncio:
+            aio_runner.run()
+        else:
+            bridge.sync_issues()
+
+        sfdc_stats.log_summary()
+        sfdc_stats.reset()
+        jira_stats.log_summary()
+        jira_stats.reset()
+        sfdc_limiter.log_summary()
+        jira_limiter.log_summary('JIRA API')
+
+        sfdc_limiter.export(metrics)
+        jira_limiter.export(metrics, 'JIRA')
+        metrics.flush()
+
+        if args.shard_result:
+            # Read by the process which started the shards
+            with open(args.shard_result, 'w') as fp:
+                json.dump(bridge.last_cycle, fp)
+
+    # In every mode SIGTERM lets the issues being synced finish, skips the
+    # others and flushes the state
+    signal.signal(signal.SIGTERM, lambda signum, frame: bridge.stop())
+    try:
+        if args.record:
+            with store.lock:
+                cassette.save_state(store.data)
+            try:
+                sync_cycle()
+            finally:
+                cassette.save(args.record)
+        elif args.replay:
+            sync_cycle()
+            log_replayed_writes(cassette, replay_adapters)
+        elif not args.daemon:
+            sync_cycle()
+        else:
+            run_daemon(bridge, store, sync_cycle,
+                       args.interval or config.get('sync_interval', 300))
+    finally:
+        if args.asyncio:
+            aio_runner.close()
+        bridge.close()
+
+    if args.shard and not args.daemon and bridge.last_cycle['failed']:
+        # Tells the process which started the shards
+        return 1
+
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -1,4 +1,363 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from jsb import LOG
+from jsb.ratelimit import SalesforceLimiter
+
+# Salesforce record ids are 15 or 18 characters long, query cursors
+# have a batch offset appended to them
+RECORD_ID = re.compile(r'/[a-zA-Z0-9]{15}(?:[a-zA-Z0-9]{3})?(?:-[0-9]+)?(?=/|$)')
+VALID_ID = re.compile(r'^[a-zA-Z0-9]{15}(?:[a-zA-Z0-9]{3})?$')
+
+# sObject Collections are available since API v42.0
+COLLECTIONS_URL = '/services/data/v42.0/composite/sobjects'
+COLLECTION_SIZE = 200
+
+# Fields of proxyTicket__c used by the bridge, SOQL has no SELECT *
+TICKET_FIELDS = ('Id', 'Status__c', 'Closed__c', 'Priority__c', 'Assignee__c',
+                 'Subject__c', 'Description__c', 'CaseNumber__c',
+                 'External_id__c', 'LastModifiedDate')
+
+# Number of ids put into a single "IN (...)" condition, keeps query urls short
+QUERY_CHUNK_SIZE = 200
+
+COMMENT_STATS_QUERY = ("SELECT related_id__c, COUNT(Id) total, MAX(LastModifiedDate) last_modified "
+                       "FROM proxyTicketComment__c WHERE related_id__c IN ({}) "
+                       "GROUP BY related_id__c")
+
+TICKETS_URL = '/services/data/v35.0/sobjects/proxyTicket__c'
+COMMENTS_URL = '/services/data/v35.0/sobjects/proxyTicketComment__c'
+QUERY_URL = '/services/data/v35.0/query'
+
+# Updating fields of a record is idempotent, so PATCH is safe to retry.
+# 429 is left to the rate limiter of the client, which pauses all threads.
+RETRY_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'PATCH'])
+RETRY_STATUSES = frozenset([500, 502, 503, 504])
+
+# Throttled requests were not processed, so any of them can be replayed
+THROTTLED_RETRIES = 3
+
+# Default number of pooled connections to SF, of both clients
+POOL_SIZE = 10
+
+
+def create_session(pool_size=POOL_SIZE, max_retries=3, backoff_factor=0.5):
+    """
+    Create a keep-alive session with a connection pool and retry policy
+    """
+    retry_options = dict(total=max_retries,
+                         backoff_factor=backoff_factor,
+                         status_forcelist=RETRY_STATUSES,
+                         raise_on_status=False)
+    try:
+        retry = Retry(allowed_methods=RETRY_METHODS, **retry_options)
+    except TypeError:
+        # urllib3 < 1.26
+        retry = Retry(method_whitelist=RETRY_METHODS, **retry_options)
+
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    return session
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def quote_list(values):
+    return ', '.join("'{}'".format(value.replace('\\', '\\\\').replace("'", "\\'"))
+                     for value in values)
+
+
+def soql_datetime(timestamp):
+    """
+    Format Unix time as a SOQL dateTime literal
+    """
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+
+def valid_ids(ids):
+    return sorted(set(id for id in ids if id and VALID_ID.match(id)))
+
+
+# SOQL queries and the handling of their results are shared by `Client`
+# and the asyncio client in `jsb.aio`, which only differ in how they
+# send the queries
+
+def tickets_queries(ids):
+    return ["SELECT {} FROM proxyTicket__c WHERE Id IN ({})".format(
+        ', '.join(TICKET_FIELDS), quote_list(chunk))
+        for chunk in chunks(valid_ids(ids), QUERY_CHUNK_SIZE)]
+
+
+def comment_stats_queries(ticket_ids):
+    return [COMMENT_STATS_QUERY.format(quote_list(chunk))
+            for chunk in chunks(valid_ids(ticket_ids), QUERY_CHUNK_SIZE)]
+
+
+def comment_stats(ticket_ids, records):
+    """
+    Dict of 15 character ticket id to (count, last modified) from the
+    records of `comment_stats_queries`
+    """
+    result = dict((id[:15], (0, None)) for id in valid_ids(ticket_ids))
+    for record in records:
+        result[record['related_id__c'][:15]] = (record['total'], record['last_modified'])
+    return result
+
+
+def modified_tickets_query(since):
+    return ("SELECT Id, External_id__c FROM proxyTicket__c "
+            "WHERE LastModifiedDate > {}".format(soql_datetime(since)))
+
+
+def modified_ticket_comments_query(since):
+    return ("SELECT Id, related_id__c FROM proxyTicketComment__c "
+            "WHERE LastModifiedDate > {}".format(soql_datetime(since)))
+
+
+def ticket_comments_query(ticket_id):
+    return ("SELECT Comment__c, CreatedById, external_id__c, Id, CreatedDate, createdby.name "
+            "FROM proxyTicketComment__c "
+            "WHERE related_id__c='{}'".format(ticket_id))
+
+
+def ticket_comment_query(comment_id):
+    return ("SELECT Comment__c, CreatedById, Id "
+            "FROM proxyTicketComment__c "
+            "WHERE external_id__c='{}'".format(comment_id))
+
+
+def comments_by_external_id_queries(external_ids):
+    external_ids = sorted(set(id for id in external_ids if id))
+    return ["SELECT Comment__c, CreatedById, Id, external_id__c "
+            "FROM proxyTicketComment__c "
+            "WHERE external_id__c IN ({})".format(quote_list(chunk))
+            for chunk in chunks(external_ids, QUERY_CHUNK_SIZE)]
+
+
+def comments_by_external_id(records):
+    result = {}
+    for record in records:
+        result.setdefault(record['external_id__c'], record)
+    return result
+
+
+def session_token(result):
+    """
+    Token kept in a `TokenCache` from the result of `OAuth2.authenticate`
+    """
+    return {'access_token': result['access_token'],
+            'instance_url': result['instance_url']}
+
+
+def auth_headers(token, headers=None):
+    headers = dict(headers or {})
+    headers['Authorization'] = 'Bearer {}'.format(token['access_token'])
+    return headers
+
+
+class RetryPolicy(object):
+    """
+    What to do with each response of a request, shared by both clients.
+
+    An expired or revoked session is replayed once with a new token,
+    throttled requests were not processed and are sent again up to
+    ``retries`` times.
+    """
+    AUTHENTICATE = 'authenticate'
+    RETRY = 'retry'
+
+    def __init__(self, retries=THROTTLED_RETRIES):
+        self.retries = retries
+        self.sent = 0
+        self.throttled = 0
+
+    def action(self, status):
+        """
+        `AUTHENTICATE` or `RETRY` after a response with ``status``, None
+        when the response is final
+        """
+        self.sent += 1
+        if status == 401 and self.sent == 1:
+            LOG.info('SF session expired, authenticating again')
+            return self.AUTHENTICATE
+
+        if status == 429 and self.throttled < self.retries:
+            # The limiter has paused requests, this one waits for its turn
+            self.throttled += 1
+            return self.RETRY
+
+
+def endpoint_name(url):
+    """
+    Strip the query string and record ids from an API url, so calls to the
+    same endpoint can be grouped together
+    """
+    return RECORD_ID.sub('/{id}', url.split('?', 1)[0])
+
+
+class RequestStats(object):
+    """
+    Number of requests and time spent on them per endpoint
+
+    :param metrics: `jsb.metrics.Metrics` also getting every request
+    :param api: name of the API in logs and metrics
+    :param normalize: function turning a request url into an endpoint name
+    """
+    def __init__(self, metrics=None, api='SF', normalize=endpoint_name):
+        self.count = defaultdict(int)
+        self.elapsed = defaultdict(float)
+        self.lock = threading.Lock()
+        self.metrics = metrics
+        self.api = api
+        self.normalize = normalize
+
+    def record(self, method, url, elapsed):
+        key = (method.upper(), self.normalize(url))
+        with self.lock:
+            self.count[key] += 1
+            self.elapsed[key] += elapsed
+
+        if self.metrics:
+            self.metrics.observe('api_request_seconds', elapsed, api=self.api,
+                                 method=key[0], endpoint=key[1])
+
+    def reset(self):
+        with self.lock:
+            self.count.clear()
+            self.elapsed.clear()
+
+    def log_summary(self):
+        for key in sorted(self.count):
+            LOG.info('%s %s %s: %s requests, %.3fs total, %.3fs avg',
+                     self.api, key[0], key[1], self.count[key], self.elapsed[key],
+                     self.elapsed[key] / self.count[key])
+
+
+class WriteError(Exception):
+    """
+    Record write of a `WriteBatch` rejected by SF
+    """
+
+
+class BatchItem(object):
+    """
+    Single record write queued in a `WriteBatch`.
+
+    ``success``, ``id`` and ``errors`` are filled in when the batch is flushed,
+    ``on_success`` is called with the item right after SF saved it.
+    """
+    def __init__(self, method, sobject, data, id=None, on_success=None):
+        self.method = method
+        self.sobject = sobject
+        self.data = data
+        self.id = id
+        self.on_success = on_success
+
+        self.success = None
+        self.errors = []
+
+    def record(self):
+        record = dict(self.data)
+        record['attributes'] = {'type': self.sobject}
+        if self.id:
+            record['Id'] = self.id
+        return record
+
+
+class WriteBatch(object):
+    """
+    Queues record writes and sends them through the sObject Collections API,
+    up to ``size`` records per request.
+
+    Writes are sent in the order they were queued; consecutive creates and
+    updates are grouped together. Failures are reported per item, a failed
+    record does not prevent the other ones from being saved.
+    """
+    def __init__(self, client, size=COLLECTION_SIZE):
+        self.client = client
+        self.size = size
+        self.items = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def _add(self, item):
+        self.items.append(item)
+        return item
+
+    def update_ticket(self, id, data, on_success=None):
+        return self._add(BatchItem('patch', 'proxyTicket__c', data, id=id,
+                                   on_success=on_success))
+
+    def update_comment(self, id, data, on_success=None):
+        return self._add(BatchItem('patch', 'proxyTicketComment__c', data, id=id,
+                                   on_success=on_success))
+
+    def create_ticket_comment(self, data, on_success=None):
+        return self._add(BatchItem('post', 'proxyTicketComment__c', data,
+                                   on_success=on_success))
+
+    def flush(self, each_chunk=None):
+        """
+        Send the queued writes, ``each_chunk`` is called with the items of
+        every request once their results are in
+        """
+        items, self.items = self.items, []
+
+        chunks = []
+        for item in items:
+            if (not chunks or chunks[-1][0].method != item.method or
+                    len(chunks[-1]) >= self.size):
+                chunks.append([])
+            chunks[-1].append(item)
+
+        for chunk in chunks:
+            records = [item.record() for item in chunk]
+            if chunk[0].method == 'post':
+                results = self.client.create_records(records)
+            else:
+                results = self.client.update_records(records)
+
+            for item, result in zip(chunk, results):
+                item.success = result['success']
+                item.errors = result.get('errors') or []
+                if result.get('id'):
+                    item.id = result['id']
+
+                if not item.success:
+                    LOG.error('Failed to %s %s %s: %s',
+                              'create' if item.method == 'post' else 'update',
+                              item.sobject, item.id or '', item.errors)
+                elif item.on_success:
+                    item.on_success(item)
+
+            if each_chunk:
+                each_chunk(chunk)
+
+        return items
 
 
 class OAuth2(object):
@@ -12,7 +371,10 @@ class OAuth2(object):
         self.username = username
         self.password = password
 
-    def authenticate(self):
+    def token_request(self):
+        """
+        Url and form data of the password grant request
+        """
         data = {
             'grant_type': 'password',
             'client_id': self.client_id,
@@ -21,54 +383,162 @@ class OAuth2(object):
             'password': self.password,
         }
 
-        url = '{}/services/oauth2/token'.format(self.auth_url)
-        response = requests.post(url, data=data)
+        return '{}/services/oauth2/token'.format(self.auth_url), data
+
+    def authenticate(self, session=None):
+        url, data = self.token_request()
+        response = (session or requests).post(url, data=data)
         response.raise_for_status()
 
         return response.json()
 
 
+class TokenCache(object):
+    """
+    OAuth2 token kept in memory. One cache can be shared by several
+    clients, ``lock`` makes them share a single refresh as well.
+    """
+    def __init__(self):
+        self.token = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        return self.token
+
+    def save(self, token):
+        self.token = token
+
+
+class FileTokenCache(TokenCache):
+    """
+    OAuth2 token also stored in a file readable only by its owner, so it
+    is reused by the next process
+    """
+    def __init__(self, path):
+        super(FileTokenCache, self).__init__()
+        self.path = path
+
+    def load(self):
+        if self.token is None:
+            try:
+                with open(self.path) as fp:
+                    self.token = json.load(fp)
+            except (IOError, OSError, ValueError):
+                pass
+
+        return self.token
+
+    def save(self, token):
+        self.token = token
+
+        tmp_path = '{}.tmp'.format(self.path)
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(token, fp)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            LOG.exception('Failed to save SF token to %s', self.path)
+
+
 class Client(object):
-    def __init__(self, oauth2):
+    def __init__(self, oauth2, session=None, timeout=None, stats=None, token_cache=None,
+                 limiter=None):
         self.oauth2 = oauth2
-
-        self.access_token = None
-        self.instance_url = None
+        self.session = session or create_session()
+        self.timeout = timeout
+        self.stats = stats or RequestStats()
+        self.token_cache = token_cache or TokenCache()
+        self.limiter = limiter or SalesforceLimiter()
 
     def ticket(self, id):
         try:
-            return self.get('/services/data/v35.0/sobjects/proxyTicket__c/{}'.format(id)).json()
+            return self.get('{}/{}'.format(TICKETS_URL, id)).json()
         except requests.HTTPError:
             return False
 
+    def tickets(self, ids):
+        """
+        Fetch many tickets with one query per chunk of ids
+
+        :param ids: iterable of ticket ids, malformed ids are ignored
+        :return: generator of ticket records
+        """
+        for query in tickets_queries(ids):
+            for record in self.search(query):
+                yield record
+
     def create_ticket(self, data):
-        return self.post('/services/data/v35.0/sobjects/proxyTicket__c', json=data).json()
+        return self.post(TICKETS_URL, json=data).json()
 
     def update_ticket(self, id, data):
-        return self.patch('/services/data/v35.0/sobjects/proxyTicket__c/{}'.format(id), json=data)
+        return self.patch('{}/{}'.format(TICKETS_URL, id), json=data)
 
     def update_comment(self, id, data):
-        return self.patch('/services/data/v35.0/sobjects/proxyTicketComment__c/{}'.format(id), json=data)
+        return self.patch('{}/{}'.format(COMMENTS_URL, id), json=data)
 
     def create_ticket_comment(self, data):
-        return self.post('/services/data/v35.0/sobjects/proxyTicketComment__c', json=data).json()
+        return self.post(COMMENTS_URL, json=data).json()
+
+    def batch(self, size=COLLECTION_SIZE):
+        return WriteBatch(self, size=size)
+
+    def create_records(self, records):
+        return self.post(COLLECTIONS_URL,
+                         json={'allOrNone': False, 'records': records}).json()
+
+    def update_records(self, records):
+        return self.patch(COLLECTIONS_URL,
+                          json={'allOrNone': False, 'records': records}).json()
+
+    def ticket_comment_stats(self, ticket_ids):
+        """
+        Number of comments and the last time one was modified for many
+        tickets, with one aggregate query per chunk of ids
+
+        :return: dict of 15 character ticket id to (count, last modified)
+        """
+        ticket_ids = valid_ids(ticket_ids)
+        return comment_stats(ticket_ids, [record for query in comment_stats_queries(ticket_ids)
+                                          for record in self.search(query)])
+
+    def modified_tickets(self, since):
+        """
+        Tickets changed after ``since`` (Unix time)
+
+        :return: generator of records with Id and External_id__c
+        """
+        return self.search(modified_tickets_query(since))
+
+    def modified_ticket_comments(self, since):
+        """
+        Ticket comments created or changed after ``since`` (Unix time)
+
+        :return: generator of records with Id and related_id__c
+        """
+        return self.search(modified_ticket_comments_query(since))
 
     def environment(self, id):
         return self.get('/services/data/v35.0/sobjects/Environment__c/{}'.format(id)).json()
 
     def ticket_comments(self, ticket_id):
-        return self.search("SELECT Comment__c, CreatedById, external_id__c, Id, CreatedDate, createdby.name "
-                           "FROM proxyTicketComment__c "
-                           "WHERE related_id__c='{}'".format(ticket_id))
+        return self.search(ticket_comments_query(ticket_id))
 
     def ticket_comment(self, comment_id):
-        return self.get('/services/data/v35.0/query',
-                        params=dict(q="SELECT Comment__c, CreatedById, Id "
-                                      "FROM proxyTicketComment__c "
-                                      "WHERE external_id__c='{}'".format(comment_id))).json()
+        return self.get(QUERY_URL, params=dict(q=ticket_comment_query(comment_id))).json()
+
+    def ticket_comments_by_external_id(self, external_ids):
+        """
+        Look up SF comments of many JIRA comments with one query per chunk
+
+        :param external_ids: iterable of JIRA comment ids
+        :return: dict of JIRA comment id to SF comment record
+        """
+        return comments_by_external_id(record for query in comments_by_external_id_queries(external_ids)
+                                       for record in self.search(query))
 
     def search(self, query):
-        response = self.get('/services/data/v35.0/query', params=dict(q=query)).json()
+        response = self.get(QUERY_URL, params=dict(q=query)).json()
         while True:
             for record in response['records']:
                 yield record
@@ -87,21 +557,46 @@ class Client(object):
     def post(self, url, **kwargs):
         return self._request('post', url, **kwargs)
 
+    def token(self, stale=None):
+        """
+        Cached token, authenticating if there is none yet or the cached one
+        is the ``stale`` access token
+        """
+        with self.token_cache.lock:
+            token = self.token_cache.load()
+            if not token or token['access_token'] == stale:
+                token = session_token(self.oauth2.authenticate(session=self.session))
+                self.token_cache.save(token)
+
+            return token
+
     def _request(self, method, url, headers=None, **kwargs):
-        if not headers:
-            headers = {}
+        kwargs.setdefault('timeout', self.timeout)
 
-        if not self.access_token or not self.instance_url:
-            result = self.oauth2.authenticate()
+        token = self.token()
+        policy = RetryPolicy()
+        while True:
+            response = self._send(token, method, url, headers, **kwargs)
+            action = policy.action(response.status_code)
+            if action is None:
+                break
+            if action == RetryPolicy.AUTHENTICATE:
+                token = self.token(stale=token['access_token'])
 
-            self.access_token = result['access_token']
-            self.instance_url = result['instance_url']
+        response.raise_for_status()
 
-        headers['Authorization'] = 'Bearer {}'.format(self.access_token)
+        return response
 
-        url = self.instance_url + url
+    def _send(self, token, method, url, headers=None, **kwargs):
+        self.limiter.acquire()
+        start = time.time()
+        response = self.session.request(method, token['instance_url'] + url,
+                                        headers=auth_headers(token, headers), **kwargs)
+        elapsed = time.time() - start
+        self.limiter.observe(response, elapsed)
 
-        response = requests.request(method, url, headers=headers, **kwargs)
-        response.raise_for_status()
+        self.stats.record(method, response.request.path_url, elapsed)
+        LOG.debug('SF %s %s: %s in %.3fs', method.upper(),
+                  response.request.path_url, response.status_code, elapsed)
 
         return response
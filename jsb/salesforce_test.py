@@ -0,0 +1,266 @@
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+
+import requests
+from requests.adapters import BaseAdapter
+
+from jsb import salesforce
+from jsb.ratelimit import SalesforceLimiter
+from jsb.ratelimit_test import FakeClock
+
+
+class FakeAdapter(BaseAdapter):
+    """
+    Transport adapter answering requests from a list of handlers
+    """
+    def __init__(self):
+        super(FakeAdapter, self).__init__()
+        self.requests = []
+        self.handlers = []
+
+    def add(self, method, path, status=200, body=None, headers=None, once=False):
+        self.handlers.append((method, path, status, body, headers or {}, once))
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+
+        for handler in self.handlers:
+            method, path, status, body, headers, once = handler
+            if request.method == method and request.path_url.startswith(path):
+                if once:
+                    self.handlers.remove(handler)
+                break
+        else:
+            status, body, headers = 404, [], {}
+
+        response = requests.Response()
+        response.status_code = status
+        response.headers.update(headers)
+        response._content = json.dumps(body).encode('utf-8')
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+class FakeOAuth2(object):
+    def __init__(self):
+        self.calls = 0
+
+    def authenticate(self, session=None):
+        self.calls += 1
+        return {'access_token': 'token{}'.format(self.calls),
+                'instance_url': 'https://sf.example.com'}
+
+
+class ClientTest(unittest.TestCase):
+    def setUp(self):
+        self.adapter = FakeAdapter()
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.oauth2 = FakeOAuth2()
+        self.client = salesforce.Client(self.oauth2, session=self.session)
+
+    def test_session_reuse(self):
+        self.adapter.add('GET', '/services/data/v35.0/sobjects/proxyTicket__c/',
+                         body={'Id': 'a0B000000000001AAA'})
+
+        for _ in range(3):
+            assert self.client.ticket('a0B000000000001AAA')['Id'] == 'a0B000000000001AAA'
+
+        assert self.oauth2.calls == 1
+        assert len(self.adapter.requests) == 3
+        assert self.adapter.requests[0].headers['Authorization'] == 'Bearer token1'
+
+    def test_stats(self):
+        self.adapter.add('GET', '/services/data/v35.0/sobjects/proxyTicket__c/', body={})
+        self.client.ticket('a0B000000000001AAA')
+        self.client.ticket('a0B000000000002')
+
+        key = ('GET', '/services/data/v35.0/sobjects/proxyTicket__c/{id}')
+        assert self.client.stats.count == {key: 2}
+        assert self.client.stats.elapsed[key] >= 0
+
+    def test_tickets(self):
+        self.adapter.add('GET', '/services/data/v35.0/query',
+                         body={'records': [{'Id': 'a0B000000000001AAA'}], 'done': True})
+
+        ids = ['a0B000000000001AAA', 'a0B000000000002', "x' OR Id != '", None]
+        assert list(self.client.tickets(ids)) == [{'Id': 'a0B000000000001AAA'}]
+
+        assert len(self.adapter.requests) == 1
+        query = requests.utils.unquote(self.adapter.requests[0].path_url).replace('+', ' ')
+        assert "WHERE Id IN ('a0B000000000001AAA', 'a0B000000000002')" in query
+        assert 'Status__c' in query
+
+    def test_ticket_comments_by_external_id(self):
+        self.adapter.add('GET', '/services/data/v35.0/query', body={'done': True, 'records': [
+            {'Id': 'C1', 'external_id__c': '10'},
+            {'Id': 'C2', 'external_id__c': '10'},
+            {'Id': 'C3', 'external_id__c': '12'},
+        ]})
+
+        result = self.client.ticket_comments_by_external_id(['10', '11', '12', '10'])
+        assert result == {'10': {'Id': 'C1', 'external_id__c': '10'},
+                          '12': {'Id': 'C3', 'external_id__c': '12'}}
+
+        query = requests.utils.unquote(self.adapter.requests[0].path_url).replace('+', ' ')
+        assert "WHERE external_id__c IN ('10', '11', '12')" in query
+
+    def test_modified_tickets(self):
+        self.adapter.add('GET', '/services/data/v35.0/query', body={'done': True, 'records': []})
+
+        list(self.client.modified_tickets(1451606400))
+
+        query = requests.utils.unquote(self.adapter.requests[0].path_url).replace('+', ' ')
+        assert query.endswith('FROM proxyTicket__c WHERE LastModifiedDate > 2016-01-01T00:00:00Z')
+
+    def test_expired_session(self):
+        self.adapter.add('GET', '/services/data/v35.0/sobjects/proxyTicket__c/', status=401,
+                         body=[{'errorCode': 'INVALID_SESSION_ID'}], once=True)
+        self.adapter.add('GET', '/services/data/v35.0/sobjects/proxyTicket__c/',
+                         body={'Id': 'a0B000000000001AAA'})
+
+        assert self.client.ticket('a0B000000000001AAA')['Id'] == 'a0B000000000001AAA'
+
+        assert self.oauth2.calls == 2
+        assert [r.headers['Authorization'] for r in self.adapter.requests] == [
+            'Bearer token1', 'Bearer token2']
+
+    def test_reauthenticate_once(self):
+        self.adapter.add('PATCH', '/services/data/v35.0/sobjects/proxyTicket__c/', status=401)
+
+        with self.assertRaises(requests.HTTPError):
+            self.client.update_ticket('a0B000000000001AAA', {})
+
+        assert self.oauth2.calls == 2
+        assert len(self.adapter.requests) == 2
+
+    def test_shared_token_cache(self):
+        self.adapter.add('GET', '/services/data/v35.0/sobjects/proxyTicket__c/', body={})
+        token_cache = salesforce.TokenCache()
+        clients = [salesforce.Client(self.oauth2, session=self.session, token_cache=token_cache)
+                   for _ in range(5)]
+
+        threads = [threading.Thread(target=client.ticket, args=('a0B000000000001AAA',))
+                   for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert self.oauth2.calls == 1
+        assert len(self.adapter.requests) == 5
+
+    def test_file_token_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'token.json')
+        self.adapter.add('GET', '/services/data/v35.0/sobjects/proxyTicket__c/', body={})
+
+        client = salesforce.Client(self.oauth2, session=self.session,
+                                   token_cache=salesforce.FileTokenCache(path))
+        client.ticket('a0B000000000001AAA')
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+        client = salesforce.Client(self.oauth2, session=self.session,
+                                   token_cache=salesforce.FileTokenCache(path))
+        client.ticket('a0B000000000001AAA')
+
+        assert self.oauth2.calls == 1
+        assert self.adapter.requests[-1].headers['Authorization'] == 'Bearer token1'
+
+    def test_throttled_request_is_replayed(self):
+        clock = FakeClock()
+        self.client.limiter = SalesforceLimiter(clock=clock, sleep=clock.sleep)
+        self.adapter.add('POST', '/services/data/v35.0/sobjects/proxyTicket__c', status=429,
+                         headers={'Retry-After': '2'}, once=True)
+        self.adapter.add('POST', '/services/data/v35.0/sobjects/proxyTicket__c',
+                         body={'id': 'a0B000000000001AAA'},
+                         headers={'Sforce-Limit-Info': 'api-usage=900/1000'})
+
+        assert self.client.create_ticket({})['id'] == 'a0B000000000001AAA'
+
+        assert len(self.adapter.requests) == 2
+        assert clock.sleeps == [2.0]
+        assert self.client.limiter.api_usage == 900
+        assert self.client.limiter.rate < self.client.limiter.max_rate
+
+    def test_endpoint_name(self):
+        assert (salesforce.endpoint_name('/services/data/v35.0/query?q=SELECT') ==
+                '/services/data/v35.0/query')
+        assert (salesforce.endpoint_name('/services/data/v35.0/query/01gD0000002HU6KIAW-2000') ==
+                '/services/data/v35.0/query/{id}')
+
+    def test_create_session(self):
+        session = salesforce.create_session(pool_size=4, max_retries=2)
+        adapter = session.get_adapter('https://sf.example.com')
+
+        assert adapter._pool_maxsize == 4
+        assert adapter.max_retries.total == 2
+        assert 503 in adapter.max_retries.status_forcelist
+        assert 429 not in adapter.max_retries.status_forcelist
+        assert 'gzip' in session.headers['Accept-Encoding']
+
+
+class WriteBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.adapter = FakeAdapter()
+        session = requests.Session()
+        session.mount('https://', self.adapter)
+        self.client = salesforce.Client(FakeOAuth2(), session=session)
+
+    def test_flush(self):
+        self.adapter.add('POST', salesforce.COLLECTIONS_URL, body=[
+            {'id': 'C1', 'success': True, 'errors': []},
+            {'id': 'C2', 'success': True, 'errors': []},
+        ])
+        self.adapter.add('PATCH', salesforce.COLLECTIONS_URL, body=[
+            {'id': 'T1', 'success': True, 'errors': []},
+            {'success': False, 'errors': [{'statusCode': 'ENTITY_IS_DELETED'}]},
+        ])
+
+        batch = self.client.batch()
+        created = [batch.create_ticket_comment({'Comment__c': str(i)}) for i in range(2)]
+        ticket = batch.update_ticket('T1', {'Status__c': 'Open'})
+        comment = batch.update_comment('C0', {'related_id__c': 'T1'})
+        batch.flush()
+
+        assert len(self.adapter.requests) == 2
+        body = json.loads(self.adapter.requests[1].body.decode('utf-8'))
+        assert body == {'allOrNone': False, 'records': [
+            {'Id': 'T1', 'Status__c': 'Open', 'attributes': {'type': 'proxyTicket__c'}},
+            {'Id': 'C0', 'related_id__c': 'T1', 'attributes': {'type': 'proxyTicketComment__c'}},
+        ]}
+
+        assert [item.id for item in created] == ['C1', 'C2']
+        assert all(item.success for item in created)
+        assert ticket.success
+        assert not comment.success
+        assert comment.errors == [{'statusCode': 'ENTITY_IS_DELETED'}]
+        assert not len(batch)
+
+    def test_chunks(self):
+        self.adapter.add('POST', salesforce.COLLECTIONS_URL,
+                         body=[{'id': 'C', 'success': True}] * 2)
+        self.adapter.add('PATCH', salesforce.COLLECTIONS_URL,
+                         body=[{'id': 'C', 'success': True}])
+
+        batch = self.client.batch(size=2)
+        for i in range(3):
+            batch.create_ticket_comment({'Comment__c': str(i)})
+        batch.update_comment('C1', {})
+        batch.create_ticket_comment({'Comment__c': '4'})
+        batch.flush()
+
+        sizes = [len(json.loads(r.body.decode('utf-8'))['records']) for r in self.adapter.requests]
+        methods = [r.method for r in self.adapter.requests]
+        assert sizes == [2, 1, 1, 1]
+        assert methods == ['POST', 'POST', 'PATCH', 'POST']
@@ -0,0 +1,33 @@
+import time
+
+from jsb import LOG
+
+
+def run_periodically(func, interval, stopping, clock=time.time):
+    """
+    Call ``func`` every ``interval`` seconds until ``stopping`` is set.
+
+    Cycles never overlap: if a call takes longer than ``interval`` the
+    ticks missed meanwhile are skipped and the next call is made on the
+    following tick. Exceptions raised by ``func`` are logged and do not
+    stop the loop.
+
+    :param stopping: `threading.Event`, also interrupts the wait between
+        cycles
+    """
+    next_run = clock()
+    while not stopping.is_set():
+        start = clock()
+        try:
+            func()
+        except Exception:
+            LOG.exception('Sync cycle failed')
+
+        now = clock()
+        next_run += interval
+        if next_run <= now:
+            skipped = int((now - next_run) // interval) + 1
+            LOG.warning('Sync cycle took %.1fs, skipping %s cycle(s)', now - start, skipped)
+            next_run += skipped * interval
+
+        stopping.wait(next_run - now)
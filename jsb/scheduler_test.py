@@ -0,0 +1,73 @@
+import unittest
+
+from jsb import scheduler
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeEvent(object):
+    """
+    Event whose waits advance the fake clock instead of sleeping
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.waits = []
+        self.flag = False
+
+    def is_set(self):
+        return self.flag
+
+    def set(self):
+        self.flag = True
+
+    def wait(self, timeout):
+        self.waits.append(timeout)
+        self.clock.now += timeout
+
+
+class RunPeriodicallyTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.stopping = FakeEvent(self.clock)
+        self.starts = []
+
+    def run_cycles(self, durations):
+        durations = list(durations)
+
+        def cycle():
+            self.starts.append(self.clock.now)
+            self.clock.now += durations.pop(0)
+            if not durations:
+                self.stopping.set()
+
+        scheduler.run_periodically(cycle, 60, self.stopping, clock=self.clock)
+
+    def test_interval(self):
+        self.run_cycles([10, 20, 5])
+
+        assert self.starts == [1000, 1060, 1120]
+        assert self.stopping.waits == [50, 40, 55]
+
+    def test_overrun_skips_ticks(self):
+        self.run_cycles([10, 130, 5])
+
+        assert self.starts == [1000, 1060, 1240]
+
+    def test_failed_cycle_does_not_stop(self):
+        calls = []
+
+        def cycle():
+            calls.append(self.clock.now)
+            if len(calls) == 2:
+                self.stopping.set()
+            raise ValueError('JIRA is down')
+
+        scheduler.run_periodically(cycle, 60, self.stopping, clock=self.clock)
+
+        assert calls == [1000, 1060]
@@ -1,101 +1,436 @@
+import bisect
+import copy
+import json
+import marshal
 import os
+import re
+import threading
+import time
+import zlib
 import yaml
 import shutil
+import sqlite3
+import struct
+from array import array
+from contextlib import contextmanager
+
+from six import string_types
+
+from jsb import LOG, YamlDumper, load_yaml
+
+
+try:
+    array('q')
+    INT_TYPECODE = 'q'
+except ValueError:
+    INT_TYPECODE = 'l'
+
+# Decimal strings which round-trip through int() and fit into 64 bits
+DECIMAL_ID = re.compile(r'^(0|[1-9][0-9]{0,17})$')
+
+
+class IntSet(object):
+    """
+    Compact set of ids.
+
+    Strings holding a canonical decimal number, like JIRA comment ids, are
+    kept as machine integers in a sorted array and looked up by bisection,
+    which takes a fraction of the memory of a set of strings. Anything else
+    goes into a regular set, so the container behaves like a set of the
+    original values.
+    """
+    def __init__(self, values=()):
+        self.ints = array(INT_TYPECODE)
+        self.other = set()
+
+        for value in values:
+            self.add(value)
+
+    @staticmethod
+    def _as_int(value):
+        if isinstance(value, string_types) and DECIMAL_ID.match(value):
+            return int(value)
+
+    def _index(self, number):
+        i = bisect.bisect_left(self.ints, number)
+        if i < len(self.ints) and self.ints[i] == number:
+            return i
+
+    def __contains__(self, value):
+        number = self._as_int(value)
+        if number is None:
+            return value in self.other
+        return self._index(number) is not None
+
+    def add(self, value):
+        number = self._as_int(value)
+        if number is None:
+            self.other.add(value)
+        elif not self.ints or number > self.ints[-1]:
+            # Ids mostly grow, so this is the common case
+            self.ints.append(number)
+        elif self._index(number) is None:
+            self.ints.insert(bisect.bisect_left(self.ints, number), number)
+
+    def discard(self, value):
+        number = self._as_int(value)
+        if number is None:
+            self.other.discard(value)
+            return
+
+        i = self._index(number)
+        if i is not None:
+            del self.ints[i]
+
+    def remove(self, value):
+        if value not in self:
+            raise KeyError(value)
+        self.discard(value)
+
+    def __iter__(self):
+        for number in self.ints:
+            yield str(number)
+        for value in self.other:
+            yield value
+
+    def __len__(self):
+        return len(self.ints) + len(self.other)
+
+    def __eq__(self, other):
+        if isinstance(other, IntSet):
+            return self.ints == other.ints and self.other == other.other
+        return set(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'IntSet({!r})'.format(set(self))
+
+    def dumps(self):
+        """
+        Serialize to a (bytes, list) pair of marshal-friendly values.
+
+        Sorted ids are stored as deltas, which compress very well.
+        """
+        deltas = array(INT_TYPECODE, self.ints)
+        for i in range(len(deltas) - 1, 0, -1):
+            deltas[i] -= deltas[i - 1]
+
+        return zlib.compress(_array_bytes(deltas)), list(self.other)
+
+    @classmethod
+    def loads(cls, value):
+        packed, other = value
+
+        result = cls()
+        ints = array(INT_TYPECODE)
+        _array_frombytes(ints, zlib.decompress(packed))
+        for i in range(1, len(ints)):
+            ints[i] += ints[i - 1]
+
+        result.ints = ints
+        result.other = set(other)
+        return result
+
+
+def is_set(value):
+    """
+    Whether ``value`` is a set, an `IntSet` or a `SqliteSet`. The runner
+    script imports this module as ``storage`` while the package imports it
+    as ``jsb.storage``, so their sets are not instances of each other's
+    classes and are recognized by their methods.
+    """
+    return isinstance(value, (set, frozenset)) or (hasattr(value, 'add') and
+                                                   hasattr(value, 'discard'))
+
+
+def _array_bytes(a):
+    if hasattr(a, 'tobytes'):
+        return a.tobytes()
+    return a.tostring()
+
+
+def _array_frombytes(a, data):
+    if hasattr(a, 'frombytes'):
+        a.frombytes(data)
+    else:
+        a.fromstring(data)
 
 
 class Store(object):
-    def __init__(self, backend=None):
+    """
+    Key/value state with redis-like string, hash and set operations.
+
+    By default every mutation is written through to the backend. Passing
+    ``flush_every`` and/or ``flush_interval`` (seconds) turns on write-behind
+    mode: mutations only mark the store dirty and the backend is written once
+    N mutations have accumulated or T seconds have passed since the last
+    write. Mutations made inside a ``transaction()`` block are deferred until
+    the outermost block of the calling thread exits, unless one of these
+    thresholds is reached first.
+
+    All operations are serialized with a lock, so a store can be shared by
+    several threads.
+
+    Sets named in ``compact_sets`` are kept as `IntSet`. Flushes are timed
+    in ``metrics``, a `jsb.metrics.Metrics`.
+    """
+    def __init__(self, backend=None, flush_every=None, flush_interval=None,
+                 compact_sets=(), metrics=None):
         if not backend:
             backend = InMemoryBackend()
 
         self.backend = backend
+        self.metrics = metrics
         self.data = backend.load()
 
+        self.compact_sets = frozenset(compact_sets)
+        for key in self.compact_sets:
+            if isinstance(self.data.get(key), set):
+                self.data[key] = IntSet(self.data[key])
+
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+
+        self.dirty = 0
+        self.last_flush = time.time()
+        self.lock = threading.RLock()
+        self._local = threading.local()
+
+    @property
+    def _transaction_depth(self):
+        return getattr(self._local, 'transaction_depth', 0)
+
+    @_transaction_depth.setter
+    def _transaction_depth(self, value):
+        self._local.transaction_depth = value
+
     def get(self, key):
-        return self.data.get(key)
+        with self.lock:
+            return self.data.get(key)
 
     def set(self, key, value):
-        if self.data.get(key) == value:
-            return False
+        with self.lock:
+            if self.data.get(key) == value:
+                return False
 
-        self.data[key] = value
-        self.save_to_backend()
-        return True
+            self.data[key] = value
+            self.backend.record('set', key, value)
+            self.save_to_backend()
+            return True
 
     def hget(self, key, field):
-        if key not in self.data:
-            return
+        with self.lock:
+            if key not in self.data:
+                return
+
+            return self.data[key].get(field)
+
+    def hgetall(self, key):
+        with self.lock:
+            if key not in self.data:
+                return {}
 
-        return self.data[key].get(field)
+            return dict(self.data[key].items())
 
     def hset(self, key, field, value):
-        if key not in self.data:
-            self.data[key] = {}
+        with self.lock:
+            if key not in self.data:
+                self.data[key] = {}
 
-        if self.data[key].get(field) == value:
-            return False
+            if self.data[key].get(field) == value:
+                return False
 
-        self.data[key][field] = value
-        self.backend.save(self.data)
-        return True
+            self.data[key][field] = value
+            self.backend.record('hset', key, field, value)
+            self.save_to_backend()
+            return True
 
     def sismember(self, key, value):
-        if key not in self.data:
-            return False
+        with self.lock:
+            if key not in self.data:
+                return False
 
-        return value in self.data[key]
+            return value in self.data[key]
 
     def sadd(self, key, value):
-        if key not in self.data:
-            self.data[key] = set()
+        with self.lock:
+            if key not in self.data:
+                self.data[key] = IntSet() if key in self.compact_sets else set()
 
-        s = self.data[key]
-        if value in s:
-            return False
+            s = self.data[key]
+            if value in s:
+                return False
 
-        s.add(value)
-        self.save_to_backend()
-        return True
+            s.add(value)
+            self.backend.record('sadd', key, value)
+            self.save_to_backend()
+            return True
 
     def srem(self, key, value):
-        if key not in self.data:
-            return False
+        with self.lock:
+            if key not in self.data:
+                return False
+
+            s = self.data[key]
+            if value not in s:
+                return False
+
+            s.remove(value)
+            self.backend.record('srem', key, value)
+            self.save_to_backend()
+            return True
+
+    @contextmanager
+    def transaction(self):
+        """
+        Defer backend writes until the outermost transaction exits, or
+        until ``flush_every`` or ``flush_interval`` is reached.
+
+        The accumulated changes are flushed even if the block raises, so
+        a failure half-way through an issue keeps the progress made so far.
+        Transactions are tracked per thread; a flush writes the whole state
+        including changes other threads have made so far.
+        """
+        self._transaction_depth += 1
+        try:
+            yield self
+        finally:
+            self._transaction_depth -= 1
+            if not self._transaction_depth:
+                self.flush()
 
-        s = self.data[key]
-        if value not in s:
-            return False
+    def save_to_backend(self):
+        self.dirty += 1
 
-        s.remove(value)
-        self.save_to_backend()
-        return True
+        if self.flush_every is None and self.flush_interval is None:
+            if not self._transaction_depth:
+                self.flush()
+            return
 
-    def save_to_backend(self):
-        self.backend.save(self.data)
+        if self.flush_every is not None and self.dirty >= self.flush_every:
+            self.flush()
+        elif (self.flush_interval is not None and
+                time.time() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Write pending changes to the backend, if there are any
+        """
+        with self.lock:
+            if not self.dirty:
+                return False
+
+            start = time.time()
+            self.backend.save(self.data)
+            if self.metrics:
+                self.metrics.observe('store_flush_seconds', time.time() - start)
+                if self.backend.saved_bytes is not None:
+                    self.metrics.increment('store_flush_bytes_total', self.backend.saved_bytes)
+            self.dirty = 0
+            self.last_flush = time.time()
+            return True
 
 
 class Backend(object):
+    # Bytes written by the last save, if the backend knows
+    saved_bytes = None
+
     def load(self):
         pass
 
+    def record(self, op, key, *args):
+        """
+        Called for every mutation before it is saved, backends which
+        persist individual operations instead of snapshots override it
+        """
+        pass
+
     def save(self, data):
         pass
 
 
 class FileBackend(Backend):
-    def __init__(self, path, tmp_path):
+    """
+    Keeps the whole state as a single snapshot file.
+
+    Snapshots are written in a compact binary format by default, which
+    loads an order of magnitude faster than YAML and keeps sets as sets.
+    Existing YAML files are still read and get converted on the next save.
+    If there is no snapshot yet and a ``legacy`` backend is given, its
+    state is imported on first load.
+    """
+    MAGIC = b'JSBSTATE'
+    VERSION = 2
+    HEADER = struct.Struct('>8sH')
+
+    def __init__(self, path, tmp_path, format='binary', legacy=None):
+        if format not in ('binary', 'yaml'):
+            raise ValueError('Unknown state format: {}'.format(format))
+
         self.tmp_path = tmp_path
         self.path = path
+        self.format = format
+        self.legacy = legacy
 
     def load(self):
-        if os.path.exists(self.path):
-            with open(self.path) as fp:
-                return yaml.load(fp)
-
-        return {}
+        if not os.path.exists(self.path):
+            data = (self.legacy.load() or {}) if self.legacy else {}
+            if data:
+                LOG.info('Importing %s keys into %s', len(data), self.path)
+                self.save(data)
+            return data
+
+        with open(self.path, 'rb') as fp:
+            content = fp.read()
+
+        if content.startswith(self.MAGIC):
+            return self.decode(content)
+
+        if self.format == 'binary':
+            LOG.info('Converting YAML state %s to binary format', self.path)
+        return load_yaml(content) or {}
+
+    def decode(self, content):
+        magic, version = self.HEADER.unpack_from(content)
+        if version not in (1, 2):
+            raise ValueError('Unsupported state version {} in {}'.format(version, self.path))
+
+        payload = marshal.loads(content[self.HEADER.size:])
+        if version == 1:
+            return payload
+
+        data, compact = payload
+        for key, value in compact.items():
+            data[key] = IntSet.loads(value)
+        return data
+
+    def encode(self, data):
+        plain, compact = {}, {}
+        for key, value in data.items():
+            if isinstance(value, IntSet):
+                compact[key] = value.dumps()
+            elif is_set(value):
+                plain[key] = set(value)
+            else:
+                plain[key] = value
+
+        # marshal version 2 is the newest one readable on both Python 2 and 3
+        return (self.HEADER.pack(self.MAGIC, self.VERSION) +
+                marshal.dumps((plain, compact), 2))
 
     def save(self, data):
-        with open(self.tmp_path, 'w') as fp:
-            yaml.dump(data, fp, default_flow_style=False)
+        if self.format == 'binary':
+            with open(self.tmp_path, 'wb') as fp:
+                fp.write(self.encode(data))
+        else:
+            data = dict((key, set(value) if is_set(value) else value)
+                        for key, value in data.items())
+            with open(self.tmp_path, 'w') as fp:
+                yaml.dump(data, fp, Dumper=YamlDumper, default_flow_style=False)
+        self.saved_bytes = os.path.getsize(self.tmp_path)
         shutil.move(self.tmp_path, self.path)
 
 
@@ -108,3 +443,450 @@ class InMemoryBackend(Backend):
 
     def save(self, data):
         self.data = data
+
+
+def merge_states(states, lowest=()):
+    """
+    Union of several states: hashes and sets are merged, for other keys
+    the last state having them wins, except for the keys in ``lowest``
+    which keep their lowest value
+    """
+    merged = {}
+    for state in states:
+        for key in state:
+            value = state[key]
+            current = merged.get(key)
+            if is_set(value):
+                merged[key] = set(current or ())
+                merged[key].update(value)
+            elif hasattr(value, 'items'):
+                merged[key] = dict(current or {})
+                merged[key].update(value.items())
+            elif key in lowest and current is not None:
+                merged[key] = min(current, value)
+            else:
+                merged[key] = value
+    return merged
+
+
+class MergedBackend(Backend):
+    """
+    Read-only union of the states of ``backends``, see `merge_states`.
+    ``select`` is called with every state and returns the part to merge.
+    """
+    def __init__(self, backends, lowest=(), select=None):
+        self.backends = backends
+        self.lowest = lowest
+        self.select = select
+
+    def load(self):
+        states = [backend.load() or {} for backend in self.backends]
+        if self.select:
+            states = [self.select(state) for state in states]
+        return merge_states(states, lowest=self.lowest)
+
+
+class ReadOnlyBackend(Backend):
+    """
+    State kept by any of the file backends at ``path``, ``log_path`` or
+    ``db_path``, read as plain dicts and sets without creating, converting
+    or repairing any of the files. The files of ``backend`` ("file",
+    "journal" or "sqlite"), the configured one, are read if they exist, so
+    files left behind by a previously used backend don't override them.
+    """
+    LAYOUTS = ('sqlite', 'journal', 'file')
+
+    def __init__(self, path, log_path=None, db_path=None, backend=None):
+        self.path = path
+        self.log_path = log_path
+        self.db_path = db_path
+        self.backend = backend
+
+    def load(self):
+        layouts = sorted(self.LAYOUTS, key=lambda layout: layout != self.backend)
+        for layout in layouts:
+            if layout == 'sqlite' and self.db_path and os.path.exists(self.db_path):
+                backend = SqliteBackend(self.db_path, read_only=True)
+                try:
+                    return merge_states([backend.load()])
+                finally:
+                    backend.close()
+
+            if layout == 'journal' and self.log_path:
+                journal = JournalBackend(self.path, None, self.log_path)
+                if os.path.exists(journal.log_path) or os.path.exists(journal.old_log_path):
+                    return journal.read()
+
+            if layout == 'file' and os.path.exists(self.path):
+                return FileBackend(self.path, None).load()
+
+        return {}
+
+
+def apply_record(data, record):
+    """
+    Apply a single journal record to a state dict
+    """
+    op, key = record[0], record[1]
+    if op == 'set':
+        data[key] = record[2]
+    elif op == 'hset':
+        data.setdefault(key, {})[record[2]] = record[3]
+    elif op == 'sadd':
+        data.setdefault(key, set()).add(record[2])
+    elif op == 'srem':
+        data.get(key, set()).discard(record[2])
+    else:
+        raise ValueError('Unknown journal operation: {}'.format(op))
+
+
+class JournalBackend(Backend):
+    """
+    Appends every mutation to a log on top of a periodic snapshot.
+
+    Saving costs one append of the records made since the previous save,
+    no matter how big the state is. Once the log grows past
+    ``compact_size`` bytes it is rotated and a fresh snapshot is written
+    by a background thread. Replaying a record twice is harmless, so a
+    crash at any point of the compaction leaves a loadable state.
+    ``legacy`` is imported like by `FileBackend`.
+    """
+    def __init__(self, path, tmp_path, log_path, compact_size=4 * 1024 * 1024,
+                 format='binary', legacy=None):
+        self.snapshot = FileBackend(path, tmp_path, format=format, legacy=legacy)
+        self.log_path = log_path
+        self.old_log_path = log_path + '.old'
+        self.compact_size = compact_size
+
+        self.pending = []
+        self.compaction = None
+
+    def read(self):
+        """
+        State with both logs replayed, leaving a torn log or an
+        interrupted compaction to the next `load`
+        """
+        data = self.snapshot.load() or {}
+        self._replay(data, self.old_log_path)
+        self._replay(data, self.log_path)
+        return data
+
+    def load(self):
+        data = self.snapshot.load() or {}
+
+        self._replay(data, self.old_log_path)
+        self._replay(data, self.log_path, truncate=True)
+
+        if os.path.exists(self.old_log_path):
+            # Previous compaction was interrupted, finish it right away
+            self.snapshot.save(data)
+            os.remove(self.old_log_path)
+
+        return data
+
+    def _replay(self, data, path, truncate=False):
+        if not os.path.exists(path):
+            return
+
+        valid_size = 0
+        with open(path, 'rb') as fp:
+            for line in fp:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('incomplete record')
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    LOG.warning('Ignoring torn journal record at %s:%s',
+                                path, valid_size)
+                    break
+
+                apply_record(data, record)
+                valid_size += len(line)
+
+        if truncate and valid_size != os.path.getsize(path):
+            with open(path, 'ab') as fp:
+                fp.truncate(valid_size)
+
+    def record(self, op, key, *args):
+        self.pending.append((op, key) + args)
+
+    def save(self, data):
+        self.saved_bytes = 0
+        if self.pending:
+            lines = ''.join(json.dumps(record) + '\n' for record in self.pending).encode('utf-8')
+            with open(self.log_path, 'ab') as fp:
+                fp.write(lines)
+                fp.flush()
+                os.fsync(fp.fileno())
+            self.saved_bytes = len(lines)
+            self.pending = []
+
+        if (os.path.exists(self.log_path) and
+                os.path.getsize(self.log_path) >= self.compact_size):
+            self.compact(data)
+
+    def compact(self, data):
+        """
+        Rotate the log and write a snapshot of ``data`` in the background.
+
+        ``data`` is copied on the caller's thread, which blocks it for the
+        time of the copy: the store lock held by the caller is what keeps
+        the copy consistent. While the rotated log of a failed compaction
+        is left, the log is not rotated again, as the rotated log holds
+        records of no snapshot; the new snapshot includes both logs.
+        """
+        if self.compaction and self.compaction.is_alive():
+            return False
+
+        if not os.path.exists(self.log_path):
+            return False
+
+        if not os.path.exists(self.old_log_path):
+            os.rename(self.log_path, self.old_log_path)
+        snapshot = copy.deepcopy(data)
+
+        self.compaction = threading.Thread(target=self._write_snapshot,
+                                           args=(snapshot,))
+        self.compaction.start()
+        return True
+
+    def _write_snapshot(self, data):
+        try:
+            self.snapshot.save(data)
+        except Exception:
+            LOG.exception('Failed to compact state journal %s', self.log_path)
+            return
+
+        os.remove(self.old_log_path)
+        LOG.debug('Compacted state journal %s', self.log_path)
+
+    def wait(self):
+        """
+        Wait for a running compaction to finish
+        """
+        if self.compaction:
+            self.compaction.join()
+
+
+class SqliteBackend(Backend):
+    """
+    Keeps the state in SQLite and reads it lazily.
+
+    ``load()`` returns a mapping which resolves keys, hash fields and set
+    members with indexed queries instead of reading the whole state into
+    memory. Changes are written straight to the database inside an open
+    transaction which ``save()`` commits, so write-behind boundaries of the
+    Store become SQLite transactions. If the database is empty and a
+    ``legacy`` backend is given, its state is imported on first load. A
+    ``read_only`` backend only reads an existing database.
+    """
+    def __init__(self, path, legacy=None, read_only=False):
+        self.path = path
+        self.legacy = legacy
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        if read_only:
+            return
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS keys (
+                key TEXT PRIMARY KEY,
+                type TEXT NOT NULL,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS hashes (
+                key TEXT NOT NULL,
+                field TEXT NOT NULL,
+                value TEXT,
+                PRIMARY KEY (key, field)
+            );
+            CREATE TABLE IF NOT EXISTS sets (
+                key TEXT NOT NULL,
+                member TEXT NOT NULL,
+                PRIMARY KEY (key, member)
+            );
+        """)
+
+    def execute(self, query, *params):
+        return self.connection.execute(query, params)
+
+    def load(self):
+        data = SqliteData(self)
+
+        if self.legacy and not len(data):
+            legacy_data = self.legacy.load() or {}
+            if legacy_data:
+                LOG.info('Importing %s keys into %s', len(legacy_data), self.path)
+                for key, value in legacy_data.items():
+                    data[key] = value
+                self.connection.commit()
+
+        return data
+
+    def save(self, data):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def _encode(value):
+    return json.dumps(value, sort_keys=True)
+
+
+def _decode(value):
+    return json.loads(value)
+
+
+class SqliteData(object):
+    """
+    Dict-like view of the state kept by `SqliteBackend`
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def _type(self, key):
+        row = self.backend.execute('SELECT type, value FROM keys WHERE key = ?', key).fetchone()
+        return row or (None, None)
+
+    def __len__(self):
+        return self.backend.execute('SELECT COUNT(*) FROM keys').fetchone()[0]
+
+    def __iter__(self):
+        for row in self.backend.execute('SELECT key FROM keys'):
+            yield row[0]
+
+    def keys(self):
+        return list(self)
+
+    def __contains__(self, key):
+        return self._type(key)[0] is not None
+
+    def __getitem__(self, key):
+        type_, value = self._type(key)
+        if type_ == 'string':
+            return _decode(value)
+        if type_ == 'hash':
+            return SqliteHash(self.backend, key)
+        if type_ == 'set':
+            return SqliteSet(self.backend, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self.__delitem__(key)
+
+        if isinstance(value, (dict, SqliteHash)):
+            self.backend.execute('INSERT INTO keys (key, type) VALUES (?, ?)', key, 'hash')
+            h = SqliteHash(self.backend, key)
+            for field, field_value in value.items():
+                h[field] = field_value
+        elif is_set(value):
+            self.backend.execute('INSERT INTO keys (key, type) VALUES (?, ?)', key, 'set')
+            s = SqliteSet(self.backend, key)
+            for member in value:
+                s.add(member)
+        else:
+            self.backend.execute('INSERT INTO keys (key, type, value) VALUES (?, ?, ?)',
+                                 key, 'string', _encode(value))
+
+    def __delitem__(self, key):
+        self.backend.execute('DELETE FROM keys WHERE key = ?', key)
+        self.backend.execute('DELETE FROM hashes WHERE key = ?', key)
+        self.backend.execute('DELETE FROM sets WHERE key = ?', key)
+
+    def __eq__(self, other):
+        return dict((key, self[key]) for key in self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class SqliteHash(object):
+    def __init__(self, backend, key):
+        self.backend = backend
+        self.key = key
+
+    def get(self, field, default=None):
+        row = self.backend.execute('SELECT value FROM hashes WHERE key = ? AND field = ?',
+                                   self.key, field).fetchone()
+        if row is None:
+            return default
+        return _decode(row[0])
+
+    def __getitem__(self, field):
+        row = self.backend.execute('SELECT value FROM hashes WHERE key = ? AND field = ?',
+                                   self.key, field).fetchone()
+        if row is None:
+            raise KeyError(field)
+        return _decode(row[0])
+
+    def __setitem__(self, field, value):
+        self.backend.execute('INSERT OR REPLACE INTO hashes (key, field, value) VALUES (?, ?, ?)',
+                             self.key, field, _encode(value))
+
+    def __contains__(self, field):
+        return self.backend.execute('SELECT 1 FROM hashes WHERE key = ? AND field = ?',
+                                    self.key, field).fetchone() is not None
+
+    def __len__(self):
+        return self.backend.execute('SELECT COUNT(*) FROM hashes WHERE key = ?',
+                                    self.key).fetchone()[0]
+
+    def __iter__(self):
+        for row in self.backend.execute('SELECT field FROM hashes WHERE key = ?', self.key):
+            yield row[0]
+
+    def items(self):
+        return [(row[0], _decode(row[1])) for row in
+                self.backend.execute('SELECT field, value FROM hashes WHERE key = ?', self.key)]
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class SqliteSet(object):
+    def __init__(self, backend, key):
+        self.backend = backend
+        self.key = key
+
+    def __contains__(self, member):
+        return self.backend.execute('SELECT 1 FROM sets WHERE key = ? AND member = ?',
+                                    self.key, _encode(member)).fetchone() is not None
+
+    def add(self, member):
+        self.backend.execute('INSERT OR IGNORE INTO sets (key, member) VALUES (?, ?)',
+                             self.key, _encode(member))
+
+    def discard(self, member):
+        self.backend.execute('DELETE FROM sets WHERE key = ? AND member = ?',
+                             self.key, _encode(member))
+
+    def remove(self, member):
+        if member not in self:
+            raise KeyError(member)
+        self.discard(member)
+
+    def __len__(self):
+        return self.backend.execute('SELECT COUNT(*) FROM sets WHERE key = ?',
+                                    self.key).fetchone()[0]
+
+    def __iter__(self):
+        for row in self.backend.execute('SELECT member FROM sets WHERE key = ?', self.key):
+            yield _decode(row[0])
+
+    def __eq__(self, other):
+        return set(self) == other
+
+    def __ne__(self, other):
+        return not self == other
@@ -1,5 +1,11 @@
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
+import yaml
+
 from jsb import storage
 
 class StoreTest(unittest.TestCase):
@@ -17,3 +23,440 @@ class StoreTest(unittest.TestCase):
         }
 
         assert self.backend.data == expected
+
+    def test_hgetall(self):
+        assert self.store.hgetall('test') == {}
+        self.store.hset('test', 'a', 1)
+
+        values = self.store.hgetall('test')
+        values['b'] = 2
+        assert self.store.hgetall('test') == {'a': 1}
+
+
+class CountingBackend(storage.InMemoryBackend):
+    def __init__(self):
+        super(CountingBackend, self).__init__()
+        self.saves = 0
+
+    def save(self, data):
+        super(CountingBackend, self).save(data)
+        self.saves += 1
+
+
+class WriteBehindTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = CountingBackend()
+
+    def test_write_through_by_default(self):
+        store = storage.Store(self.backend)
+        store.set('a', 1)
+        store.hset('h', 'f', 1)
+        store.sadd('s', 1)
+        store.srem('s', 1)
+
+        assert self.backend.saves == 4
+
+    def test_unchanged_values_are_not_written(self):
+        store = storage.Store(self.backend)
+        store.set('a', 1)
+        store.set('a', 1)
+
+        assert self.backend.saves == 1
+        assert not store.flush()
+
+    def test_transaction_writes_once(self):
+        store = storage.Store(self.backend)
+        with store.transaction():
+            for i in range(10):
+                store.sadd('seen_comments_id', str(i))
+                store.set('last_seen_jira_status:KEY-{}'.format(i), 'Open')
+
+            with store.transaction():
+                store.hset('issue_to_ticket_id', 'KEY-1', 'a0B1')
+
+            assert self.backend.saves == 0
+
+        assert self.backend.saves == 1
+        assert self.backend.data['issue_to_ticket_id'] == {'KEY-1': 'a0B1'}
+
+    def test_transaction_flushes_on_error(self):
+        store = storage.Store(self.backend)
+        with self.assertRaises(ValueError):
+            with store.transaction():
+                store.set('a', 1)
+                raise ValueError()
+
+        assert self.backend.saves == 1
+
+    def test_flush_every(self):
+        store = storage.Store(self.backend, flush_every=3)
+        for i in range(7):
+            store.sadd('s', i)
+
+        assert self.backend.saves == 2
+        assert store.dirty == 1
+
+        store.flush()
+        assert self.backend.saves == 3
+
+    def test_flush_interval(self):
+        store = storage.Store(self.backend, flush_interval=60)
+        store.set('a', 1)
+        store.set('b', 2)
+        assert self.backend.saves == 0
+
+        store.last_flush -= 61
+        store.set('c', 3)
+        assert self.backend.saves == 1
+
+    def test_thresholds_apply_within_transaction(self):
+        store = storage.Store(self.backend, flush_every=3)
+        with store.transaction():
+            for i in range(7):
+                store.sadd('s', i)
+
+            assert self.backend.saves == 2
+
+        assert self.backend.saves == 3
+
+        store = storage.Store(self.backend, flush_interval=60)
+        with store.transaction():
+            store.set('a', 1)
+            assert self.backend.saves == 3
+
+            store.last_flush -= 61
+            store.set('b', 2)
+            assert self.backend.saves == 4
+
+
+class ThreadSafetyTest(unittest.TestCase):
+    def test_concurrent_transactions(self):
+        backend = CountingBackend()
+        store = storage.Store(backend, compact_sets=['seen_comments_id'])
+
+        def worker(n):
+            for i in range(50):
+                with store.transaction():
+                    store.sadd('seen_comments_id', str(n * 1000 + i))
+                    store.hset('issue_to_ticket_id', 'KEY-{}-{}'.format(n, i), str(i))
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(store.get('seen_comments_id')) == 400
+        assert len(store.get('issue_to_ticket_id')) == 400
+        assert not store.dirty
+        assert 0 < backend.saves <= 400
+
+
+class IntSetTest(unittest.TestCase):
+    def test_set_semantics(self):
+        s = storage.IntSet(['10', '2', 'abc', '007', 5])
+        s.add('3')
+        s.add('3')
+
+        assert len(s) == 6
+        assert s == set(['10', '2', 'abc', '007', 5, '3'])
+        for value in ['2', '3', '10', 'abc', '007', 5]:
+            assert value in s
+        for value in [2, '5', '7', '4', '-1', '']:
+            assert value not in s
+
+        s.remove('10')
+        s.remove('abc')
+        s.discard('missing')
+        with self.assertRaises(KeyError):
+            s.remove('10')
+        assert s == set(['2', '3', '007', 5])
+
+    def test_numeric_ids_are_packed(self):
+        s = storage.IntSet(str(i) for i in range(1000, 0, -1))
+        assert not s.other
+        assert list(s.ints) == list(range(1, 1001))
+
+    def test_dumps(self):
+        s = storage.IntSet(str(i * 7) for i in range(1000))
+        s.add('x')
+
+        assert storage.IntSet.loads(s.dumps()) == s
+
+    def test_store(self):
+        backend = storage.InMemoryBackend()
+        backend.data = {'seen_comments_id': set(['1', '2'])}
+        store = storage.Store(backend, compact_sets=['seen_comments_id', 'other'])
+
+        assert isinstance(store.get('seen_comments_id'), storage.IntSet)
+        assert store.sismember('seen_comments_id', '1')
+        assert store.sadd('other', '3')
+        assert isinstance(store.get('other'), storage.IntSet)
+        assert store.srem('seen_comments_id', '1')
+        assert not store.sismember('seen_comments_id', '1')
+
+    def test_persistence(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'state')
+        tmp_path = os.path.join(directory, 'tmp_state')
+
+        for format in ('binary', 'yaml'):
+            store = storage.Store(storage.FileBackend(path, tmp_path, format=format),
+                                  compact_sets=['seen_comments_id'])
+            store.sadd('seen_comments_id', '{}1'.format(len(format)))
+            store.sadd('seen_comments_id', 'x')
+
+            store = storage.Store(storage.FileBackend(path, tmp_path, format=format),
+                                  compact_sets=['seen_comments_id'])
+            assert store.sismember('seen_comments_id', '{}1'.format(len(format)))
+            assert store.sismember('seen_comments_id', 'x')
+
+
+class FileBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'state.yml')
+        self.tmp_path = os.path.join(self.dir, 'tmp_state.yml')
+
+    def test_binary_roundtrip(self):
+        data = {
+            'seen_comments_id': set(['1', '2']),
+            'issue_to_ticket_id': {'KEY-1': 'a0B1'},
+            'last_seen_jira_status:KEY-1': 'Open',
+            'last_seen_sf_assignee:a0B1': None,
+        }
+        storage.FileBackend(self.path, self.tmp_path).save(data)
+
+        with open(self.path, 'rb') as fp:
+            assert fp.read().startswith(storage.FileBackend.MAGIC)
+        assert storage.FileBackend(self.path, self.tmp_path).load() == data
+
+    def test_migrate_yaml(self):
+        data = {'seen_comments_id': set(['1']), 'a': 'b'}
+        with open(self.path, 'w') as fp:
+            yaml.dump(data, fp, default_flow_style=False)
+
+        backend = storage.FileBackend(self.path, self.tmp_path)
+        store = storage.Store(backend)
+        assert store.data == data
+
+        store.sadd('seen_comments_id', '2')
+        with open(self.path, 'rb') as fp:
+            assert fp.read().startswith(storage.FileBackend.MAGIC)
+        assert backend.load() == {'seen_comments_id': set(['1', '2']), 'a': 'b'}
+
+    def test_yaml_format(self):
+        backend = storage.FileBackend(self.path, self.tmp_path, format='yaml')
+        backend.save({'s': set(['1'])})
+
+        with open(self.path) as fp:
+            assert yaml.load(fp, Loader=yaml.Loader) == {'s': set(['1'])}
+        assert backend.load() == {'s': set(['1'])}
+
+    def test_unknown_version(self):
+        with open(self.path, 'wb') as fp:
+            fp.write(storage.FileBackend.HEADER.pack(storage.FileBackend.MAGIC, 99))
+
+        with self.assertRaises(ValueError):
+            storage.FileBackend(self.path, self.tmp_path).load()
+
+    def test_import_merged_states(self):
+        first, second = storage.InMemoryBackend(), storage.InMemoryBackend()
+        first.data = {'seen_comments_id': set(['1']), 'issue_to_ticket_id': {'A-1': 'a'},
+                      'sync_watermark': 20, 'last_seen_jira_status:A-1': 'Open'}
+        second.data = {'seen_comments_id': set(['2']), 'issue_to_ticket_id': {'B-1': 'b'},
+                       'sync_watermark': 10, 'last_seen_jira_status:A-1': 'Closed'}
+        legacy = storage.MergedBackend([first, second], lowest=['sync_watermark'])
+
+        data = storage.FileBackend(self.path, self.tmp_path, legacy=legacy).load()
+
+        assert data == {'seen_comments_id': set(['1', '2']),
+                        'issue_to_ticket_id': {'A-1': 'a', 'B-1': 'b'},
+                        'sync_watermark': 10, 'last_seen_jira_status:A-1': 'Closed'}
+        first.data = {}
+        assert storage.FileBackend(self.path, self.tmp_path, legacy=legacy).load() == data
+
+    def test_read_only_backend(self):
+        data = {'a': 1, 'h': {'f': 'v'}, 's': set(['1'])}
+        paths = [os.path.join(self.dir, name) for name in ('journal.yml', 'journal.log', 'state.db')]
+        store = storage.Store(storage.JournalBackend(paths[0], self.tmp_path, paths[1]))
+        store.set('a', 1)
+        store.hset('h', 'f', 'v')
+        store.sadd('s', '1')
+        with open(paths[1], 'ab') as fp:
+            fp.write(b'["set", "b", ')
+        with open(paths[1], 'rb') as fp:
+            log = fp.read()
+
+        assert storage.ReadOnlyBackend(*paths).load() == data
+        with open(paths[1], 'rb') as fp:
+            assert fp.read() == log
+        assert not os.path.exists(paths[2])
+
+        backend = storage.SqliteBackend(paths[2])
+        storage.Store(backend).set('a', 2)
+        backend.close()
+        assert storage.ReadOnlyBackend(*paths).load() == {'a': 2}
+
+        # A database left behind doesn't override the configured backend
+        assert storage.ReadOnlyBackend(*paths, backend='journal').load() == data
+        assert storage.ReadOnlyBackend(*paths, backend='sqlite').load() == {'a': 2}
+
+
+class JournalBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def backend(self, compact_size=1024 * 1024):
+        return storage.JournalBackend(os.path.join(self.dir, 'state.yml'),
+                                      os.path.join(self.dir, 'tmp_state.yml'),
+                                      os.path.join(self.dir, 'state.log'),
+                                      compact_size=compact_size)
+
+    def test_replay(self):
+        store = storage.Store(self.backend())
+        store.set('a', 'b')
+        store.hset('issue_to_ticket_id', 'KEY-1', 'a0B1')
+        store.sadd('seen_comments_id', '1')
+        store.sadd('seen_comments_id', '2')
+        store.srem('seen_comments_id', '1')
+
+        data = self.backend().load()
+        assert data == {
+            'a': 'b',
+            'issue_to_ticket_id': {'KEY-1': 'a0B1'},
+            'seen_comments_id': set(['2']),
+        }
+
+    def test_appends_only_new_records(self):
+        store = storage.Store(self.backend())
+        store.sadd('seen_comments_id', '1')
+        size = os.path.getsize(os.path.join(self.dir, 'state.log'))
+        store.sadd('seen_comments_id', '2')
+
+        assert os.path.getsize(os.path.join(self.dir, 'state.log')) == 2 * size
+
+    def test_torn_write(self):
+        store = storage.Store(self.backend())
+        store.set('a', 1)
+        with open(os.path.join(self.dir, 'state.log'), 'ab') as fp:
+            fp.write(b'["set", "b", ')
+
+        store = storage.Store(self.backend())
+        assert store.data == {'a': 1}
+
+        store.set('c', 2)
+        assert self.backend().load() == {'a': 1, 'c': 2}
+
+    def test_compaction(self):
+        backend = self.backend(compact_size=100)
+        store = storage.Store(backend)
+        for i in range(20):
+            store.sadd('seen_comments_id', str(i))
+        backend.wait()
+
+        assert os.path.exists(os.path.join(self.dir, 'state.yml'))
+        assert not os.path.exists(os.path.join(self.dir, 'state.log.old'))
+        assert self.backend().load() == {'seen_comments_id': set(str(i) for i in range(20))}
+
+    def test_failed_compaction(self):
+        backend = self.backend()
+        store = storage.Store(backend)
+        save = backend.snapshot.save
+
+        def fail(data):
+            raise IOError('Disk full')
+        backend.snapshot.save = fail
+
+        store.set('a', 1)
+        backend.compact(store.data)
+        backend.wait()
+        store.set('b', 2)
+        backend.compact(store.data)
+        backend.wait()
+
+        # The rotated log of the first compaction is kept
+        assert self.backend().read() == {'a': 1, 'b': 2}
+
+        backend.snapshot.save = save
+        store.set('c', 3)
+        backend.compact(store.data)
+        backend.wait()
+
+        assert not os.path.exists(os.path.join(self.dir, 'state.log.old'))
+        assert self.backend().load() == {'a': 1, 'b': 2, 'c': 3}
+
+    def test_interrupted_compaction(self):
+        store = storage.Store(self.backend())
+        store.set('a', 1)
+        os.rename(os.path.join(self.dir, 'state.log'),
+                  os.path.join(self.dir, 'state.log.old'))
+        store.set('b', 2)
+
+        assert self.backend().load() == {'a': 1, 'b': 2}
+        assert not os.path.exists(os.path.join(self.dir, 'state.log.old'))
+        assert self.backend().load() == {'a': 1, 'b': 2}
+
+
+class SqliteBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'state.db')
+
+    def backend(self, legacy=None):
+        backend = storage.SqliteBackend(self.path, legacy=legacy)
+        self.addCleanup(backend.close)
+        return backend
+
+    def test_operations(self):
+        store = storage.Store(self.backend())
+        assert not store.sismember('seen_comments_id', '1')
+        assert store.sadd('seen_comments_id', '1')
+        assert not store.sadd('seen_comments_id', '1')
+        assert store.sismember('seen_comments_id', '1')
+        assert not store.sismember('seen_comments_id', 1)
+        assert store.srem('seen_comments_id', '1')
+        assert not store.sismember('seen_comments_id', '1')
+
+        assert store.hget('issue_to_ticket_id', 'KEY-1') is None
+        assert store.hset('issue_to_ticket_id', 'KEY-1', 'a0B1')
+        assert not store.hset('issue_to_ticket_id', 'KEY-1', 'a0B1')
+        assert store.hget('issue_to_ticket_id', 'KEY-1') == 'a0B1'
+
+        assert store.set('last_seen_jira_status:KEY-1', 'Open')
+        assert not store.set('last_seen_jira_status:KEY-1', 'Open')
+        assert store.get('last_seen_jira_status:KEY-1') == 'Open'
+        assert store.get('missing') is None
+
+    def test_persistence(self):
+        store = storage.Store(self.backend())
+        with store.transaction():
+            store.set('a', 1)
+            store.hset('h', 'f', 'v')
+            store.sadd('s', '1')
+
+        store = storage.Store(self.backend())
+        assert store.data == {'a': 1, 'h': {'f': 'v'}, 's': set(['1'])}
+
+    def test_uncommitted_changes_are_not_visible(self):
+        store = storage.Store(self.backend(), flush_every=10)
+        store.set('a', 1)
+
+        assert storage.Store(self.backend()).get('a') is None
+        store.flush()
+        assert storage.Store(self.backend()).get('a') == 1
+
+    def test_import_legacy_state(self):
+        legacy = storage.InMemoryBackend()
+        legacy.data = {'a': 'b', 's': set(['1', '2'])}
+
+        store = storage.Store(self.backend(legacy=legacy))
+        assert store.sismember('s', '2')
+        assert store.get('a') == 'b'
+
+        legacy.data = {'a': 'c'}
+        assert storage.Store(self.backend(legacy=legacy)).get('a') == 'b'
@@ -0,0 +1,588 @@
+"""
+In-process fakes of the Salesforce and JIRA REST APIs used by the bridge,
+for tests and benchmarks which need real HTTP traffic without a network.
+"""
+import itertools
+import json
+import re
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import parse_qs, urlparse
+
+from jsb.salesforce import endpoint_name
+
+SOQL = re.compile(r'^SELECT (?P<fields>.+?) FROM (?P<sobject>\w+)(?: WHERE (?P<where>.+?))?'
+                  r'(?: GROUP BY (?P<group_by>\w+))?$',
+                  re.IGNORECASE | re.DOTALL)
+AGGREGATE = re.compile(r'^(?P<function>COUNT|MAX|MIN)\((?P<field>\w+)\)\s+(?P<alias>\w+)$',
+                       re.IGNORECASE)
+CONDITION = re.compile(r"^(?P<field>\w+)\s*(?P<op>>=|<=|!=|=|>|<|\s+IN\s+)\s*(?P<value>.+)$",
+                       re.IGNORECASE | re.DOTALL)
+STRING = re.compile(r"'((?:[^'\\]|\\.)*)'")
+DATETIME = re.compile(r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.\d+)?(?:Z|[+-]\d{2}:?\d{2})$')
+
+# The part of JQL understood by the fake JIRA, other conditions match
+# every issue
+JQL_KEYS = re.compile(r'\bkey\s+in\s+\(([^)]*)\)', re.IGNORECASE)
+JQL_UPDATED = re.compile(r'\bupdated\s*>=\s*"?-(\d+)m"?', re.IGNORECASE)
+JIRA_RESOURCE = re.compile(r'/(issue|comment)/[^/]+')
+
+# Transition name to (id, target status) for every status, names as in
+# reference_jira_sf_statuses of config.yml
+JIRA_WORKFLOW = {
+    'New': {'Start Investigation': ('11', 'Support Investigating')},
+    'Support Investigating': {'Wait Reporter': ('21', 'Waiting Reporter'),
+                              'Resolve': ('31', 'Resolved')},
+    'Waiting Reporter': {'Start Investigation': ('11', 'Support Investigating'),
+                         'Resolve': ('31', 'Resolved')},
+    'Waiting Support': {'Start Investigation': ('11', 'Support Investigating'),
+                        'Resolve': ('31', 'Resolved')},
+    'Resolved': {'Start Investigation': ('11', 'Support Investigating'),
+                 'Close': ('41', 'Closed')},
+}
+
+
+def now(timestamp=None):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000+0000', time.gmtime(timestamp))
+
+
+def parse_value(value):
+    value = value.strip()
+    match = STRING.match(value)
+    if match:
+        return re.sub(r'\\(.)', r'\1', match.group(1))
+    if value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    if value.lower() == 'null':
+        return None
+    return value
+
+
+def parse_list(value):
+    return [re.sub(r'\\(.)', r'\1', item) for item in STRING.findall(value)]
+
+
+def matches(record, where):
+    if not where:
+        return True
+
+    for condition in re.split(r'\s+AND\s+', where.strip(), flags=re.IGNORECASE):
+        match = CONDITION.match(condition.strip())
+        if not match:
+            raise ValueError('Unsupported condition: {}'.format(condition))
+
+        field, op = match.group('field'), match.group('op').strip().upper()
+        actual = record.get(field)
+        if op == 'IN':
+            if actual not in parse_list(match.group('value')):
+                return False
+            continue
+
+        expected = parse_value(match.group('value'))
+        if op == '=' and actual != expected:
+            return False
+        if op == '!=' and actual == expected:
+            return False
+        if op in ('>', '<', '>=', '<='):
+            if actual is None:
+                return False
+            # UTC timestamps compare as strings once the format is the same
+            if DATETIME.match(actual) and DATETIME.match(expected):
+                actual = DATETIME.match(actual).group(1)
+                expected = DATETIME.match(expected).group(1)
+            if not {'>': actual > expected, '<': actual < expected,
+                    '>=': actual >= expected, '<=': actual <= expected}[op]:
+                return False
+
+    return True
+
+
+def aggregate(records, fields, group_by):
+    groups = {}
+    for record in records:
+        groups.setdefault(record.get(group_by), []).append(record)
+
+    results = []
+    for value, group in sorted(groups.items(), key=lambda item: str(item[0])):
+        result = {'attributes': {'type': 'AggregateResult'}}
+        for field in fields.split(','):
+            field = field.strip()
+            function = AGGREGATE.match(field)
+            if not function:
+                result[field] = group[0].get(field)
+                continue
+
+            values = [r.get(function.group('field')) for r in group
+                      if r.get(function.group('field')) is not None]
+            name = function.group('function').upper()
+            if name == 'COUNT':
+                result[function.group('alias')] = len(values)
+            else:
+                result[function.group('alias')] = (max if name == 'MAX' else min)(values)
+        results.append(result)
+    return results
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, delayed ACKs would hold
+    # back every keep-alive response otherwise
+    disable_nagle_algorithm = True
+    # The `FakeServer` handling the requests
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body=None):
+        content = b'' if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length).decode('utf-8') if length else ''
+
+    def handle_request(self, method):
+        raise NotImplementedError()
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_PATCH(self):
+        self.handle_request('PATCH')
+
+
+class SalesforceHandler(JsonHandler):
+    def handle_request(self, method):
+        salesforce = self.fake
+        url = urlparse(self.path)
+        path = url.path
+        body = self.read_body()
+
+        salesforce.count_request(method, endpoint_name(path))
+
+        if path == '/services/oauth2/token':
+            return self.send_json(200, {'access_token': salesforce.access_token,
+                                        'instance_url': salesforce.url})
+
+        if self.headers.get('Authorization') != 'Bearer {}'.format(salesforce.access_token):
+            return self.send_json(401, [{'errorCode': 'INVALID_SESSION_ID',
+                                         'message': 'Session expired or invalid'}])
+
+        if salesforce.take_throttled():
+            return self.send_json(429, [{'errorCode': 'REQUEST_LIMIT_EXCEEDED',
+                                         'message': 'Too many requests'}])
+
+        query = re.match(r'^/services/data/v[\d.]+/query(?:/(?P<cursor>[\w-]+))?$', path)
+        if query and method == 'GET':
+            if query.group('cursor'):
+                cursor, offset = query.group('cursor').rsplit('-', 1)
+                records = salesforce.cursors[cursor]
+                offset = int(offset)
+            else:
+                try:
+                    records = salesforce.query(parse_qs(url.query)['q'][0])
+                except ValueError as e:
+                    return self.send_json(400, [{'errorCode': 'MALFORMED_QUERY', 'message': str(e)}])
+                cursor = salesforce.new_id('01g')
+                salesforce.cursors[cursor] = records
+                offset = 0
+
+            page = records[offset:offset + salesforce.page_size]
+            result = {'totalSize': len(records), 'done': offset + len(page) >= len(records),
+                      'records': page}
+            if not result['done']:
+                result['nextRecordsUrl'] = '/services/data/v35.0/query/{}-{}'.format(
+                    cursor, offset + len(page))
+            return self.send_json(200, result)
+
+        collection = re.match(r'^/services/data/v[\d.]+/composite/sobjects$', path)
+        if collection:
+            results = []
+            for record in json.loads(body)['records']:
+                record = dict(record)
+                sobject = record.pop('attributes')['type']
+                if method == 'POST':
+                    created = salesforce.create(sobject, record)
+                    results.append({'id': created['Id'], 'success': True, 'errors': []})
+                elif salesforce.update(sobject, record['Id'], record):
+                    results.append({'id': record['Id'], 'success': True, 'errors': []})
+                else:
+                    results.append({'success': False, 'errors': [
+                        {'statusCode': 'ENTITY_IS_DELETED', 'message': 'entity is deleted'}]})
+            return self.send_json(200, results)
+
+        sobject = re.match(r'^/services/data/v[\d.]+/sobjects/(?P<type>\w+)(?:/(?P<id>\w+))?$', path)
+        if sobject and sobject.group('type') in salesforce.records:
+            type_, id = sobject.group('type'), sobject.group('id')
+            if method == 'POST' and not id:
+                created = salesforce.create(type_, json.loads(body))
+                return self.send_json(201, {'id': created['Id'], 'success': True, 'errors': []})
+
+            if method == 'PATCH' and id:
+                if salesforce.update(type_, id, json.loads(body)):
+                    return self.send_json(204)
+
+            if method == 'GET' and id:
+                with salesforce.lock:
+                    record = salesforce.records[type_].get(id)
+                    if record:
+                        record = dict(record, attributes={'type': type_})
+                        return self.send_json(200, record)
+
+        return self.send_json(404, [{'errorCode': 'NOT_FOUND', 'message': 'Not found'}])
+
+
+class JiraHandler(JsonHandler):
+    def handle_request(self, method):
+        jira = self.fake
+        url = urlparse(self.path)
+        path = re.sub(r'^/rest/api/latest/', '/rest/api/2/', url.path)
+        params = dict((name, values[0]) for name, values in parse_qs(url.query).items())
+        body = self.read_body()
+
+        jira.count_request(method, JIRA_RESOURCE.sub(r'/\1/{id}', path))
+
+        if path == '/rest/api/2/serverInfo':
+            return self.send_json(200, {'baseUrl': jira.url, 'version': '8.0.0',
+                                        'versionNumbers': [8, 0, 0],
+                                        'deploymentType': 'Server'})
+
+        if path == '/rest/api/2/myself':
+            return self.send_json(200, jira.user_resource(jira.username))
+
+        if path == '/rest/api/2/field':
+            return self.send_json(200, [{'id': name, 'name': name, 'clauseNames': [name]}
+                                        for name in ('summary', 'description', 'status')])
+
+        if path == '/rest/api/2/user/search':
+            return self.send_json(200, [jira.user_resource(params.get('username'))])
+
+        if path == '/rest/api/2/search':
+            issues = jira.search(params.get('jql', ''))
+            start = int(params.get('startAt', 0))
+            size = int(params.get('maxResults', 50))
+            page = [jira.render(issue) for issue in issues[start:start + size]]
+            return self.send_json(200, {'startAt': start, 'maxResults': size,
+                                        'total': len(issues), 'issues': page})
+
+        match = re.match(r'^/rest/api/2/issue/(?P<id>[^/]+)(?:/(?P<action>\w+))?$', path)
+        issue = jira.find(match.group('id')) if match else None
+        if issue is not None:
+            key, action = issue['key'], match.group('action')
+
+            if method == 'GET' and not action:
+                return self.send_json(200, jira.render(issue))
+
+            if method == 'PUT' and not action:
+                jira.update(key, json.loads(body).get('fields', {}))
+                return self.send_json(204)
+
+            if method == 'PUT' and action == 'assignee':
+                jira.assign(key, json.loads(body).get('name'))
+                return self.send_json(204)
+
+            if method == 'GET' and action == 'transitions':
+                return self.send_json(200, {'transitions': jira.transitions(key)})
+
+            if method == 'POST' and action == 'transitions':
+                if jira.transition(key, str(json.loads(body)['transition']['id'])):
+                    return self.send_json(204)
+                return self.send_json(400, {'errorMessages': [
+                    'It seems that you have tried to perform a workflow operation '
+                    'that is not valid from the current state.'], 'errors': {}})
+
+            if method == 'POST' and action == 'comment':
+                comment = jira.add_comment(key, json.loads(body)['body'], author=jira.username)
+                return self.send_json(201, comment)
+
+        return self.send_json(404, {'errorMessages': ['Not found'], 'errors': {}})
+
+
+class FakeServer(object):
+    """
+    HTTP server running ``handler`` in a background thread
+
+    :param latency: seconds added to every request
+    """
+    handler = None
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.requests = defaultdict(int)
+        self.lock = threading.RLock()
+
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def start(self):
+        handler = type(self.handler.__name__, (self.handler,), {'fake': self})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def count_request(self, method, endpoint):
+        with self.lock:
+            self.requests[(method, endpoint)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class FakeSalesforce(FakeServer):
+    """
+    Records of proxyTicket__c and proxyTicketComment__c with just enough of
+    the REST API and SOQL to run the bridge against them.
+
+    :param latency: seconds added to every request
+    :param page_size: number of records per query page
+    """
+    handler = SalesforceHandler
+
+    def __init__(self, latency=0, page_size=2000):
+        super(FakeSalesforce, self).__init__(latency)
+        self.page_size = page_size
+
+        self.records = {'proxyTicket__c': {}, 'proxyTicketComment__c': {}}
+        self.cursors = {}
+        self.ids = itertools.count(1)
+        self.tokens = itertools.count(1)
+        self.access_token = 'token{}'.format(next(self.tokens))
+        self.throttled = 0
+
+    def throttle(self, requests=1):
+        """
+        Answer the next ``requests`` API requests with 429
+        """
+        with self.lock:
+            self.throttled += requests
+
+    def take_throttled(self):
+        with self.lock:
+            if self.throttled:
+                self.throttled -= 1
+                return True
+        return False
+
+    def expire_token(self):
+        """
+        Invalidate the session, requests get 401 until clients authenticate
+        again
+        """
+        with self.lock:
+            self.access_token = 'token{}'.format(next(self.tokens))
+
+    def new_id(self, prefix):
+        # 15 character id plus the suffix of the 18 character form
+        return '{}{:012d}AAA'.format(prefix, next(self.ids))
+
+    def add_ticket(self, **fields):
+        with self.lock:
+            ticket = {
+                'Id': self.new_id('a0B'),
+                'Status__c': 'New',
+                'Closed__c': False,
+                'Priority__c': None,
+                'Assignee__c': None,
+                'Subject__c': None,
+                'Description__c': None,
+                'External_id__c': None,
+                'LastModifiedDate': now(),
+            }
+            ticket['CaseNumber__c'] = '{:08d}'.format(len(self.records['proxyTicket__c']) + 1)
+            ticket.update(fields)
+            self.records['proxyTicket__c'][ticket['Id']] = ticket
+            return ticket
+
+    def add_comment(self, **fields):
+        with self.lock:
+            comment = {
+                'Id': self.new_id('a0C'),
+                'Comment__c': None,
+                'related_id__c': None,
+                'external_id__c': None,
+                'CreatedById': '005000000000001AAA',
+                'CreatedBy': {'Name': 'Support Agent'},
+                'CreatedDate': now(),
+                'LastModifiedDate': now(),
+            }
+            comment.update(fields)
+            self.records['proxyTicketComment__c'][comment['Id']] = comment
+            return comment
+
+    def create(self, sobject, fields):
+        if sobject == 'proxyTicket__c':
+            return self.add_ticket(**fields)
+        return self.add_comment(**fields)
+
+    def update(self, sobject, id, fields):
+        with self.lock:
+            record = self.records[sobject].get(id)
+            if record is None:
+                return False
+            record.update(fields)
+            record['LastModifiedDate'] = now()
+            return True
+
+    def query(self, soql):
+        match = SOQL.match(soql.strip())
+        if not match:
+            raise ValueError('Unsupported query: {}'.format(soql))
+
+        with self.lock:
+            records = [dict(r) for r in self.records[match.group('sobject')].values()
+                       if matches(r, match.group('where'))]
+
+        if match.group('group_by'):
+            return aggregate(records, match.group('fields'), match.group('group_by'))
+
+        for record in records:
+            record['attributes'] = {'type': match.group('sobject')}
+        return records
+
+
+class FakeJira(FakeServer):
+    """
+    Issues with just enough of the JIRA REST API to run the bridge against
+    them with the jira library.
+
+    Searches only understand "key in (...)" and "updated >= -Nm" of JQL,
+    other conditions match every issue.
+
+    :param latency: seconds added to every request
+    :param username: name of the user the clients are logged in as
+    :param workflow: transition name to (id, target status) per status
+    """
+    handler = JiraHandler
+
+    def __init__(self, latency=0, username='jirabot', workflow=None):
+        super(FakeJira, self).__init__(latency)
+        self.username = username
+        self.workflow = workflow or JIRA_WORKFLOW
+
+        self.issues = OrderedDict()
+        self.ids = itertools.count(10000)
+
+    def user(self, name):
+        if name is None:
+            return None
+        return {'name': name, 'key': name, 'displayName': name.title(), 'active': True}
+
+    def user_resource(self, name):
+        return dict(self.user(name), self='{}/rest/api/2/user?username={}'.format(self.url, name))
+
+    def add_issue(self, key, status='New', assignee=None, **fields):
+        with self.lock:
+            issue = {
+                'id': str(next(self.ids)),
+                'key': key,
+                'fields': {
+                    'summary': 'Issue {}'.format(key),
+                    'description': 'Description of {}'.format(key),
+                    'status': {'name': status},
+                    'assignee': self.user(assignee),
+                    'reporter': self.user('reporter'),
+                    'creator': self.user('reporter'),
+                    'priority': {'name': 'Major'},
+                    'project': {'key': key.split('-')[0]},
+                    'issuetype': {'name': 'Bug'},
+                    'created': now(),
+                    'updated': now(),
+                    'attachment': [],
+                    'comment': {'comments': [], 'total': 0},
+                },
+            }
+            issue['fields'].update(fields)
+            self.issues[key] = issue
+            return issue
+
+    def add_comment(self, key, body, author='user'):
+        with self.lock:
+            comment = {
+                'id': str(next(self.ids)),
+                'body': body,
+                'author': self.user(author),
+                'created': now(),
+                'updated': now(),
+            }
+            comments = self.issues[key]['fields']['comment']
+            comments['comments'].append(comment)
+            comments['total'] = len(comments['comments'])
+            self.touch(key)
+            return comment
+
+    def touch(self, key, timestamp=None):
+        self.issues[key]['fields']['updated'] = now(timestamp)
+
+    def update(self, key, fields):
+        with self.lock:
+            issue = self.issues.get(key)
+            if issue is None:
+                return False
+            issue['fields'].update(fields)
+            self.touch(key)
+            return True
+
+    def assign(self, key, assignee):
+        return self.update(key, {'assignee': self.user(assignee)})
+
+    def transitions(self, key):
+        with self.lock:
+            status = self.issues[key]['fields']['status']['name']
+        return [{'id': id, 'name': name, 'to': {'name': to}}
+                for name, (id, to) in sorted(self.workflow.get(status, {}).items())]
+
+    def transition(self, key, transition_id):
+        for transition in self.transitions(key):
+            if transition['id'] == transition_id:
+                return self.update(key, {'status': transition['to']})
+        return False
+
+    def search(self, jql):
+        keys = JQL_KEYS.search(jql)
+        keys = set(key.strip().strip('"\'') for key in keys.group(1).split(',')) if keys else None
+        updated = JQL_UPDATED.search(jql)
+        since = now(time.time() - int(updated.group(1)) * 60) if updated else None
+
+        with self.lock:
+            return [issue for key, issue in self.issues.items()
+                    if (keys is None or key in keys) and
+                    (since is None or issue['fields']['updated'] >= since)]
+
+    def render(self, issue):
+        return dict(issue, self='{}/rest/api/2/issue/{}'.format(self.url, issue['id']))
+
+    def find(self, key_or_id):
+        with self.lock:
+            issue = self.issues.get(key_or_id)
+            if issue is None:
+                issue = next((i for i in self.issues.values() if i['id'] == key_or_id), None)
+            return issue
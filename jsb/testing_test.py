@@ -0,0 +1,47 @@
+import unittest
+
+from jira import JIRA
+
+from jsb import bridge, storage, testing
+from jsb.bridge_test import BOT, CONFIG
+from jsb.salesforce import Client, OAuth2
+
+
+class FakeServersTest(unittest.TestCase):
+    def setUp(self):
+        self.jira = testing.FakeJira(username=BOT).start()
+        self.addCleanup(self.jira.stop)
+        self.salesforce = testing.FakeSalesforce().start()
+        self.addCleanup(self.salesforce.stop)
+
+        config = dict(CONFIG, jira_url=self.jira.url)
+        jira_client = JIRA(server=self.jira.url, basic_auth=(BOT, 'password'))
+        sfdc_client = Client(OAuth2('client', 'secret', 'user', 'password',
+                                    auth_url=self.salesforce.url))
+        self.store = storage.Store()
+        self.bridge = bridge.Bridge(sfdc_client, jira_client, self.store, config)
+
+    def test_sync_issues(self):
+        for i in range(3):
+            key = 'TEST-{}'.format(i)
+            self.jira.add_issue(key, 'New', customfield_1=None, customfield_2=None)
+            self.jira.add_comment(key, 'Comment {}'.format(i))
+
+        self.bridge.sync_issues()
+
+        tickets = self.salesforce.records['proxyTicket__c']
+        assert len(tickets) == 3
+        assert len(self.salesforce.records['proxyTicketComment__c']) == 3
+        for issue in self.jira.issues.values():
+            assert issue['fields']['customfield_1'] in tickets
+            assert issue['fields']['assignee']['name'] == BOT
+
+    def test_search_understands_keys_and_updated(self):
+        self.jira.add_issue('TEST-1')
+        self.jira.add_issue('TEST-2')
+        self.jira.touch('TEST-2', timestamp=0)
+
+        assert [i['key'] for i in self.jira.search('project = TEST AND key in (TEST-2)')] == [
+            'TEST-2']
+        assert [i['key'] for i in self.jira.search('(project = TEST) AND updated >= -5m')] == [
+            'TEST-1']
@@ -0,0 +1,22 @@
+import threading
+
+
+class ThreadLocalProxy(object):
+    """
+    Proxy which creates a separate instance of an object for every thread
+    using it, for clients which should not be shared between threads.
+
+    :param factory: callable returning a new instance
+    """
+    def __init__(self, factory):
+        self._factory = factory
+        self._local = threading.local()
+
+    def _instance(self):
+        instance = getattr(self._local, 'instance', None)
+        if instance is None:
+            instance = self._local.instance = self._factory()
+        return instance
+
+    def __getattr__(self, name):
+        return getattr(self._instance(), name)
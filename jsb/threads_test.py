@@ -0,0 +1,28 @@
+import threading
+import unittest
+
+from jsb import threads
+
+
+class ThreadLocalProxyTest(unittest.TestCase):
+    def test_instance_per_thread(self):
+        created = []
+
+        def factory():
+            created.append(threading.current_thread().name)
+            return {'thread': threading.current_thread().name}
+
+        proxy = threads.ThreadLocalProxy(factory)
+        result = []
+
+        def use():
+            result.append(proxy.get('thread'))
+            result.append(proxy.get('thread'))
+
+        thread = threading.Thread(target=use, name='worker')
+        thread.start()
+        thread.join()
+        use()
+
+        assert result == ['worker', 'worker', 'MainThread', 'MainThread']
+        assert created == ['worker', 'MainThread']
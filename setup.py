@@ -8,6 +8,10 @@ setup(
     author_email='vokhrimenko@mirantis.com',
     url='https://github.com/vladryk/bridge',
     packages=find_packages(),
+    extras_require={
+        # --asyncio execution mode
+        'asyncio': ['aiohttp>=3.3'],
+    },
     entry_points={
         'console_scripts': [
             'jsb = jsb.runner:main',